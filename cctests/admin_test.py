@@ -0,0 +1,167 @@
+import asyncio
+import sys, os
+
+import pytest
+
+rootpath = os.path.realpath(os.path.dirname(__file__) + "/..")
+if rootpath not in sys.path:
+    sys.path.append(rootpath)
+
+pytest.importorskip("credentials")  # utils.config reads the bot's credentials
+from cogsmisc.adminUtils import COMMAND_PUBSUB_CHANNEL, AdminUtils, PendingCall, publish_command
+from utils import redisIO as redis
+from utils.aliases import AliasCache
+
+
+class FakePubSubRedis:
+    """Every cluster's connection to the same redis: published frames are delivered to each cluster's
+    AdminUtils by deliver()."""
+
+    def __init__(self):
+        self.clusters = []
+        self.frames = []
+
+    async def publish(self, channel, data):
+        assert channel == COMMAND_PUBSUB_CHANNEL
+        self.frames.append(data)
+
+    async def subscribe(self, channel):
+        class Channel:
+            async def iter(self, encoding=None):
+                return
+                yield
+
+        return [Channel()]
+
+    async def deliver(self):
+        frames, self.frames = self.frames, []
+        for frame in frames:
+            for admin in self.clusters:
+                await admin._ps_recv(frame)
+
+
+class FakeLoop:
+    @staticmethod
+    def create_task(coro):
+        coro.close()  # AdminUtils' startup tasks are run by hand
+
+
+class FakeBot:
+    loop = FakeLoop()
+    latencies = [(0, 0.05)]
+
+    def __init__(self, rdb, cluster_id, alias_cache=None):
+        self.rdb = rdb
+        self.cluster_id = cluster_id
+        self.alias_cache = alias_cache
+
+
+async def start_cluster(rdb, cluster_id, **kwargs):
+    bot = FakeBot(rdb, cluster_id, **kwargs)
+    admin = AdminUtils(bot)
+    await admin.admin_pubsub()  # registers the pubsub commands; there are no messages to read
+    rdb.clusters.append(admin)
+    return bot, admin
+
+
+def test_alias_invalidation():
+    class FakeCollection:
+        def __init__(self):
+            self.finds = 0
+
+        def find(self, query, projection):
+            self.finds += 1
+
+            async def results():
+                yield {"name": "fb", "commands": f"cast fireball {self.finds}"}
+
+            return results()
+
+    async def run():
+        rdb = FakePubSubRedis()
+        mdb = {"aliases": FakeCollection(), "servaliases": FakeCollection()}
+        bot, _ = await start_cluster(rdb, 0, alias_cache=AliasCache(mdb))
+        other, _ = await start_cluster(rdb, 1, alias_cache=AliasCache(mdb))
+        assert await other.alias_cache.get("fb", "1") == "cast fireball 1"
+        assert await other.alias_cache.get("fb", "1") == "cast fireball 1"  # cached
+
+        await publish_command(bot, "invalidate_aliases", kwargs={"owner": "1", "server": None})
+        await rdb.deliver()
+        assert await other.alias_cache.get("fb", "1") == "cast fireball 2"
+        assert rdb.frames == []  # invalidations aren't replied to
+
+    asyncio.run(run())
+
+
+def test_pending_call():
+    async def run():
+        request = redis.PubSubCommand.new(FakeBot(None, 0), "ping")
+        pending = PendingCall(request, 2, 30)
+        pending.add_reply(0, "a")
+        assert not pending.done.done()
+        pending.add_reply(1, "b")
+        assert pending.done.result() == {0: "a", 1: "b"}
+        pending.add_reply(2, "late")  # still collected, done stays resolved
+        assert [pending.updates.get_nowait() for _ in range(3)] == [(0, "a"), (1, "b"), (2, "late")]
+
+        assert PendingCall(request, 0, 30).done.result() == {}
+
+    asyncio.run(run())
+
+
+def test_pscall():
+    async def run():
+        rdb = FakePubSubRedis()
+        _, admin = await start_cluster(rdb, 0)
+        await start_cluster(rdb, 1)
+
+        call = asyncio.ensure_future(admin.pscall("ping", expected_replies=2, timeout=5))
+        await asyncio.sleep(0)
+        await rdb.deliver()  # the request, to both clusters
+        await asyncio.sleep(0.02)  # replies are batched
+        await rdb.deliver()
+        assert await call == {0: {"0": 0.05}, 1: {"0": 0.05}}
+        assert admin._ps_requests_pending == {}
+        assert admin.ps_metrics["ping"]["calls"] == 1 and admin.ps_metrics["ping"]["replies"] == 2
+
+        # only one of the two expected clusters answers
+        call = asyncio.ensure_future(admin.pscall("ping", expected_replies=3, timeout=0.1))
+        await asyncio.sleep(0)
+        await rdb.deliver()
+        await asyncio.sleep(0.02)
+        await rdb.deliver()
+        assert len(await call) == 2
+        assert admin._ps_requests_pending == {}
+        assert admin.ps_metrics["ping"]["timeouts"] == 1
+
+    asyncio.run(run())
+
+
+def test_pscall_iter():
+    async def run():
+        rdb = FakePubSubRedis()
+        _, admin = await start_cluster(rdb, 0)
+        await start_cluster(rdb, 1)
+
+        async def deliver_later():
+            await asyncio.sleep(0.01)
+            await rdb.deliver()
+            await asyncio.sleep(0.02)
+            await rdb.deliver()
+
+        delivery = asyncio.ensure_future(deliver_later())
+        replies = [reply async for reply in admin.pscall_iter("ping", expected_replies=2, timeout=5)]
+        await delivery
+        assert sorted(replies) == [(0, {"0": 0.05}), (1, {"0": 0.05})]
+        assert admin._ps_requests_pending == {}
+
+        # a caller that stops early cancels the call
+        delivery = asyncio.ensure_future(deliver_later())
+        replies = admin.pscall_iter("ping", expected_replies=3, timeout=5)
+        assert (await replies.__anext__())[1] == {"0": 0.05}
+        await replies.aclose()
+        await delivery
+        assert admin._ps_requests_pending == {}
+        assert admin.ps_metrics["ping"]["cancelled"] == 1
+
+    asyncio.run(run())
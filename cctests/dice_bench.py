@@ -0,0 +1,182 @@
+"""Microbenchmarks for the dice engine (cogscc/funcs/dice.py).
+
+Usage:
+    python cctests/dice_bench.py [--output results.json] [--baseline baseline.json]
+                                 [--threshold 0.1] [--seconds 0.5] [--only NAME ...]
+
+Each case reports ops/sec, p50/p99 latency and the peak bytes allocated per
+roll (tracemalloc measures bytes, not allocation counts).
+With --baseline, results are compared case by case and the script exits with
+status 1 if any case got slower than the threshold allows, so it can gate a
+deploy. Write a baseline by running with --output on the known-good commit."""
+
+import argparse
+import gc
+import json
+import platform
+import sys, os
+import time
+import tracemalloc
+
+rootpath = os.path.realpath(os.path.dirname(__file__) + "/..")
+if rootpath not in sys.path:
+    sys.path.append(rootpath)
+
+from cogscc.funcs.dice import roll, roll_many, odds, set_dice_source, SeededDiceSource
+
+ANNOTATED = (
+    " + ".join(
+        "1d{} [{}]".format(size, kind)
+        for size, kind in zip(
+            (4, 6, 8, 10, 12, 6, 8, 4),
+            ("fire", "cold", "acid", "force", "thunder", "fire", "radiant", "cold"),
+        )
+    )
+    + " + 5 [magic] for the dragon"
+)
+ANNOTATED_RESULT = roll(ANNOTATED)
+
+# name -> zero-argument callable doing one operation
+CASES = {
+    "d20": lambda: roll("1d20").total,
+    "d20+5": lambda: roll("1d20+5").total,
+    "d20 rendered": lambda: roll("1d20+5", inline=True).skeleton,
+    "4d6kh3": lambda: roll("4d6kh3").total,
+    "10d6ra6": lambda: roll("10d6ra6").total,
+    "300d6e6": lambda: roll("300d6e6").total,
+    "annotated": lambda: roll(ANNOTATED).result,
+    "consolidated": lambda: ANNOTATED_RESULT.consolidated(),
+    "roll_many 1000x 1d20+5": lambda: roll_many("1d20+5", 1000).totals,
+    "odds 4d6kh3": lambda: odds.__wrapped__("4d6kh3"),
+}
+
+# name -> rolls made by one call, for cases making more than one
+ROLLS_PER_CALL = {"roll_many 1000x 1d20+5": 1000}
+
+
+def run_case(func, seconds=0.5, rounds=5, alloc_samples=50, rolls=1):
+    """Times func for about the given number of seconds, split into rounds.
+    ops/sec comes from the fastest round, like timeit, as it is the least
+    disturbed by whatever else the machine is doing. Memory is the peak
+    allocated during a call above what was allocated before it, divided by
+    the number of rolls the call makes.
+    Returns: A dict of ops_per_sec, p50_us, p99_us, bytes_per_roll and calls."""
+    for _ in range(10):  # warm caches
+        func()
+    timings = []
+    best = 0
+    for _ in range(rounds):
+        gc.collect()
+        round_timings = []
+        deadline = time.perf_counter() + seconds / rounds
+        while time.perf_counter() < deadline:
+            start = time.perf_counter_ns()
+            func()
+            round_timings.append(time.perf_counter_ns() - start)
+        best = max(best, 1e9 * len(round_timings) / sum(round_timings))
+        timings += round_timings
+    timings.sort()
+
+    peak = 0
+    for _ in range(alloc_samples):
+        # restarting clears the traces and the peak: reset_peak() needs Python 3.9
+        tracemalloc.start()
+        func()
+        peak += tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return {
+        "ops_per_sec": round(best, 1),
+        "p50_us": round(timings[len(timings) // 2] / 1000, 2),
+        "p99_us": round(
+            timings[min(len(timings) - 1, len(timings) * 99 // 100)] / 1000, 2
+        ),
+        "bytes_per_roll": peak // (alloc_samples * rolls),
+        "calls": len(timings),
+    }
+
+
+def compare(results, baseline, threshold=0.1):
+    """Compares ops/sec against a baseline.
+    Returns: A list of (name, baseline ops/sec, ops/sec, change, regressed)"""
+    rows = []
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        change = result["ops_per_sec"] / old["ops_per_sec"] - 1
+        rows.append(
+            (
+                name,
+                old["ops_per_sec"],
+                result["ops_per_sec"],
+                change,
+                change < -threshold,
+            )
+        )
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the dice engine.")
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="compare against this JSON results file")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="fractional ops/sec drop that counts as a regression (default 0.1)",
+    )
+    parser.add_argument("--seconds", type=float, default=0.5, help="time per case")
+    parser.add_argument("--only", nargs="*", help="only run these cases")
+    args = parser.parse_args(argv)
+
+    set_dice_source(SeededDiceSource(0))
+    results = {}
+    print(
+        "{:<24} {:>12} {:>10} {:>10} {:>12}".format(
+            "case", "ops/sec", "p50 us", "p99 us", "bytes/roll"
+        )
+    )
+    for name, func in CASES.items():
+        if args.only and name not in args.only:
+            continue
+        results[name] = res = run_case(func, args.seconds, rolls=ROLLS_PER_CALL.get(name, 1))
+        print(
+            "{:<24} {ops_per_sec:>12,.0f} {p50_us:>10.2f} {p99_us:>10.2f} {bytes_per_roll:>12,}".format(
+                name, **res
+            )
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "python": platform.python_version(),
+                    "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        rows = compare(results, baseline, args.threshold)
+        print(
+            "\n{:<24} {:>12} {:>12} {:>8}".format("case", "baseline", "now", "change")
+        )
+        for name, old, new, change, regressed in rows:
+            print(
+                "{:<24} {:>12,.0f} {:>12,.0f} {:>+7.1%}{}".format(
+                    name, old, new, change, "  REGRESSION" if regressed else ""
+                )
+            )
+        if any(row[4] for row in rows):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,295 @@
+import asyncio
+import sys, os
+import threading
+import time
+
+rootpath = os.path.realpath(os.path.dirname(__file__) + "/..")
+if rootpath not in sys.path:
+    sys.path.append(rootpath)
+
+from cogscc.funcs.dice import (
+    roll,
+    roll_many,
+    compile_roll,
+    get_dice_source,
+    set_dice_source,
+    SeededDiceSource,
+    SystemDiceSource,
+    DiceResult,
+    DicePlan,
+    ConstantPlan,
+    OperatorPlan,
+    CommentPlan,
+    odds,
+    estimate_cost,
+    MAX_REROLLS,
+)
+from cogscc.funcs.rollpool import ROLL_TIMEOUT, RollPool
+from cogscc.models.errors import InvalidArgument, TooBusy
+
+
+def test_roll():
+    assert type(roll("1d20")) == DiceResult
+    assert 0 < roll("1d20").total < 21
+    assert roll("3+4*(9-2)").total == 31
+    assert roll("1d20**2").total == 0
+
+
+def test_compile_roll():
+    plan = compile_roll("4d6kh3[str]+2 for strength")
+    assert plan == (
+        DicePlan(4, 6, ("", "k", "h3"), "[str]", False),
+        OperatorPlan("+", ""),
+        ConstantPlan(2, ""),
+        CommentPlan("for strength"),
+    )
+    assert compile_roll("4d6kh3[str]+2 for strength") is plan
+    assert compile_roll("1d20")[0].allows_adv
+
+
+def test_advantage():
+    r = roll("1d20", adv=1)
+    assert len(r.raw_dice.parts[0].rolled) == 2
+    assert r.total == max(d.value for d in r.raw_dice.parts[0].rolled)
+    r = roll("1d20", adv=-1)
+    assert r.total == min(d.value for d in r.raw_dice.parts[0].rolled)
+
+
+def test_arithmetic():
+    assert roll("2*-3").total == -6
+    assert roll("--3").total == 3
+    assert roll("7/2").total == 3
+    assert roll("-7/2").total == -4
+    assert roll("8/2/2").total == 2
+    assert roll("10-2-3").total == 5
+    assert roll("1.5*2").total == 3
+    assert roll("1/0").total == 0
+    assert roll("2+").result == "Invalid input: No dice found to roll."
+    assert roll("3=3").result == "Invalid input: No dice found to roll."
+
+
+def test_roll_many():
+    r = roll_many("4d6kh3", 1000)
+    assert len(r) == 1000
+    assert all(3 <= t <= 18 for t in r.totals)
+    assert r.total == sum(r.totals)
+    assert type(r[-1]) == DiceResult
+    for i in range(0, 1000, 97):
+        assert r[i].total == r.totals[i]
+        assert len([p for p in r[i].raw_dice.parts[0].rolled if p.kept]) == 3
+
+    r = roll_many("10d2mi2", 50)
+    assert all(t == 20 for t in r.totals)
+    assert all(
+        d.value == 2 and d.rolls[0] in (1, 2) for d in r[0].raw_dice.parts[0].rolled
+    )
+
+    r = roll_many("4d6rr<3+2", 200)
+    assert all(14 <= t <= 26 for t in r.totals)
+
+    r = roll_many("1d1e1", 3)
+    assert list(r.totals) == [1001] * 3
+
+    r = roll_many("1d1e1rr1e1rr1", 3)
+    assert list(r.totals) == [0] * 3
+    assert r[1].result == "Invalid input: Tried to reroll too many dice."
+
+    r = roll_many("1d6/(1d2-1)", 200)
+    assert any(res.result == "Invalid input: division by zero" for res in r)
+
+    r = roll_many("1d20**2", 5)
+    assert r[4].result == "Invalid input: Exponents are currently disabled."
+
+
+def test_dice_sources():
+    source = get_dice_source()
+    try:
+        set_dice_source(SeededDiceSource(42))
+        first = [roll("10d6e6").result for _ in range(5)]
+        first_many = list(roll_many("4d6kh3", 20).totals)
+        set_dice_source(SeededDiceSource(42))
+        assert [roll("10d6e6").result for _ in range(5)] == first
+        assert list(roll_many("4d6kh3", 20).totals) == first_many
+    finally:
+        set_dice_source(source)
+
+    system = SystemDiceSource(block_size=16)
+    rolls = [system.randint(6) for _ in range(600)]
+    assert set(rolls) == {1, 2, 3, 4, 5, 6}
+    batch = system.integers(20, (50, 10))
+    assert batch.shape == (50, 10)
+    assert 1 <= batch.min() and batch.max() <= 20
+
+
+def test_dice_group_arrays():
+    r = roll("10d2mi2")
+    group = r.raw_dice.parts[0]
+    assert len(group.values) == len(group.kept) == len(group.exploded) == 10
+    assert group.get_num_kept() == 10
+    for i, die in enumerate(group.rolled):
+        assert die.value == group.values[i] == 2
+        assert die.rolls == group.history.get(i, []) + [2]
+    assert str(group).count("**2**") == 10
+    assert group.to_dict()["dice"][0]["rolls"][-1] == 2
+
+
+def test_reroll_budget():
+    r = roll("300d2e2")
+    group = r.raw_dice.parts[0]
+    assert r.raw_dice.budget.spent <= 1001
+    assert len(group.values) <= 300 + 1000
+    assert 300 <= r.total
+
+    r = roll("1d1e1+1d1e1")
+    assert r.result == "Invalid input: Tried to reroll too many dice."
+
+
+def test_lazy_result():
+    r = roll("1d20+5 [fire] for luck", inline=True)
+    assert r._render is not None
+    assert 6 <= r.total <= 25
+    assert r._render is not None
+    assert r.skeleton.endswith("= `{}`".format(r.total))
+    assert r._render is None
+    assert r.result.startswith("**for luck:** ")
+    assert "[fire]" in r.rolled
+
+
+def test_fast_path():
+    # the fast path must draw and render exactly like the full engine
+    source = get_dice_source()
+    try:
+        for expr in ("1d20+5", "4d6kh3", "2d6-1", "d20", "3d6kl2"):
+            for adv in (0, 1, -1):
+                set_dice_source(SeededDiceSource(11))
+                fast = roll(expr, adv=adv, inline=True)
+                assert fast.raw_dice._replay is not None
+                set_dice_source(SeededDiceSource(11))
+                full = roll(expr + " ", adv=adv, inline=True)
+                assert (fast.total, fast.crit) == (full.total, full.crit)
+                assert fast.result == full.result
+                assert str(fast.raw_dice.parts[0]) == str(full.raw_dice.parts[0])
+    finally:
+        set_dice_source(source)
+
+
+def test_consolidated():
+    r = roll("1d1+1d1 [fire] + 2 [fire] + 1d1 [cold] + 3")
+    assert r.consolidated() == "4 [fire]+4 [cold]"
+    assert roll("1d1 [fire] * 2 [cold]").consolidated() == "1 [fire]+0 [cold]"
+    assert roll("3d1 for luck").consolidated() == "3"
+    assert DiceResult().consolidated() == "0"
+
+
+def test_odds():
+    d20 = odds("1d20+5")
+    assert d20.mean() == 15.5
+    assert abs(d20.at_least(16) - 0.5) < 1e-9
+    assert d20.percentile(50) == 15
+
+    # 4d6 keep highest 3: of 1296 outcomes, 21 give 18 and only 1,1,1,1 gives 3
+    d = odds("4d6kh3")
+    assert abs(d.to_dict()[18] - 21 / 1296) < 1e-12
+    assert abs(d.to_dict()[3] - 1 / 1296) < 1e-12
+    assert abs(d.mean() - 15869 / 1296) < 1e-9
+
+    assert odds("1d20", adv=1).at_least(20) > odds("1d20").at_least(20)
+    assert abs(odds("1d6rr1").mean() - 4) < 1e-9
+    assert abs(odds("1d6e6").mean() - 4.2) < 1e-6
+    assert odds("1d6/2").values.tolist() == [0, 1, 2, 3]
+    assert odds("3").to_dict() == {3: 1.0}
+
+    for unsupported in ("1d6ra6", "4d6kh3rr1", "1d6/(1d2-1)"):
+        try:
+            odds(unsupported)
+            assert False, unsupported
+        except InvalidArgument:
+            pass
+
+
+def test_odds_too_complex():
+    # the outer product of two 9901 or 29701 value distributions would take gigabytes
+    for expr in ("100d100*100d100", "(300d100)/(300d100)"):
+        try:
+            odds(expr)
+            assert False, expr
+        except InvalidArgument:
+            pass
+    # these would hold a RollPool worker for seconds, long after the roll timed out
+    for expr in ("300d1000", "50d100*50d100", "40d100kh30", "1d1000e>1", "+".join(["100d1000"] * 10)):
+        start = time.perf_counter()
+        try:
+            odds(expr)
+            assert False, expr
+        except InvalidArgument:
+            pass
+        assert time.perf_counter() - start < ROLL_TIMEOUT / 4, expr
+    # subtraction is a convolution, like addition
+    d = odds("300d100-300d100")
+    assert d.values[0] == -d.values[-1]  # the extremes are too unlikely for a float
+    assert abs(d.mean()) < 1e-6
+
+
+def test_odds_match_rolls():
+    for expr in ("4d6kh3", "5d6p<3kl2", "3d6e6", "4d6ro<3mi2"):
+        d = odds(expr)
+        totals = roll_many(expr, 20000).totals
+        assert abs(totals.mean() - d.mean()) < 4 * d.std() / 20000 ** 0.5
+
+
+def test_long_reroll_chains():
+    start = time.perf_counter()
+    out = roll_many("1d1e1", 10000)
+    assert time.perf_counter() - start < ROLL_TIMEOUT  # so a multiroll of it can't time out on the RollPool
+    assert (out.totals == MAX_REROLLS + 1).all()
+    assert out[0].total == MAX_REROLLS + 1
+
+
+def test_estimate_cost():
+    assert estimate_cost("1d20+5") == 1
+    assert estimate_cost("1d20", adv=1) == 2
+    assert estimate_cost("300d6e6") == 1200
+    assert estimate_cost("1d1e1", iterations=10000) == 10000000  # the whole reroll budget, each iteration
+    assert estimate_cost("4d6kh3+2d8", iterations=100) == 600
+    assert estimate_cost("1d20**2") == 0
+
+
+def test_roll_pool():
+    async def run():
+        pool = RollPool(workers=2, max_pending=3, per_user=2, timeout=5)
+        release = threading.Event()
+        slow = lambda: release.wait(5) and roll("300d6").total
+        first = asyncio.ensure_future(pool.run(1, slow))
+        second = asyncio.ensure_future(pool.run(1, slow))
+        await asyncio.sleep(0.05)
+        try:
+            await pool.run(1, slow)  # over the per-user cap
+            assert False
+        except TooBusy:
+            pass
+        third = asyncio.ensure_future(pool.run(2, slow))
+        await asyncio.sleep(0.05)
+        try:
+            await pool.run(3, slow)  # pool is full
+            assert False
+        except TooBusy:
+            pass
+        release.set()
+        totals = await asyncio.gather(first, second, third)
+        assert all(300 <= t <= 1800 for t in totals)
+        assert pool.pending == 0 and not pool.users
+
+        pool.timeout = 0.05
+        release.clear()
+        try:
+            await pool.run(1, slow)
+            assert False
+        except TooBusy:
+            pass
+        assert pool.pending == 1  # still running on its thread
+        release.set()
+        await asyncio.sleep(0.1)
+        assert pool.pending == 0
+        pool.shutdown()
+
+    asyncio.run(run())
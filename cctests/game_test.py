@@ -4,12 +4,17 @@ rootpath = os.path.realpath(os.path.dirname(__file__) + "/..")
 if rootpath not in sys.path:
     sys.path.append(rootpath)
 
+import asyncio
+import io
 import time
 import json
 import random
+import re
+import pytest
 from os.path import basename
 from discord.ext import commands
 from cogscc.funcs.dice import roll
+from cogscc.game import Game as GameCog
 from cogscc.character import Character
 from cogscc.monster import Monster
 import cogscc.npc
@@ -23,6 +28,18 @@ from cogscc.models.errors import (
 from cogscc.world.world import GHWorld
 from cogscc.world.location import GHLocation
 from cogscc.base_obj import BaseObj
+from cogscc.funcs import persistence
+from cogscc.funcs.persistence import (
+    BackupStore,
+    CampaignStore,
+    campaign_dict,
+    campaign_records,
+    convert_to_snapshot,
+    iter_campaign_json,
+    read_snapshot,
+    snapshot_bytes,
+    snapshot_json,
+)
 
 
 class ToJson(json.JSONEncoder):
@@ -75,7 +92,8 @@ class Game(BaseObj):
                     self.characters[player] = Character.__from_dict__(character)
 
 
-def test_save_load():
+def test_save_load(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # Game.saveJson writes to the working directory
     g = Game()
     g.world.set_date(364 * 10.5)
     l = GHLocation("new town", "plains", 40, 0)
@@ -96,4 +114,211 @@ def test_save_load():
     assert g3 == Game()
 
 
-test_save_load()
+@pytest.fixture
+def campaign():
+    g = Game()
+    g.world.set_date(364 * 10.5)
+    g.world.add_location(GHLocation("new town", "plains", 40, 0))
+    g.world.reset_weather()
+    g.characters["slithy#1234"] = Character("Slithy", "Human", "Fighter", 3)
+    g.characters["a/b+c%"] = Character("Odd Name", "Elf", "Wizard", 1)
+    return g
+
+
+def as_json(g):
+    return json.loads(json.dumps({"characters": g.characters, "world": g.world}, cls=ToJson))
+
+
+class FakeCtx:
+    """Stands in for the context of a command invoked by a Game Master; what the bot sends is kept in sent."""
+
+    author = type("Author", (), {"roles": [type("Role", (), {"name": "Game Master"})()], "__str__": lambda _: "gm#1"})()
+
+    def __init__(self, command):
+        self.command = command
+        self.sent = []
+
+    async def send(self, content):
+        self.sent.append(content)
+        return self
+
+    async def edit(self, content):
+        self.sent.append(content)
+
+
+@pytest.fixture
+def cog(tmp_path, campaign):
+    """A Game cog saving to tmp_path, playing the campaign."""
+    g = GameCog(type("FakeBot", (), {})())
+    g.save_dir = str(tmp_path)
+    g.characters = campaign.characters
+    g.world = campaign.world
+    return g
+
+
+async def invoke(cog, name, *args):
+    """Runs a Game command like the bot does, after_invoke hook included. Returns what it sent."""
+    command = next(c for c in cog.get_commands() if c.name == name)
+    ctx = FakeCtx(command)
+    await command.callback(cog, ctx, *args)
+    await cog.cog_after_invoke(ctx)
+    return ctx.sent
+
+
+def test_campaign_store(tmp_path, campaign):
+    g = campaign
+    records = campaign_records(g.characters, g.world)
+    assert json.loads(snapshot_json(records)) == as_json(g)
+
+    async def run():
+        store = CampaignStore(str(tmp_path / "campaign"))
+        assert await store.save(records) == len(records)
+        assert await store.save(records) == 0  # nothing changed
+        g.characters["slithy#1234"].levelUp()
+        del g.characters["a/b+c%"]
+        assert await store.save(campaign_records(g.characters, g.world)) == 2
+
+        raw = campaign_dict(CampaignStore(store.path).load())
+        assert raw == as_json(g)
+        assert GHWorld.__from_dict__(raw["world"]) == g.world
+
+        # changes between saves are journaled, and replayed on load
+        g.characters["new#1"] = Character("New", "Dwarf", "Cleric", 1)
+        assert await store.journal(campaign_records(g.characters, g.world), "create")
+        assert not await store.journal(campaign_records(g.characters, g.world), "character")
+        g.world.set_date(400)
+        del g.characters["slithy#1234"]
+        assert await store.journal(campaign_records(g.characters, g.world), "set_date")
+        with open(store.journal_path, "a") as f:
+            f.write('{"ts": 0, "op": "torn", "del": [], "se')  # a crash mid-append
+        recovered = CampaignStore(store.path)
+        assert campaign_dict(recovered.load()) == as_json(g)
+        assert recovered.journal_entries == 2
+
+        # a save folds the journal into the record files
+        assert await recovered.save(campaign_records(g.characters, g.world)) > 0
+        assert not os.path.exists(recovered.journal_path)
+        assert campaign_dict(CampaignStore(store.path).load()) == as_json(g)
+
+    asyncio.run(run())
+
+
+def test_save_load_cog(tmp_path, cog):
+    async def run():
+        sent = await invoke(cog, "save", "camp.json")
+        records = len(os.listdir(tmp_path / "campaigns" / "camp.json"))
+        assert sent[-1].endswith(f"({records} of {records} records changed)")
+        assert (await invoke(cog, "save", "camp.json"))[-1].endswith(f"(0 of {records} records changed)")
+
+        loaded = GameCog(cog.bot)
+        loaded.save_dir = cog.save_dir
+        await invoke(loaded, "load", "camp.json")
+        assert as_json(loaded) == as_json(cog)
+        assert loaded.campaign == "camp.json"
+
+        # a campaign saved as one JSON file, before per-record saves
+        (tmp_path / "old.json").write_text(json.dumps(as_json(cog)))
+        old = GameCog(cog.bot)
+        old.save_dir = cog.save_dir
+        await invoke(old, "load", "old.json")
+        assert as_json(old) == as_json(cog)
+
+    asyncio.run(run())
+
+
+def test_journal_cog(tmp_path, cog):
+    async def run():
+        await invoke(cog, "save", "camp.json")
+        store = cog.getStore("camp.json")
+        await invoke(cog, "party")
+        await invoke(cog, "backups", "camp.json")
+        assert store.journal_entries == 0  # commands that change nothing aren't journaled
+        assert not os.path.exists(store.journal_path)
+
+        await invoke(cog, "level_up", "Slithy")
+        await invoke(cog, "set_date", 400)
+        assert store.journal_entries == 2
+        with open(store.journal_path) as f:
+            entries = [json.loads(line) for line in f]
+        assert [key for key, _ in entries[0]["set"]] == [["characters", "slithy#1234"]]  # only what changed
+        assert all(key[0] == "world" for key, _ in entries[1]["set"])
+
+        await invoke(cog, "euthanise", "a/b+c%")
+        recovered = GameCog(cog.bot)  # after a crash
+        recovered.save_dir = cog.save_dir
+        await invoke(recovered, "load", "camp.json")
+        assert as_json(recovered) == as_json(cog)
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("backup_format", ["chunks", "json", "snapshot"])
+def test_backups_cog(tmp_path, cog, backup_format):
+    async def run():
+        old = as_json(cog)
+        (tmp_path / "camp.json.20200101000000").write_text(json.dumps(old))  # written before backup formats
+        cog.characters["slithy#1234"].levelUp()
+        cog.backup_format = backup_format
+        saved = (await invoke(cog, "save", "camp.json"))[-1]
+        backup = re.search(r"saved as (\S+)", saved).group(1)
+        assert (await invoke(cog, "backups", "camp.json")) == [f"Backups of camp.json:\n{backup}\ncamp.json.20200101000000"]
+        assert (await invoke(cog, "backups", "other.json")) == ["There are no backups of other.json."]
+
+        restored = GameCog(cog.bot)
+        restored.save_dir = cog.save_dir
+        await invoke(restored, "load", "20200101")
+        assert as_json(restored) == old
+        assert restored.campaign == "camp.json"
+        await invoke(restored, "load", backup.split(".")[2][:12])  # to the minute
+        assert as_json(restored) == as_json(cog)
+        with pytest.raises(InvalidArgument):
+            await invoke(restored, "load", "2019")
+
+    asyncio.run(run())
+
+
+def test_iter_campaign_json(campaign):
+    saved = as_json(campaign)
+    expected = [(("characters", p), c) for p, c in saved["characters"].items()] + [(("world",), saved["world"])]
+    for indent in (None, 2):
+        data = json.dumps(saved, indent=indent, ensure_ascii=False).encode()
+        for chunk_size in (1, 7, 4096):  # values split across any number of reads
+            assert list(iter_campaign_json(io.BytesIO(data), chunk_size)) == expected
+
+    legacy = json.dumps(saved["characters"]).encode()  # saved before there was a world
+    assert list(iter_campaign_json(io.BytesIO(legacy))) == expected[:-1]
+    assert list(iter_campaign_json(io.BytesIO(b"{}"))) == []
+
+
+def test_snapshot(tmp_path, campaign):
+    records = campaign_records(campaign.characters, campaign.world)
+    saved = json.loads(snapshot_json(records))
+
+    path = tmp_path / "characters.json.20200101000000.snap"
+    path.write_bytes(snapshot_bytes(records))
+    assert read_snapshot(str(path)) == saved
+
+    json_path = tmp_path / "characters.json"
+    json_path.write_text(snapshot_json(records))
+    assert read_snapshot(convert_to_snapshot(str(json_path))) == saved
+    assert (tmp_path / "characters.json.snap").stat().st_size < json_path.stat().st_size
+
+
+def test_backup_store(tmp_path, monkeypatch, campaign):
+    g = campaign
+    backups = BackupStore(str(tmp_path))
+    first = campaign_records(g.characters, g.world)
+    assert backups.write("characters.json.20200101000000", first) == len(first)
+    g.characters["slithy#1234"].levelUp()
+    second = campaign_records(g.characters, g.world)
+    assert backups.write("characters.json.20200102000000", second) == 1  # only the changed character is new
+    assert backups.write("other.json.20200102120000", second) == 0
+
+    assert backups.read("characters.json.20200101000000") == first
+    assert backups.find("20200102") == ["other.json.20200102120000", "characters.json.20200102000000"]
+    assert backups.find("2019") == []
+
+    monkeypatch.setattr(persistence, "CHUNK_GC_GRACE", -1)
+    os.remove(tmp_path / "backups" / "characters.json.20200101000000")
+    assert backups.gc() == 1  # the old version of slithy
+    assert backups.read("characters.json.20200102000000") == second
@@ -0,0 +1,165 @@
+import asyncio
+import sys, os
+
+import pytest
+
+rootpath = os.path.realpath(os.path.dirname(__file__) + "/..")
+if rootpath not in sys.path:
+    sys.path.append(rootpath)
+
+pytest.importorskip("credentials")  # utils.config reads the bot's credentials
+from pymongo import UpdateOne
+from pymongo.errors import ConnectionFailure, OperationFailure
+
+from cogsmisc.stats import AnalyticsPipeline, Stats, StatsBuffer
+
+
+class FakeCollection:
+    def __init__(self):
+        self.writes = []  # the ops of each bulk_write
+        self.failures = []  # exceptions to raise from the next bulk_writes
+        self.blocker = None  # an Event bulk_write waits on, if set
+
+    async def bulk_write(self, ops, ordered=True):
+        assert not ordered
+        if self.blocker is not None:
+            await self.blocker.wait()
+        if self.failures:
+            raise self.failures.pop(0)
+        self.writes.append(ops)
+
+
+class FakeMdb(dict):
+    def __missing__(self, name):
+        self[name] = FakeCollection()
+        return self[name]
+
+
+def test_stats_buffer_merges():
+    async def run():
+        mdb = FakeMdb()
+        buffer = StatsBuffer(mdb, max_events=100)
+        for _ in range(3):
+            buffer.inc("random_stats", {"key": "dice_rolled_life"}, "value")
+        buffer.inc("analytics_user_activity", {"user_id": 1}, "commands_called", 2, "last_command_time")
+        buffer.inc("analytics_user_activity", {"user_id": 1}, "commands_called", 1, "last_command_time")
+        await buffer.flush()
+        assert mdb["random_stats"].writes == [[UpdateOne({"key": "dice_rolled_life"}, {"$inc": {"value": 3}}, upsert=True)]]
+        assert mdb["analytics_user_activity"].writes == [[UpdateOne(
+            {"user_id": 1},
+            {"$inc": {"commands_called": 3}, "$currentDate": {"last_command_time": True}},
+            upsert=True,
+        )]]
+        await buffer.flush()  # nothing pending, nothing written
+        assert len(mdb["random_stats"].writes) == 1
+
+    asyncio.run(run())
+
+
+def test_stats_buffer_flushes_early_and_on_close():
+    async def run():
+        mdb = FakeMdb()
+        buffer = StatsBuffer(mdb, interval=60, max_events=2)
+        buffer.start()
+        buffer.inc("random_stats", {"key": "a"}, "value")
+        buffer.inc("random_stats", {"key": "a"}, "value")
+        await asyncio.sleep(0)
+        assert len(mdb["random_stats"].writes) == 1  # max_events reached, long before the interval
+        buffer.inc("random_stats", {"key": "b"}, "value")
+        await buffer.close()
+        assert len(mdb["random_stats"].writes) == 2
+
+    asyncio.run(run())
+
+
+def test_stats_buffer_requeues():
+    async def run():
+        mdb = FakeMdb()
+        buffer = StatsBuffer(mdb)
+        mdb["random_stats"].failures = [ConnectionFailure("down"), OperationFailure("bad update")]
+        buffer.inc("random_stats", {"key": "a"}, "value", 2)
+        await buffer.flush()  # the connection failed: the deltas are kept
+        assert mdb["random_stats"].writes == []
+        buffer.inc("random_stats", {"key": "a"}, "value")
+        await buffer.flush()  # any other error drops them
+        assert mdb["random_stats"].writes == [] and buffer.pending == {}
+
+        mdb["random_stats"].failures = [ConnectionFailure("down")]
+        buffer.inc("random_stats", {"key": "a"}, "value", 2)
+        await buffer.flush()
+        buffer.inc("random_stats", {"key": "a"}, "value")
+        await buffer.flush()
+        assert mdb["random_stats"].writes == [[UpdateOne({"key": "a"}, {"$inc": {"value": 3}}, upsert=True)]]
+
+    asyncio.run(run())
+
+
+def test_stats_buffer_bounded():
+    async def run():
+        mdb = FakeMdb()
+        buffer = StatsBuffer(mdb, max_pending=2)
+        for key in ("a", "b", "c", "a"):
+            buffer.inc("random_stats", {"key": key}, "value")
+        assert len(buffer.pending) == 2 and buffer.dropped == 1  # c, but a still merges
+
+        # new documents fill the buffer while mongo is down: the failed updates don't grow it
+        mdb["random_stats"].failures = [ConnectionFailure("down")]
+        mdb["random_stats"].blocker = asyncio.Event()
+        flush = asyncio.ensure_future(buffer.flush())
+        await asyncio.sleep(0)
+        buffer.inc("random_stats", {"key": "a"}, "value")
+        buffer.inc("random_stats", {"key": "d"}, "value")
+        mdb["random_stats"].blocker.set()
+        await flush
+        assert buffer.dropped == 2  # b
+        assert {key[1] for key in buffer.pending} == {(("key", "a"),), (("key", "d"),)}
+        assert buffer.pending[("random_stats", (("key", "a"),))][0]["value"] == 3
+
+    asyncio.run(run())
+
+
+def test_stats_buffer_logs_early_flush_failures(caplog):
+    async def run():
+        mdb = FakeMdb()
+        buffer = StatsBuffer(mdb, max_events=1)
+        mdb["random_stats"].failures = [RuntimeError("broken")]
+        buffer.inc("random_stats", {"key": "a"}, "value")
+        await buffer.close()
+        assert "Failed to flush stat updates" in caplog.text
+
+    asyncio.run(run())
+
+
+def test_analytics_pipeline():
+    async def run():
+        mdb = FakeMdb()
+        buffer = StatsBuffer(mdb, max_events=100)
+        analytics = AnalyticsPipeline(buffer, maxsize=2)
+        for key in ("a", "b", "c"):
+            analytics.submit(("random_stats", {"key": key}, "value"))
+        metrics = analytics.metrics()
+        assert metrics["depth"] == 2 and metrics["capacity"] == 2
+        assert metrics["dropped"] == 1 and metrics["processed"] == 0  # the queue was full for c
+
+        analytics.start()
+        await asyncio.sleep(0)
+        metrics = analytics.metrics()
+        assert metrics["depth"] == 0 and metrics["processed"] == 2
+        assert 0 <= metrics["lag"] <= metrics["max_lag"]
+
+        analytics.submit(("random_stats", {"key": "a"}, "value"), ("random_stats", {"key": "d"}, "value", 5))
+        await analytics.close()  # hands the queued event to the buffer
+        await buffer.flush()
+        assert sorted(op._filter["key"] for op in mdb["random_stats"].writes[0]) == ["a", "b", "d"]
+
+        class FakeCtx:
+            sent = []
+
+            async def send(self, content):
+                self.sent.append(content)
+
+        cog = type("FakeStats", (), {"bot": type("FakeBot", (), {"analytics": analytics})()})()
+        await Stats.analyticsstats.callback(cog, FakeCtx())
+        assert "queue depth: 0/2\nprocessed: 3\ndropped: 1\n" in FakeCtx.sent[0]
+
+    asyncio.run(run())
@@ -1,3 +1,6 @@
+import asyncio
+import json
+import logging
 import sys, os
 
 rootpath = os.path.realpath(os.path.dirname(__file__) + "/..")
@@ -5,6 +8,17 @@ if rootpath not in sys.path:
     sys.path.append(rootpath)
 
 from cogscc.funcs import utils
+from utils.aliases import AliasCache
+from utils.cache import LRUCache
+from utils.redisIO import (
+    PubSubCommand,
+    PubSubPublisher,
+    PubSubReply,
+    RedisIO,
+    deserialize_ps_frame,
+    get_ps_codec,
+    new_ps_id,
+)
 
 
 def test_d2std_time():
@@ -28,3 +42,245 @@ def test_split_long_message():
     print()
     for i in out:
         print(i.count("\n"))
+
+
+def test_lru_cache():
+    cache = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1  # a is now the most recently used
+    cache.set("c", 3)
+    assert "b" not in cache and len(cache) == 2
+    assert cache.pop("a") == 1 and cache.get("a", "missing") == "missing"
+
+    cache = LRUCache(ttl=0)
+    cache.set("a", 1)
+    assert cache.get("a") is None
+    cache.set("b", 2, ttl=None)
+    assert cache.get("b") == 2
+
+
+class FakePipeline:
+    """Stands in for an aioredis pipeline: commands are answered from a dict when executed."""
+
+    def __init__(self, data):
+        self.data = data
+        self.queued = []
+        self.executions = 0
+
+    def __getattr__(self, command):
+        def queue(key, *args, encoding=None):
+            future = asyncio.get_event_loop().create_future()
+            self.queued.append((future, command, key, args, encoding))
+            return future
+
+        return queue
+
+    async def execute(self, return_exceptions=False):
+        self.executions += 1
+        for future, command, key, args, encoding in self.queued:
+            if command == "get":
+                future.set_result(self.data.get(key))
+            elif command == "hget":
+                value = self.data.get(key, {}).get(args[0])
+                future.set_result(value.decode(encoding) if value is not None and encoding else value)
+            elif command == "hlen":
+                future.set_result(len(self.data.get(key, {})))
+            elif command == "set":
+                self.data[key] = args[0].encode()
+                future.set_result(True)
+            else:
+                future.set_exception(ValueError(command))
+
+
+def test_redis_pipeline():
+    async def run():
+        pipe = FakePipeline({"muted": json.dumps([1, 2]).encode(), "hash": {"a": b"[0, 4]"}})
+        rdb = RedisIO(type("FakeRedis", (), {"pipeline": lambda self: pipe})())
+        async with rdb.pipeline() as p:
+            muted = p.jget("muted", [])
+            missing = p.jget("blacklist", [])
+            shards = p.jhget("hash", "a")
+            length = p.hlen("hash")
+            bad = p.incr("counter")
+        assert pipe.executions == 1
+        assert muted.result() == [1, 2] and missing.result() == []
+        assert shards.result() == [0, 4] and length.result() == 1
+        assert isinstance(bad.exception(), ValueError)
+
+    asyncio.run(run())
+
+
+def test_redis_cache():
+    class FakeRedis:
+        data = {"build_num": b"41"}
+        reads = 0
+
+        async def get(self, key):
+            self.reads += 1
+            return self.data.get(key)
+
+        async def incr(self, key):
+            self.data[key] = str(int(self.data[key]) + 1).encode()
+
+    async def run():
+        db = FakeRedis()
+        rdb = RedisIO(db)
+        assert await rdb.cached_get("build_num", 60) == "41"
+        assert await rdb.cached_get("build_num", 60) == "41"
+        assert db.reads == 1
+        await rdb.incr("build_num")  # writes drop the cached value
+        assert await rdb.cached_get("build_num", 60) == "42"
+        assert await rdb.cached_get("missing", 0, "default") == "default"  # ttl=0 is never served from cache
+        await rdb.cached_get("missing", 0)
+        assert db.reads == 4
+        assert rdb.cache_stats() == {"build_num": (1, 2), "missing": (0, 2)}
+
+    asyncio.run(run())
+
+
+def test_redis_pipeline_invalidates():
+    class FakeRedis:
+        def __init__(self, data):
+            self.data = data
+
+        def pipeline(self):
+            return FakePipeline(self.data)
+
+        async def get(self, key):
+            return self.data.get(key)
+
+    async def run():
+        rdb = RedisIO(FakeRedis({"muted": b"[1]"}))
+        assert await rdb.cached_jget("muted", 60) == [1]
+        async with rdb.pipeline() as p:
+            p.jset("muted", [1, 2])
+        assert await rdb.cached_jget("muted", 60) == [1, 2]  # not the cached [1]
+        assert rdb.cache_stats() == {"muted": (0, 2)}
+
+    asyncio.run(run())
+
+
+def test_ps_ids():
+    bot = type("FakeBot", (), {"cluster_id": 3})()
+    ids = [new_ps_id(bot) for _ in range(3)]
+    assert all(isinstance(i, int) and i >> 40 == 3 for i in ids)
+    assert len(set(ids)) == 3
+
+
+def test_ps_codecs():
+    bot = type("FakeBot", (), {"cluster_id": 1})()
+    command = PubSubCommand.new(bot, "invalidate_rdb", ["build_num"], {})
+    reply = PubSubReply.new(bot, command.id, {"guilds": 12})
+    for name in ("json", "msgpack"):
+        codec = get_ps_codec(name)
+        for messages in ([command], [command, reply]):
+            frame = codec.encode([m.to_dict() for m in messages])
+            decoded = deserialize_ps_frame(frame, codec)
+            assert [type(m) for m in decoded] == [type(m) for m in messages]
+            assert [m.to_dict() for m in decoded] == [m.to_dict() for m in messages]
+    assert json.loads(get_ps_codec("json").encode([command.to_dict()]))["id"] == command.id  # a bare object
+
+
+class FakePublishRedis:
+    def __init__(self, fail=False):
+        self.published = []
+        self.fail = fail
+
+    async def publish(self, channel, data):
+        if self.fail:
+            raise ConnectionError("redis is down")
+        self.published.append((channel, data))
+
+
+def test_pubsub_publisher():
+    bot = type("FakeBot", (), {"cluster_id": 0})()
+    codec = get_ps_codec("json")
+
+    async def run():
+        rdb = FakePublishRedis()
+        publisher = PubSubPublisher(rdb, "chan", codec, delay=0.01, max_batch=3)
+        await publisher.publish(PubSubReply.new(bot, 1, "now"))
+        assert len(rdb.published) == 1  # not batched
+
+        for i in range(2):
+            await publisher.publish(PubSubReply.new(bot, i, "later"), batch=True)
+        assert len(rdb.published) == 1
+        await asyncio.sleep(0.05)
+        assert len(rdb.published) == 2
+        assert [m.reply_to for m in deserialize_ps_frame(rdb.published[1][1], codec)] == [0, 1]
+
+        for i in range(3):  # a full batch is sent at once
+            await publisher.publish(PubSubReply.new(bot, i, "full"), batch=True)
+        assert len(rdb.published) == 3
+        await publisher.flush()
+        assert len(rdb.published) == 3  # nothing left to send
+
+    asyncio.run(run())
+
+
+def test_pubsub_publisher_failure(caplog):
+    bot = type("FakeBot", (), {"cluster_id": 0})()
+
+    async def run():
+        publisher = PubSubPublisher(FakePublishRedis(fail=True), "chan", get_ps_codec("json"), delay=0.01)
+        await publisher.publish(PubSubReply.new(bot, 1, "lost"), batch=True)
+        await asyncio.sleep(0.05)
+
+    with caplog.at_level(logging.ERROR, logger="rdb.pubsub"):
+        asyncio.run(run())
+    assert "Failed to publish 1 batched messages on chan" in caplog.text
+
+
+class FakeAliasCollection:
+    def __init__(self, field, docs):
+        self.field = field
+        self.docs = docs
+        self.finds = 0
+
+    def find(self, query, projection):
+        self.finds += 1
+
+        async def results():
+            for doc in self.docs:
+                if doc[self.field] == query[self.field]:
+                    yield {k: doc[k] for k in projection}
+
+        return results()
+
+
+def test_alias_cache():
+    mdb = {
+        "aliases": FakeAliasCollection("owner", [
+            {"owner": "1", "name": "fb", "commands": "cast fireball"},
+            {"owner": "1", "name": "atk", "commands": "attack sword"},
+        ]),
+        "servaliases": FakeAliasCollection("server", [
+            {"server": "9", "name": "atk", "commands": "attack axe"},
+            {"server": "9", "name": "heal", "commands": "cast cure"},
+        ]),
+    }
+    cache = AliasCache(mdb, reserved={"roll": None})
+
+    async def run():
+        assert await cache.get("atk", "1", "9") == "attack sword"  # the user's alias wins
+        assert await cache.get("heal", "1", "9") == "cast cure"
+        assert await cache.get("fb", "1") == "cast fireball"
+        assert await cache.get("nope", "1", "9") is None
+        assert await cache.get("heal", "2", "9") == "cast cure"  # a user with no aliases
+        assert await cache.get("atk", "2", "9") == "attack axe"
+        assert mdb["aliases"].finds == 2 and mdb["servaliases"].finds == 1  # one find per index
+
+        assert await cache.get("roll", "3", "8") is None  # a built-in command: no lookups at all
+        assert mdb["aliases"].finds == 2 and mdb["servaliases"].finds == 1
+
+        mdb["aliases"].docs[0]["commands"] = "cast fireball 5"
+        assert await cache.get("fb", "1") == "cast fireball"
+        cache.invalidate(owner="1")
+        assert await cache.get("fb", "1") == "cast fireball 5"
+        assert mdb["aliases"].finds == 3 and mdb["servaliases"].finds == 1
+        cache.invalidate(server="9")
+        await cache.get("heal", "1", "9")
+        assert mdb["servaliases"].finds == 2
+
+    asyncio.run(run())
@@ -28,6 +28,9 @@ class BaseCharacter:
     def siegeCheck(self, stat: str, bonus: int, cl: int):
         return self.stats.siegeCheck(self.getName(), self.getLevel(), stat, bonus, cl)
 
+    def siegeOdds(self, stat: str, bonus: int, cl: int):
+        return self.stats.siegeOdds(self.getLevel(), stat, bonus, cl)
+
     # Combat
 
     def rollForInitiative(self):
@@ -4,16 +4,102 @@ import re
 import discord
 from discord.ext import commands
 
-from cogscc.funcs.dice import roll
+from cogscc.funcs.dice import estimate_cost, odds, roll, roll_many
+from cogscc.funcs.rollpool import RollPool
 from cogsmisc.stats import Stats
 from utils.functions import try_delete
 
+MAX_ITERATIONS = 10000
+ODDS_PERCENTILES = (5, 25, 50, 75, 95)
+INLINE_COST = 1000  # rolls estimated to cost more dice than this go to the RollPool
+
+
+def join_skeletons(header, results, limit=1500):
+    """Appends one skeleton line per result to header, rendering only as many
+    results as fit.
+    Returns: The joined string, or None if it would be limit characters or longer."""
+    lines = []
+    length = len(header) - 1
+    for res in results:
+        length += len(res.skeleton) + 1
+        if length >= limit:
+            return None
+        lines.append(res.skeleton)
+    return header + "\n".join(lines)
+
+
+def roll_message(mention, rollStr, adv):
+    res = roll(rollStr, adv=adv)
+    outStr = mention + "  :game_die:\n" + res.result
+    if len(outStr) > 1999:
+        return (
+            mention
+            + "  :game_die:\n[Output truncated due to length]\n**Result:** "
+            + str(res.plain)
+        )
+    return outStr
+
+
+def multiroll_message(iterations, rollStr, adv, args):
+    out = roll_many(rollStr, iterations, adv=adv, rollFor=args, inline=True)
+    outStr = join_skeletons("Rolling {} iterations...\n".format(iterations), out)
+    if outStr is not None:
+        outStr += "\n{} total.".format(out.total)
+    else:
+        outStr = (
+            "Rolling {} iterations...\n[Output truncated due to length]\n".format(
+                iterations
+            )
+            + "{} total.".format(out.total)
+        )
+    return outStr
+
+
+def iterroll_message(iterations, rollStr, dc, adv, args):
+    out = roll_many(rollStr, iterations, adv=adv, rollFor=args, inline=True)
+    successes = int((out.totals >= dc).sum())
+    header = "Rolling {} iterations, DC {}...\n".format(iterations, dc)
+    outStr = join_skeletons(header, out)
+    if outStr is not None:
+        outStr += "\n{} successes.".format(str(successes))
+    else:
+        outStr = "Rolling {} iterations, DC {}...\n[Output truncated due to length]\n".format(
+            iterations, dc
+        ) + "{} successes.".format(
+            str(successes)
+        )
+    return outStr
+
+
+def odds_message(rollStr, dc, adv):
+    dist = odds(rollStr, adv=adv)
+    percentiles = ", ".join(
+        "{}%: {:g}".format(q, dist.percentile(q)) for q in ODDS_PERCENTILES
+    )
+    outStr = "**Odds for {}:**\nMean: {:.2f}, standard deviation: {:.2f}\n{}".format(
+        rollStr, dist.mean(), dist.std(), percentiles
+    )
+    if dc is not None:
+        outStr += "\nChance of {} or more: {:.2%}".format(dc, dist.at_least(dc))
+    return outStr
+
 
 class Dice(commands.Cog):
     """Dice and math related commands."""
 
     def __init__(self, bot):
         self.bot = bot
+        self.pool = RollPool()
+
+    def cog_unload(self):
+        self.pool.shutdown()
+
+    async def run_roll(self, ctx, cost, func, *args):
+        """Runs func(*args) inline if the roll is cheap, otherwise on the RollPool
+        so it doesn't hold up the event loop."""
+        if cost <= INLINE_COST:
+            return func(*args)
+        return await self.pool.run(ctx.author.id, func, *args)
 
     @commands.command(name="2", hidden=True)
     async def quick_roll(self, ctx, *, mod: str = "0"):
@@ -54,45 +140,37 @@ class Dice(commands.Cog):
         if re.search("(^|\s+)(adv|dis)(\s+|$)", rollStr) is not None:
             adv = 1 if re.search("(^|\s+)adv(\s+|$)", rollStr) is not None else -1
             rollStr = re.sub("(adv|dis)(\s+|$)", "", rollStr)
-        res = roll(rollStr, adv=adv)
-        out = res.result
+        outStr = await self.run_roll(
+            ctx,
+            estimate_cost(rollStr, adv=adv),
+            roll_message,
+            ctx.author.mention,
+            rollStr,
+            adv,
+        )
         await try_delete(ctx.message)
-        outStr = ctx.author.mention + "  :game_die:\n" + out
-        if len(outStr) > 1999:
-            await ctx.send(
-                ctx.author.mention
-                + "  :game_die:\n[Output truncated due to length]\n**Result:** "
-                + str(res.plain)
-            )
-        else:
-            await ctx.send(outStr)
+        await ctx.send(outStr)
         await Stats.increase_stat(ctx, "dice_rolled_life")
 
     @commands.command(name="multiroll", aliases=["rr"])
     async def rr(self, ctx, iterations: int, rollStr, *, args=""):
         """Rolls dice in xdy format a given number of times.
         Usage: !rr <iterations> <xdy> [args]"""
-        if iterations < 1 or iterations > 100:
+        if iterations < 1 or iterations > MAX_ITERATIONS:
             return await ctx.send("Too many or too few iterations.")
         adv = 0
-        out = []
         if re.search("(^|\s+)(adv|dis)(\s+|$)", args) is not None:
             adv = 1 if re.search("(^|\s+)adv(\s+|$)", args) is not None else -1
             args = re.sub("(adv|dis)(\s+|$)", "", args)
-        for _ in range(iterations):
-            res = roll(rollStr, adv=adv, rollFor=args, inline=True)
-            out.append(res)
-        outStr = "Rolling {} iterations...\n".format(iterations)
-        outStr += "\n".join([o.skeleton for o in out])
-        if len(outStr) < 1500:
-            outStr += "\n{} total.".format(sum(o.total for o in out))
-        else:
-            outStr = (
-                "Rolling {} iterations...\n[Output truncated due to length]\n".format(
-                    iterations
-                )
-                + "{} total.".format(sum(o.total for o in out))
-            )
+        outStr = await self.run_roll(
+            ctx,
+            estimate_cost(rollStr, iterations, adv),
+            multiroll_message,
+            iterations,
+            rollStr,
+            adv,
+            args,
+        )
         await try_delete(ctx.message)
         await ctx.send(ctx.author.mention + "\n" + outStr)
         await Stats.increase_stat(ctx, "dice_rolled_life")
@@ -101,33 +179,39 @@ class Dice(commands.Cog):
     async def rrr(self, ctx, iterations: int, rollStr, dc: int = 0, *, args=""):
         """Rolls dice in xdy format, given a set dc.
         Usage: !rrr <iterations> <xdy> <DC> [args]"""
-        if iterations < 1 or iterations > 100:
+        if iterations < 1 or iterations > MAX_ITERATIONS:
             return await ctx.send("Too many or too few iterations.")
         adv = 0
-        out = []
-        successes = 0
         if re.search("(^|\s+)(adv|dis)(\s+|$)", args) is not None:
             adv = 1 if re.search("(^|\s+)adv(\s+|$)", args) is not None else -1
             args = re.sub("(adv|dis)(\s+|$)", "", args)
-        for r in range(iterations):
-            res = roll(rollStr, adv=adv, rollFor=args, inline=True)
-            if res.plain >= dc:
-                successes += 1
-            out.append(res)
-        outStr = "Rolling {} iterations, DC {}...\n".format(iterations, dc)
-        outStr += "\n".join([o.skeleton for o in out])
-        if len(outStr) < 1500:
-            outStr += "\n{} successes.".format(str(successes))
-        else:
-            outStr = "Rolling {} iterations, DC {}...\n[Output truncated due to length]\n".format(
-                iterations, dc
-            ) + "{} successes.".format(
-                str(successes)
-            )
+        outStr = await self.run_roll(
+            ctx,
+            estimate_cost(rollStr, iterations, adv),
+            iterroll_message,
+            iterations,
+            rollStr,
+            dc,
+            adv,
+            args,
+        )
         await try_delete(ctx.message)
         await ctx.send(ctx.author.mention + "\n" + outStr)
         await Stats.increase_stat(ctx, "dice_rolled_life")
 
+    @commands.command(name="odds")
+    async def oddsCmd(self, ctx, rollStr, *, args=""):
+        """Works out the exact odds of a roll without rolling it.
+        Usage: !odds <xdy> [DC] [adv/dis]"""
+        adv = 0
+        if re.search("(^|\s+)(adv|dis)(\s+|$)", args) is not None:
+            adv = 1 if re.search("(^|\s+)adv(\s+|$)", args) is not None else -1
+        dc = re.search("(^|\s+)(-?\d+)(\s+|$)", args)
+        dc = int(dc.group(2)) if dc is not None else None
+        # exact odds can take a while for big rolls, so always use the pool
+        outStr = await self.pool.run(ctx.author.id, odds_message, rollStr, dc, adv)
+        await ctx.send(ctx.author.mention + "\n" + outStr)
+
 
 def setup(bot):
     bot.add_cog(Dice(bot))
@@ -5,13 +5,19 @@ Created on Dec 25, 2016
 """
 
 import logging
+import os
 import random
 import re
+import threading
+from array import array
+from collections import Counter, namedtuple
+from functools import lru_cache
 from heapq import nlargest, nsmallest
-from math import floor
+from itertools import compress
+from math import comb, floor
 from re import IGNORECASE
 
-import numexpr
+import numpy
 
 from cogscc.models import errors
 
@@ -28,7 +34,46 @@ DICE_PATTERN = re.compile(
     + r")(?:[lh<>]?\d+))*|(\d+)|([-+*/().=])?)\s*(\[.*\])?)(.*?)\s*$",
     IGNORECASE,
 )
-MAX_REROLLS = 1000
+# NdM, NdMkhX or NdMklX, optionally plus or minus a constant: rolled by Roll.roll_fast()
+FAST_ROLL_PATTERN = re.compile(r"^(\d*)d(\d+)(?:k([hl])(\d+))?(?:([-+])(\d+))?$")
+MAX_REROLLS = 1000  # dice the reroll operators may check in one roll
+PLAN_CACHE_SIZE = 1024
+MAX_BATCH_CELLS = 1 << 21  # dice held in memory at once by roll_many()
+MAX_BATCH_VALUES = 1 << 12  # widest range of die values roll_many() selects on
+MAX_ODDS_WORK = 1 << 32  # rough bound, in multiply-adds, on the work one odds() call may do
+MAX_ODDS_WIDTH = 1 << 22  # widest range of integers odds() holds a dense distribution over
+ODDS_OUTER_COST = 256  # multiply-adds a pair of values in an outer product (for * and /) counts as
+ODDS_KEEP_COST = 128  # multiply-adds a step of the keep highest/lowest order statistics counts as
+EXPLODE_DEPTH = 20  # explosions followed per die by odds()
+REROLL_COST = 4  # dice a rerolling or exploding die is assumed to cost estimate_cost()
+
+# A compiled roll string is a tuple of these, in the order they appear in the string.
+DicePlan = namedtuple("DicePlan", "num_dice dice_size operators annotation allows_adv")
+ConstantPlan = namedtuple("ConstantPlan", "value annotation")
+OperatorPlan = namedtuple("OperatorPlan", "op annotation")
+CommentPlan = namedtuple("CommentPlan", "comment")
+
+
+class WorkBudget:
+    """Bounds the work done by the reroll operators (rr, ro, ra, e) in one roll.
+    A single operation stops after checking per_operation dice; once the roll has
+    checked more than limit dice in total, starting another operator fails.
+    `spent` may be a numpy array to track a batch of iterations at once."""
+
+    def __init__(self, limit=MAX_REROLLS, per_operation=MAX_REROLLS, spent=0):
+        self.limit = limit
+        self.per_operation = per_operation
+        self.spent = spent
+
+    def spend(self, checked):
+        self.spent += checked
+
+    def exhausted(self):
+        return self.spent > self.limit
+
+    def check(self):
+        if self.exhausted():
+            raise OverflowError("Tried to reroll too many dice.")
 
 
 def list_get(index, default, l):
@@ -39,6 +84,94 @@ def list_get(index, default, l):
     return a
 
 
+class DiceSource:
+    """Where the dice engine gets its random numbers from."""
+
+    def randint(self, size: int):
+        """Returns: int - a uniformly random number from 1 to size."""
+        raise NotImplementedError
+
+    def integers(self, size: int, shape):
+        """Returns: numpy array of int of the given shape, each a uniformly random
+        number from 1 to size."""
+        raise NotImplementedError
+
+
+class SystemDiceSource(DiceSource):
+    """Draws from the OS entropy pool, reading os.urandom in large blocks and
+    rejection sampling so every face is equally likely."""
+
+    def __init__(self, block_size: int = 4096):
+        self.block_size = block_size  # 32-bit words per read
+        self._words = []
+        self._lock = threading.Lock()
+        self._fallback = random.SystemRandom()
+
+    def randint(self, size: int):
+        if size >= 1 << 32:
+            return self._fallback.randint(1, size)
+        limit = (1 << 32) - (1 << 32) % size
+        with self._lock:
+            while True:
+                if not self._words:
+                    self._words = numpy.frombuffer(
+                        os.urandom(4 * self.block_size), dtype=numpy.uint32
+                    ).tolist()
+                word = self._words.pop()
+                if word < limit:
+                    return word % size + 1
+
+    def integers(self, size: int, shape):
+        if size >= 1 << 32:
+            return numpy.array(
+                [self._fallback.randint(1, size) for _ in range(numpy.prod(shape))],
+                dtype=numpy.int64,
+            ).reshape(shape)
+        limit = (1 << 32) - (1 << 32) % size
+        count = int(numpy.prod(shape))
+        out = numpy.empty(count, dtype=numpy.int64)
+        filled = 0
+        while filled < count:
+            wanted = count - filled
+            words = numpy.frombuffer(
+                os.urandom(4 * (wanted + wanted // 8 + 16)), dtype=numpy.uint32
+            )
+            words = words[words < limit][:wanted]
+            out[filled : filled + len(words)] = words % size + 1
+            filled += len(words)
+        return out.reshape(shape)
+
+
+class SeededDiceSource(DiceSource):
+    """A deterministic generator, for tests and replaying rolls."""
+
+    def __init__(self, seed: int):
+        self.seed = seed
+        self._random = random.Random(seed)
+        self._generator = numpy.random.default_rng(seed)
+        self._lock = threading.Lock()  # numpy generators aren't thread safe
+
+    def randint(self, size: int):
+        return self._random.randint(1, size)
+
+    def integers(self, size: int, shape):
+        with self._lock:
+            return self._generator.integers(1, size + 1, size=shape, dtype=numpy.int64)
+
+
+_dice_source = SystemDiceSource()
+
+
+def set_dice_source(source: DiceSource):
+    """Sets where every subsequent roll gets its random numbers from."""
+    global _dice_source
+    _dice_source = source
+
+
+def get_dice_source():
+    return _dice_source
+
+
 def roll(
     rollStr,
     adv: int = 0,
@@ -53,6 +186,157 @@ def roll(
     return result
 
 
+def estimate_cost(rollStr, iterations: int = 1, adv: int = 0):
+    """A rough estimate, in dice rolled, of the work rolling rollStr iterations
+    times takes. Dice in groups that reroll or explode count REROLL_COST times,
+    and such a group costs at least the MAX_REROLLS dice its WorkBudget lets it
+    check, as a chain like 1d1e1 does.
+    Roll strings that fail to compile cost 0, as they fail without rolling."""
+    try:
+        plan = compile_roll(rollStr)
+        cost = 0
+        for step in plan:
+            if isinstance(step, DicePlan):
+                num_dice, ops = apply_adv(step, adv)
+                if any(op in ("rr", "ro", "ra", "e") for op in ops):
+                    cost += max(num_dice * REROLL_COST, MAX_REROLLS)
+                else:
+                    cost += num_dice
+    except Exception:
+        return 0
+    return cost * iterations
+
+
+@lru_cache(maxsize=PLAN_CACHE_SIZE)
+def compile_roll(rollStr):
+    """Parses a roll string once into an immutable plan.
+    Returns: A tuple of DicePlan, ConstantPlan, OperatorPlan and CommentPlan."""
+    if "**" in rollStr:
+        raise errors.InvalidArgument("Exponents are currently disabled.")
+    plan = []
+    # split roll string into XdYoptsSel [comment] or Op
+    # set remainder to comment
+    dice_set = re.split("([-+*/().=])", rollStr)
+    dice_set = [d for d in dice_set if not d in (None, "")]
+    log.debug("Found dice set: " + str(dice_set))
+    for index, dice in enumerate(dice_set):
+        match = DICE_PATTERN.match(dice)
+        log.debug("Found dice group: " + str(match.groups()))
+        # check if it's dice
+        if match.group(1):
+            plan.append(compile_dice(dice.replace(match.group(5), "")))
+        # or a constant
+        elif match.group(2):
+            plan.append(ConstantPlan(int(match.group(2)), match.group(4) or ""))
+        # or an operator
+        elif not match.group(5):
+            plan.append(OperatorPlan(match.group(3) or "", match.group(4) or ""))
+
+        if match.group(5):
+            plan.append(CommentPlan(match.group(5) + "".join(dice_set[index + 1 :])))
+            break
+    return tuple(plan)
+
+
+def compile_dice(dice):
+    """Parses one XdYoptsSel [annotation] group.
+    Returns: A DicePlan."""
+    # splits dice and annotation
+    split = re.match(r"^([^\[\]]*?)\s*(\[.*\])?\s*$", dice)
+    dice = split.group(1).strip()
+    annotation = split.group(2)
+
+    # Recognizes dice
+    obj = re.findall(r"\d+", dice)
+    obj = [int(x) for x in obj]
+    numArgs = len(obj)
+
+    # prepare dice and operators
+    ops = []
+    if numArgs == 1:
+        if not dice.startswith("d"):
+            raise errors.InvalidArgument("Please pass in the value of the dice.")
+        numDice = 1
+        dice_size = obj[0]
+    elif numArgs == 2:
+        numDice = obj[0]
+        dice_size = obj[-1]
+    else:  # split into xdy and operators
+        numDice = obj[0]
+        dice_size = obj[1]
+        dice = re.split(r"(\d+d\d+)", dice)[-1]
+        ops = VALID_OPERATORS_2.split(dice)
+        ops = [a for a in ops if a is not None]
+
+    return DicePlan(
+        num_dice=numDice,
+        dice_size=dice_size,
+        operators=tuple(ops),
+        annotation=annotation or "",
+        allows_adv=numArgs < 3,
+    )
+
+
+def apply_adv(plan, adv: int = 0):
+    """Applies advantage/disadvantage to a straight d20 DicePlan and checks limits.
+    Returns: A two-tuple (number of dice, list of operators)"""
+    numDice = plan.num_dice
+    ops = list(plan.operators)
+    if adv != 0 and plan.dice_size == 20 and plan.allows_adv:
+        ops = ["k", "h" + str(numDice)] if adv == 1 else ["k", "l" + str(numDice)]
+        numDice = numDice * 2
+
+    # ensure limits
+    if numDice > 300 or plan.dice_size < 1:
+        raise errors.InvalidArgument("Too many dice rolled.")
+    return numDice, ops
+
+
+def roll_many(
+    rollStr,
+    iterations: int,
+    adv: int = 0,
+    rollFor="",
+    inline=True,
+    show_blurbs=True,
+):
+    """Rolls the same roll string a number of times, drawing every iteration's dice
+    as one batch.
+    Returns: MultiDiceResult"""
+    try:
+        plan = compile_roll(rollStr)
+        batches = []
+        row_cells = sum(p.num_dice * 2 + 1 for p in plan if isinstance(p, DicePlan))
+        chunk = max(1, MAX_BATCH_CELLS // max(1, row_cells))
+        for start in range(0, iterations, chunk):
+            batch = BatchRoll(min(chunk, iterations - start))
+            batch.run(plan, adv)
+            batches.append(batch)
+    except _BatchUnsupported:
+        # fall back to rolling each iteration on its own
+        results = [
+            roll(rollStr, adv, rollFor, inline, show_blurbs=show_blurbs)
+            for _ in range(iterations)
+        ]
+        return MultiDiceResult(
+            numpy.array([r.total for r in results], dtype=numpy.int64),
+            results.__getitem__,
+        )
+    except Exception as ex:
+        invalid = DiceResult(verbose_result="Invalid input: {}".format(ex))
+        return MultiDiceResult(
+            numpy.zeros(iterations, dtype=numpy.int64), lambda index: invalid
+        )
+
+    def render(index):
+        for batch in batches:
+            if index < batch.iterations:
+                return batch.get_result(index, adv, rollFor, inline, show_blurbs)
+            index -= batch.iterations
+
+    return MultiDiceResult(numpy.concatenate([b.totals for b in batches]), render)
+
+
 def get_roll_comment(rollStr):
     """Returns: A two-tuple (dice without comment, comment)"""
     try:
@@ -80,7 +364,19 @@ class Roll(object):
         if parts is None:
             parts = []
         self.parts = parts
-        self._rerolls = 0
+        self.budget = WorkBudget()
+
+    @property
+    def parts(self):
+        if self._replay is not None:
+            replay, self._replay = self._replay, None
+            self._parts = replay()
+        return self._parts
+
+    @parts.setter
+    def parts(self, parts):
+        self._parts = parts
+        self._replay = None  # builds parts on first access after roll_fast()
 
     def get_crit(self):
         """Returns: 0 for no crit, 1 for 20, 2 for 1."""
@@ -93,10 +389,8 @@ class Roll(object):
         return crit
 
     def get_total(self):
-        """Returns: int"""
-        return numexpr.evaluate(
-            "".join(p.get_eval() for p in self.parts if not isinstance(p, Comment))
-        )
+        """Returns: int or float"""
+        return evaluate(self.parts)
 
     # # Dice Roller
     def roll(
@@ -110,185 +404,152 @@ class Roll(object):
         **kwargs,
     ):
         try:
-            if "**" in rollStr:
-                raise errors.InvalidArgument("Exponents are currently disabled.")
-            self.parts = []
-            # split roll string into XdYoptsSel [comment] or Op
-            # set remainder to comment
-            # parse each, returning a SingleDiceResult
-            dice_set = re.split("([-+*/().=])", rollStr)
-            dice_set = [d for d in dice_set if not d in (None, "")]
-            log.debug("Found dice set: " + str(dice_set))
-            for index, dice in enumerate(dice_set):
-                match = DICE_PATTERN.match(dice)
-                log.debug("Found dice group: " + str(match.groups()))
-                # check if it's dice
-                if match.group(1):
-                    roll = self.roll_one(dice.replace(match.group(5), ""), adv)
-                    self.parts.append(roll)
-                # or a constant
-                elif match.group(2):
-                    self.parts.append(
-                        Constant(value=int(match.group(2)), annotation=match.group(4))
-                    )
-                # or an operator
-                elif not match.group(5):
-                    self.parts.append(
-                        Operator(op=match.group(3), annotation=match.group(4))
-                    )
-
-                if match.group(5):
-                    self.parts.append(
-                        Comment(match.group(5) + "".join(dice_set[index + 1 :]))
-                    )
-                    break
-
-            # calculate total
-            crit = self.get_crit()
-            try:
-                total = self.get_total()
-            except SyntaxError:
-                raise errors.InvalidArgument("No dice found to roll.")
-            rolled = " ".join(
-                str(res) for res in self.parts if not isinstance(res, Comment)
-            )
-            if rollFor == "":
-                rollFor = "".join(str(c) for c in self.parts if isinstance(c, Comment))
-            # return final solution
-            if not inline:
-                # Builds end result while showing rolls
-                reply = (
-                    " ".join(
-                        str(res) for res in self.parts if not isinstance(res, Comment)
-                    )
-                    + "\n**Total:** "
-                    + str(floor(total))
-                )
-                skeletonReply = reply
-                rollFor = rollFor if rollFor != "" else "Result"
-                reply = "**{}:** ".format(rollFor) + reply
-                if show_blurbs:
-                    if adv == 1:
-                        reply += "\n**Rolled with Advantage**"
-                    elif adv == -1:
-                        reply += "\n**Rolled with Disadvantage**"
-                    if crit == 1:
-                        critStr = "\n_**Critical Hit!**_  "
-                        reply += critStr
-                    elif crit == 2:
-                        critStr = "\n_**Critical Fail!**_  "
-                        reply += critStr
-            else:
-                # Builds end result while showing rolls
-                reply = (
-                    " ".join(
-                        str(res) for res in self.parts if not isinstance(res, Comment)
-                    )
-                    + " = `"
-                    + str(floor(total))
-                    + "`"
-                )
-                skeletonReply = reply
-                rollFor = rollFor if rollFor != "" else "Result"
-                reply = "**{}:** ".format(rollFor) + reply
-                if show_blurbs:
-                    if adv == 1:
-                        reply += "\n**Rolled with Advantage**"
-                    elif adv == -1:
-                        reply += "\n**Rolled with Disadvantage**"
-                    if crit == 1:
-                        critStr = "\n_**Critical Hit!**_  "
-                        reply += critStr
-                    elif crit == 2:
-                        critStr = "\n_**Critical Fail!**_  "
-                        reply += critStr
-            reply = re.sub(" +", " ", reply)
-            skeletonReply = re.sub(" +", " ", str(skeletonReply))
-            return DiceResult(
-                result=int(floor(total)),
-                verbose_result=reply,
-                crit=crit,
-                rolled=rolled,
-                skeleton=skeletonReply,
-                raw_dice=self,
-            )
+            match = FAST_ROLL_PATTERN.match(rollStr)
+            if match is not None:
+                result = self.roll_fast(match, adv, rollFor, inline, show_blurbs)
+                if result is not None:
+                    return result
+            self.parts = self.build_parts(rollStr, adv)
+            return self.get_result(adv, rollFor, inline, show_blurbs)
         except Exception as ex:
             return DiceResult(verbose_result="Invalid input: {}".format(ex))
 
+    def build_parts(self, rollStr, adv: int = 0, values=None):
+        """Rolls each step of the compiled roll string. If values is given, the
+        (single) dice group uses those rolls instead of drawing new ones.
+        Returns: A list of Parts."""
+        parts = []
+        for step in compile_roll(rollStr):
+            if isinstance(step, DicePlan):
+                parts.append(self.roll_dice(step, adv, values))
+            elif isinstance(step, ConstantPlan):
+                parts.append(Constant(value=step.value, annotation=step.annotation))
+            elif isinstance(step, OperatorPlan):
+                parts.append(Operator(op=step.op, annotation=step.annotation))
+            else:
+                parts.append(Comment(step.comment))
+        return parts
+
+    def roll_fast(
+        self, match, adv: int = 0, rollFor="", inline=False, show_blurbs=True
+    ):
+        """Rolls a FAST_ROLL_PATTERN match straight from the die values, without
+        building parts. The parts are only rebuilt, from the same values, if the
+        result is rendered or raw_dice.parts is read.
+        Returns: DiceResult, or None if the roll needs the full engine."""
+        num_dice = int(match.group(1) or 1)
+        dice_size = int(match.group(2))
+        keep, keep_num = match.group(3), match.group(4)
+        if adv != 0 and dice_size == 20 and keep is None:
+            keep, keep_num = ("h" if adv == 1 else "l"), num_dice
+            num_dice = num_dice * 2
+        if num_dice > 300 or dice_size < 1:
+            return None
+
+        values = [_dice_source.randint(dice_size) for _ in range(num_dice)]
+        kept = values
+        if keep is not None:
+            kept = (nlargest if keep == "h" else nsmallest)(int(keep_num), values)
+        total = sum(kept)
+        if match.group(5) == "+":
+            total += int(match.group(6))
+        elif match.group(5) == "-":
+            total -= int(match.group(6))
+        crit = 0
+        if dice_size == 20 and len(kept) == 1:
+            crit = 1 if kept[0] == 20 else 2 if kept[0] == 1 else 0
+
+        rollStr = match.group(0)
+        self._replay = lambda: self.build_parts(rollStr, adv, values)
+        return DiceResult(
+            result=total,
+            crit=crit,
+            raw_dice=self,
+            render=lambda: self.render(total, crit, adv, rollFor, inline, show_blurbs),
+        )
+
+    def get_result(self, adv: int = 0, rollFor="", inline=False, show_blurbs=True):
+        """Totals the already-rolled parts. The output strings are only built when
+        the DiceResult is first asked for them.
+        Returns: DiceResult"""
+        # calculate total
+        crit = self.get_crit()
+        try:
+            total = self.get_total()
+        except SyntaxError:
+            raise errors.InvalidArgument("No dice found to roll.")
+        return DiceResult(
+            result=int(floor(total)),
+            crit=crit,
+            raw_dice=self,
+            render=lambda: self.render(total, crit, adv, rollFor, inline, show_blurbs),
+        )
+
+    def render(
+        self, total, crit, adv: int = 0, rollFor="", inline=False, show_blurbs=True
+    ):
+        """Formats the rolled parts.
+        Returns: A three-tuple (verbose result, rolled dice, skeleton)"""
+        rolled = " ".join(
+            str(res) for res in self.parts if not isinstance(res, Comment)
+        )
+        if rollFor == "":
+            rollFor = "".join(str(c) for c in self.parts if isinstance(c, Comment))
+        # Builds end result while showing rolls
+        if not inline:
+            skeletonReply = rolled + "\n**Total:** " + str(floor(total))
+        else:
+            skeletonReply = rolled + " = `" + str(floor(total)) + "`"
+        rollFor = rollFor if rollFor != "" else "Result"
+        reply = "**{}:** ".format(rollFor) + skeletonReply
+        if show_blurbs:
+            if adv == 1:
+                reply += "\n**Rolled with Advantage**"
+            elif adv == -1:
+                reply += "\n**Rolled with Disadvantage**"
+            if crit == 1:
+                reply += "\n_**Critical Hit!**_  "
+            elif crit == 2:
+                reply += "\n_**Critical Fail!**_  "
+        reply = re.sub(" +", " ", reply)
+        skeletonReply = re.sub(" +", " ", skeletonReply)
+        return reply, rolled, skeletonReply
+
     def roll_one(self, dice, adv: int = 0):
-        # splits dice and annotation
-        split = re.match(r"^([^\[\]]*?)\s*(\[.*\])?\s*$", dice)
-        dice = split.group(1).strip()
-        annotation = split.group(2)
-
-        # Recognizes dice
-        obj = re.findall("\d+", dice)
-        obj = [int(x) for x in obj]
-        numArgs = len(obj)
-
-        # prepare dice and operators
-        ops = []
-        if numArgs == 1:
-            if not dice.startswith("d"):
-                raise errors.InvalidArgument("Please pass in the value of the dice.")
-            numDice = 1
-            dice_size = obj[0]
-            if adv != 0 and dice_size == 20:
-                numDice = 2
-                ops = ["k", "h1"] if adv == 1 else ["k", "l1"]
-        elif numArgs == 2:
-            numDice = obj[0]
-            dice_size = obj[-1]
-            if adv != 0 and dice_size == 20:
-                ops = (
-                    ["k", "h" + str(numDice)] if adv == 1 else ["k", "l" + str(numDice)]
-                )
-                numDice = numDice * 2
-        else:  # split into xdy and operators
-            numDice = obj[0]
-            dice_size = obj[1]
-            dice = re.split("(\d+d\d+)", dice)[-1]
-            ops = VALID_OPERATORS_2.split(dice)
-            ops = [a for a in ops if a is not None]
-
-        # ensure limits
-        if numDice > 300 or dice_size < 1:
-            raise errors.InvalidArgument("Too many dice rolled.")
+        return self.roll_dice(compile_dice(dice), adv)
+
+    def roll_dice(self, plan, adv: int = 0, values=None):
+        numDice, ops = apply_adv(plan, adv)
+        dice_size = plan.dice_size
 
         # prepare output
         result = SingleDiceGroup(
             num_dice=numDice,
             max_value=dice_size,
-            annotation=annotation or "",
+            annotation=plan.annotation,
             operators=ops,
         )
 
         # roll dice
-        for _ in range(numDice):
-            try:
-                tempdice = SingleDice(
-                    value=random.SystemRandom().randint(1, dice_size),
-                    max_value=dice_size,
-                )
-                result.rolled.append(tempdice)
-            except:  # ?
-                result.rolled.append(SingleDice())
+        if values is None:
+            values = (_dice_source.randint(dice_size) for _ in range(numDice))
+        result.add_dice(values)
 
         # define operators
         def _op_rr(buf):
-            self._rerolls += result.reroll(buf, greedy=True)
+            result.reroll(buf, self.budget, greedy=True)
 
         def _op_k(buf):
             result.keep(buf)
 
         def _op_ro(buf):
-            self._rerolls += result.reroll(buf, once=True)
+            result.reroll(buf, self.budget, once=True)
 
         def _op_ra(buf):
-            result.reroll(buf, once=True, keep_rerolled=True, unique=True)
+            result.reroll(buf, self.budget, once=True, keep_rerolled=True, unique=True)
 
         def _op_e(buf):
-            self._rerolls += result.reroll(buf, greedy=True, keep_rerolled=True)
+            result.reroll(buf, self.budget, greedy=True, keep_rerolled=True)
 
         # run operators
         if ops is not None:
@@ -297,8 +558,7 @@ class Roll(object):
             last_operator = None
 
             for index, op in enumerate(ops):
-                if self._rerolls > MAX_REROLLS:
-                    raise OverflowError("Tried to reroll too many dice.")
+                self.budget.check()
 
                 if (
                     operation is not None
@@ -326,15 +586,9 @@ class Roll(object):
                     buffer += parse_selectors([list_get(index + 1, 0, ops)], result)
                     operation = _op_ro
                 elif op == "mi":
-                    _min = list_get(index + 1, 0, ops)
-                    for r in result.rolled:
-                        if r.value < int(_min):
-                            r.update(int(_min))
+                    result.clamp(int(list_get(index + 1, 0, ops)), minimum=True)
                 elif op == "ma":
-                    _max = list_get(index + 1, 0, ops)
-                    for r in result.rolled:
-                        if r.value > int(_max):
-                            r.update(int(_max))
+                    result.clamp(int(list_get(index + 1, 0, ops)), minimum=False)
                 elif op == "ra":
                     buffer += parse_selectors([list_get(index + 1, 0, ops)], result)
                     operation = _op_ra
@@ -347,8 +601,7 @@ class Roll(object):
                 if op in VALID_OPERATORS_ARRAY:
                     last_operator = op
 
-            if self._rerolls > MAX_REROLLS:
-                raise OverflowError("Tried to reroll too many dice.")
+            self.budget.check()
             if operation is not None:
                 operation(buffer)
 
@@ -362,6 +615,9 @@ class Part:
 
 
 class SingleDiceGroup(Part):
+    """A group of dice of the same size. The dice are held as parallel arrays of
+    values and kept/exploded flags; SingleDice views are only built on demand."""
+
     def __init__(
         self,
         num_dice: int = 0,
@@ -373,94 +629,130 @@ class SingleDiceGroup(Part):
     ):
         if operators is None:
             operators = []
-        if rolled is None:
-            rolled = []
         self.num_dice = num_dice
         self.max_value = max_value
-        self.rolled = rolled  # list of SingleDice
+        self.values = array("q")
+        self.kept = bytearray()
+        self.exploded = bytearray()
+        self.history = {}  # index -> earlier values of dice changed by mi/ma
         self.annotation = annotation
         self.result = result
         self.operators = operators
+        for die in rolled or []:
+            self.add_die(die.value, die.kept, die.exploded, die.rolls[:-1])
+
+    @property
+    def rolled(self):
+        """Returns: A list of SingleDice, a snapshot of the dice in this group."""
+        return [self.get_die(i) for i in range(len(self.values))]
+
+    def get_die(self, index):
+        die = SingleDice(
+            value=self.values[index],
+            max_value=self.max_value,
+            kept=bool(self.kept[index]),
+            exploded=bool(self.exploded[index]),
+        )
+        die.rolls = self.history.get(index, []) + [die.value]
+        return die
+
+    def add_die(self, value, kept=True, exploded=False, history=None):
+        if history:
+            self.history[len(self.values)] = list(history)
+        self.values.append(value)
+        self.kept.append(kept)
+        self.exploded.append(exploded)
+
+    def add_dice(self, values):
+        """Adds freshly rolled (kept, unexploded) dice."""
+        start = len(self.values)
+        self.values.extend(values)
+        added = len(self.values) - start
+        self.kept.extend(b"\x01" * added)
+        self.exploded.extend(bytes(added))
+
+    def clamp(self, value, minimum=True):
+        """Applies mi (minimum=True) or ma to every die."""
+        for i, current in enumerate(self.values):
+            if current < value if minimum else current > value:
+                self.history.setdefault(i, []).append(current)
+                self.values[i] = value
 
     def keep(self, rolls_to_keep):
         if rolls_to_keep is None:
             return
-        for _roll in self.rolled:
-            if not _roll.value in rolls_to_keep:
-                _roll.kept = False
-            elif _roll.kept:
-                rolls_to_keep.remove(_roll.value)
+        remaining = Counter(rolls_to_keep)
+        for i, value in enumerate(self.values):
+            if not remaining[value]:
+                self.kept[i] = False
+            elif self.kept[i]:
+                remaining[value] -= 1
 
     def reroll(
         self,
         rerollList,
-        max_iterations=1000,
+        budget=None,
         greedy=False,
         keep_rerolled=False,
         unique=False,
         once=False,
     ):
+        """Rerolls (or, with keep_rerolled, explodes) the kept dice showing a value
+        in rerollList. Greedy rerolls keep going on the new dice; otherwise each
+        entry in rerollList is used up by one die.
+        Each pass only checks the dice added by the previous one.
+        Returns: int - the number of dice checked."""
+        if budget is None:
+            budget = WorkBudget()
         if not rerollList:
             return 0  # don't reroll nothing - minor optimization
         if unique:
             rerollList = list(set(rerollList))  # remove duplicates
         if len(rerollList) > 100:
             raise OverflowError("Too many dice to reroll (max 100)")
-        last_index = 0
+        targets = set(rerollList)
+        remaining = Counter(rerollList)
         count = 0
-        should_continue = True
-        while should_continue:  # let's only iterate 250 times for sanity
-            should_continue = False
-            if any(
-                d.value in set(rerollList)
-                for d in self.rolled[last_index:]
-                if d.kept and not d.exploded
-            ):
-                should_continue = True
-
+        start, end = 0, len(self.values)
+        while start < end:
             to_extend = []
-            for r in self.rolled[last_index:]:  # no need to recheck everything
+            for i in range(start, end):
                 count += 1
-                if count > max_iterations:
-                    should_continue = False
+                if count > budget.per_operation:
                     break
 
-                if r.value in rerollList and r.kept and not r.exploded:
-                    try:
-                        tempdice = SingleDice(
-                            value=random.SystemRandom().randint(1, self.max_value),
-                            max_value=self.max_value,
-                        )
-                        to_extend.append(tempdice)
-                    except:
-                        to_extend.append(SingleDice())
+                value = self.values[i]
+                if value in targets and self.kept[i] and not self.exploded[i]:
+                    to_extend.append(_dice_source.randint(self.max_value))
 
                     if not keep_rerolled:
-                        r.drop()
+                        self.kept[i] = False
                     else:
-                        r.explode()
+                        self.exploded[i] = True
 
                     if not greedy:
-                        rerollList.remove(r.value)
-
-            last_index = len(self.rolled)
-            self.rolled.extend(to_extend)
+                        remaining[value] -= 1
+                        if not remaining[value]:
+                            targets.discard(value)
 
-            if once:
+            self.add_dice(to_extend)
+            if once or not to_extend or count > budget.per_operation:
                 break
+            start, end = end, len(self.values)
 
+        budget.spend(count)
         return count
 
     def get_total(self):
         """Returns:
         int - The total value of the dice."""
-        return sum(r.value for r in self.rolled if r.kept)
+        return sum(compress(self.values, self.kept))
 
     def get_eval(self):
         return str(self.get_total())
 
     def get_num_kept(self):
-        return sum(1 for r in self.rolled if r.kept)
+        return self.kept.count(1)
 
     def get_crit(self):
         """Returns:
@@ -474,7 +766,17 @@ class SingleDiceGroup(Part):
 
     def __str__(self):
         return "{0.num_dice}d{0.max_value}{1} ({2}) {0.annotation}".format(
-            self, "".join(self.operators), ", ".join(str(r) for r in self.rolled)
+            self,
+            "".join(self.operators),
+            ", ".join(
+                format_die(
+                    self.history.get(i, []) + [value],
+                    self.max_value,
+                    self.kept[i],
+                    self.exploded[i],
+                )
+                for i, value in enumerate(self.values)
+            ),
         )
 
     def to_dict(self):
@@ -492,6 +794,19 @@ class SingleDiceGroup(Part):
         }
 
 
+def format_die(rolls, max_value, kept, exploded):
+    """Formats the rolls of one die (X -> Y -> Z) in markdown."""
+    formatted_rolls = [str(r) for r in rolls]
+    if rolls[-1] == max_value or rolls[-1] == 1:
+        formatted_rolls[-1] = "**" + formatted_rolls[-1] + "**"
+    if exploded:
+        formatted_rolls[-1] = "__" + formatted_rolls[-1] + "__"
+    if kept:
+        return " -> ".join(formatted_rolls)
+    else:
+        return "~~" + " -> ".join(formatted_rolls) + "~~"
+
+
 class SingleDice:
     def __init__(
         self,
@@ -517,15 +832,7 @@ class SingleDice:
         self.rolls.append(new_value)
 
     def __str__(self):
-        formatted_rolls = [str(r) for r in self.rolls]
-        if int(formatted_rolls[-1]) == self.max_value or int(formatted_rolls[-1]) == 1:
-            formatted_rolls[-1] = "**" + formatted_rolls[-1] + "**"
-        if self.exploded:
-            formatted_rolls[-1] = "__" + formatted_rolls[-1] + "__"
-        if self.kept:
-            return " -> ".join(formatted_rolls)
-        else:
-            return "~~" + " -> ".join(formatted_rolls) + "~~"
+        return format_die(self.rolls, self.max_value, self.kept, self.exploded)
 
     def __repr__(self):
         return "<SingleDice object: value={0.value}, max_value={0.max_value}, kept={0.kept}, rolls={0.rolls}>".format(
@@ -584,37 +891,121 @@ class Comment(Part):
         return {"type": "comment", "value": self.comment}
 
 
+def evaluate(parts):
+    """Evaluates the arithmetic expression formed by a list of Parts, with the usual
+    precedence: parentheses, then unary signs, then * and /, then + and -.
+    Division is true division; callers floor the final total.
+    Raises SyntaxError if the parts do not form a valid expression."""
+    return evaluate_tokens([t for t in map(part_token, parts) if t is not None])
+
+
+def part_token(part):
+    """Returns: The number or operator string a Part contributes to the total,
+    or None if it contributes nothing."""
+    if isinstance(part, SingleDiceGroup):
+        return part.get_total()
+    elif isinstance(part, Constant):
+        return part.value
+    elif isinstance(part, Operator) and part.op.strip():
+        return part.op.strip()
+    return None
+
+
+def evaluate_tokens(tokens):
+    """Evaluates a list of numbers and operator strings (see evaluate()).
+    Numbers may be numpy arrays, in which case the result is evaluated element-wise."""
+    pos, value = _eval_sum(tokens, 0)
+    if pos != len(tokens):
+        raise SyntaxError("invalid syntax")
+    return value
+
+
+def _is_op(tokens, pos, ops):
+    return pos < len(tokens) and isinstance(tokens[pos], str) and tokens[pos] in ops
+
+
+def _eval_sum(tokens, pos):
+    pos, value = _eval_product(tokens, pos)
+    while _is_op(tokens, pos, ("+", "-")):
+        op = tokens[pos]
+        pos, rhs = _eval_product(tokens, pos + 1)
+        value = value + rhs if op == "+" else value - rhs
+    return pos, value
+
+
+def _eval_product(tokens, pos):
+    pos, value = _eval_unary(tokens, pos)
+    while _is_op(tokens, pos, ("*", "/")):
+        op = tokens[pos]
+        pos, rhs = _eval_unary(tokens, pos + 1)
+        value = value * rhs if op == "*" else value / rhs
+    return pos, value
+
+
+def _eval_unary(tokens, pos):
+    if _is_op(tokens, pos, ("+", "-")):
+        op = tokens[pos]
+        pos, value = _eval_unary(tokens, pos + 1)
+        return pos, value if op == "+" else -value
+    return _eval_atom(tokens, pos)
+
+
+def _eval_atom(tokens, pos):
+    if pos >= len(tokens):
+        raise SyntaxError("invalid syntax")
+    if _is_op(tokens, pos, ("(",)):
+        pos, value = _eval_sum(tokens, pos + 1)
+        if not _is_op(tokens, pos, (")",)):
+            raise SyntaxError("invalid syntax")
+        return pos + 1, value
+    if _is_op(tokens, pos, (".",)):
+        # ".5" - the number after the dot is the fractional part
+        if pos + 1 >= len(tokens) or isinstance(tokens[pos + 1], str):
+            raise SyntaxError("invalid syntax")
+        return pos + 2, float(f".{tokens[pos + 1]}")
+    token = tokens[pos]
+    if isinstance(token, str):
+        raise SyntaxError("invalid syntax")
+    pos += 1
+    if _is_op(tokens, pos, (".",)):
+        # "1.5" is split into 1, ".", 5 by the roll parser
+        if pos + 1 < len(tokens) and not isinstance(tokens[pos + 1], str):
+            return pos + 2, float(f"{token}.{tokens[pos + 1]}")
+        return pos + 1, float(token)
+    return pos, token
+
+
 def parse_selectors(opts, res, greedy=False, inverse=False):
     """Returns a list of ints."""
     for o in range(len(opts)):
         if opts[o][0] == "h":
             opts[o] = nlargest(
-                int(opts[o].split("h")[1]), (d.value for d in res.rolled if d.kept)
+                int(opts[o].split("h")[1]), compress(res.values, res.kept)
             )
         elif opts[o][0] == "l":
             opts[o] = nsmallest(
-                int(opts[o].split("l")[1]), (d.value for d in res.rolled if d.kept)
+                int(opts[o].split("l")[1]), compress(res.values, res.kept)
             )
         elif opts[o][0] == ">":
             if greedy:
                 opts[o] = list(range(int(opts[o].split(">")[1]) + 1, res.max_value + 1))
             else:
-                opts[o] = [
-                    d.value for d in res.rolled if d.value > int(opts[o].split(">")[1])
-                ]
+                threshold = int(opts[o].split(">")[1])
+                opts[o] = [v for v in res.values if v > threshold]
         elif opts[o][0] == "<":
             if greedy:
                 opts[o] = list(range(1, int(opts[o].split("<")[1])))
             else:
-                opts[o] = [
-                    d.value for d in res.rolled if d.value < int(opts[o].split("<")[1])
-                ]
+                threshold = int(opts[o].split("<")[1])
+                opts[o] = [v for v in res.values if v < threshold]
     out = []
     for o in opts:
         if isinstance(o, list):
             out.extend(int(l) for l in o)
         elif not greedy:
-            out.extend(int(o) for a in res.rolled if a.value is int(o) and a.kept)
+            if res.values:
+                value = int(o)
+                out.extend([value] * list(compress(res.values, res.kept)).count(value))
         else:
             out.append(int(o))
 
@@ -622,16 +1013,20 @@ def parse_selectors(opts, res, greedy=False, inverse=False):
         return out
 
     inverse_out = []
-    for rolled in res.rolled:
-        if rolled.kept and rolled.value in out:
-            out.remove(rolled.value)
-        elif rolled.kept:
-            inverse_out.append(rolled.value)
+    remaining = Counter(out)
+    for value in compress(res.values, res.kept):
+        if remaining[value]:
+            remaining[value] -= 1
+        else:
+            inverse_out.append(value)
     return inverse_out
 
 
 class DiceResult:
-    """Class to hold the output of a dice roll."""
+    """Class to hold the output of a dice roll.
+    If render is given, result, rolled and skeleton are built by calling it the
+    first time one of them is read, so callers that only want the total never
+    pay for formatting."""
 
     def __init__(
         self,
@@ -641,14 +1036,36 @@ class DiceResult:
         rolled: str = "",
         skeleton: str = "",
         raw_dice: Roll = None,
+        render=None,
     ):
         self.plain = result
         self.total = result
-        self.result = verbose_result
         self.crit = crit
-        self.rolled = rolled
-        self.skeleton = skeleton if skeleton != "" else verbose_result
         self.raw_dice = raw_dice  # Roll
+        self._result = verbose_result
+        self._rolled = rolled
+        self._skeleton = skeleton
+        self._render = render
+
+    def _rendered(self):
+        if self._render is not None:
+            self._result, self._rolled, self._skeleton = self._render()
+            self._render = None
+
+    @property
+    def result(self):
+        self._rendered()
+        return self._result
+
+    @property
+    def rolled(self):
+        self._rendered()
+        return self._rolled
+
+    @property
+    def skeleton(self):
+        self._rendered()
+        return self._skeleton if self._skeleton != "" else self._result
 
     def __str__(self):
         return self.result
@@ -657,38 +1074,862 @@ class DiceResult:
         return "<DiceResult object: total={}>".format(self.total)
 
     def consolidated(self):
-        """Gets the most simplified version of the roll string."""
+        """Gets the most simplified version of the roll string, totalling each run
+        of parts that share an annotation straight from the rolled parts."""
         if self.raw_dice is None:
             return "0"
-        parts = []  # list of (part, annotation)
-        last_part = ""
+        segments = []  # list of (tokens, annotation)
+        tokens = []
         for p in self.raw_dice.parts:
-            if isinstance(p, SingleDiceGroup):
-                last_part += str(p.get_total())
-            else:
-                last_part += str(p)
+            token = part_token(p)
+            if token is not None:
+                tokens.append(token)
             if not isinstance(p, Comment) and p.annotation:
-                parts.append((last_part, p.annotation))
-                last_part = ""
-        if last_part:
-            parts.append((last_part, ""))
+                segments.append((tokens, p.annotation))
+                tokens = []
+        if tokens:
+            segments.append((tokens, ""))
 
-        to_roll = ""
+        to_total = []
         last_annotation = ""
         out = ""
-        for numbers, annotation in parts:
-            if annotation and annotation != last_annotation and to_roll:
-                out += f"{roll(to_roll).total:+} {last_annotation}"
-                to_roll = ""
+        for tokens, annotation in segments:
+            if annotation and annotation != last_annotation and to_total:
+                out += f"{_segment_total(to_total):+} {last_annotation}"
+                to_total = []
             if annotation:
                 last_annotation = annotation
-            to_roll += numbers
-        if to_roll:
-            out += f"{roll(to_roll).total:+} {last_annotation}"
+            to_total += tokens
+        if to_total:
+            out += f"{_segment_total(to_total):+} {last_annotation}"
         out = out.strip("+ ")
         return out
 
 
+def _segment_total(tokens):
+    """Totals one consolidated segment; like an invalid roll, a segment that isn't
+    a complete expression on its own totals 0."""
+    try:
+        return int(floor(evaluate_tokens(tokens)))
+    except (SyntaxError, ZeroDivisionError):
+        return 0
+
+
+class _BatchUnsupported(Exception):
+    """Raised when a roll can't be held as arrays and must be rolled one at a time."""
+
+    pass
+
+
+class BatchRoll:
+    """Rolls a compiled roll string for a number of iterations at once.
+    Dice groups are held as BatchDiceGroups with one row per iteration."""
+
+    def __init__(self, iterations: int):
+        self.iterations = iterations
+        self.parts = []
+        self.errors = [None] * iterations  # first error hit by each iteration
+        self.totals = numpy.zeros(iterations, dtype=numpy.int64)
+        self.budget = WorkBudget(spent=numpy.zeros(iterations, dtype=numpy.int64))
+
+    def fail(self, mask, message):
+        """Marks the iterations in mask as invalid, keeping any earlier error."""
+        for index in numpy.flatnonzero(mask):
+            if self.errors[index] is None:
+                self.errors[index] = message
+
+    def run(self, plan, adv: int = 0):
+        try:
+            for step in plan:
+                if isinstance(step, DicePlan):
+                    self.parts.append(self.roll_dice(step, adv))
+                elif isinstance(step, ConstantPlan):
+                    self.parts.append(
+                        Constant(value=step.value, annotation=step.annotation)
+                    )
+                elif isinstance(step, OperatorPlan):
+                    self.parts.append(Operator(op=step.op, annotation=step.annotation))
+                else:
+                    self.parts.append(Comment(step.comment))
+            self.totals = self.get_totals()
+        except _BatchUnsupported:
+            raise
+        except Exception as ex:
+            self.fail(numpy.ones(self.iterations, dtype=bool), str(ex))
+        invalid = numpy.array([e is not None for e in self.errors], dtype=bool)
+        self.totals[invalid] = 0
+
+    def get_totals(self):
+        """Returns: numpy array of int - the floored total of each iteration."""
+        tokens = []
+        for p in self.parts:
+            if isinstance(p, BatchDiceGroup):
+                tokens.append(p.get_totals())
+            elif isinstance(p, Constant):
+                tokens.append(p.value)
+            elif isinstance(p, Operator) and p.op.strip():
+                tokens.append(p.op.strip())
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            try:
+                total = evaluate_tokens(tokens)
+            except SyntaxError:
+                raise errors.InvalidArgument("No dice found to roll.")
+            total = numpy.broadcast_to(
+                numpy.asarray(total, dtype=numpy.float64), (self.iterations,)
+            )
+            finite = numpy.isfinite(total)
+            self.fail(~finite, "division by zero")
+            return numpy.floor(numpy.where(finite, total, 0)).astype(numpy.int64)
+
+    def get_result(
+        self, index, adv: int = 0, rollFor="", inline=True, show_blurbs=True
+    ):
+        """Renders one iteration as if it had been rolled by Roll.roll().
+        Returns: DiceResult"""
+        if self.errors[index] is not None:
+            return DiceResult(
+                verbose_result="Invalid input: {}".format(self.errors[index])
+            )
+        parts = [
+            p.materialize(index) if isinstance(p, BatchDiceGroup) else p
+            for p in self.parts
+        ]
+        try:
+            return Roll(parts).get_result(adv, rollFor, inline, show_blurbs)
+        except Exception as ex:
+            return DiceResult(verbose_result="Invalid input: {}".format(ex))
+
+    def check_rerolls(self):
+        self.fail(self.budget.exhausted(), "Tried to reroll too many dice.")
+
+    def roll_dice(self, plan, adv: int = 0):
+        numDice, ops = apply_adv(plan, adv)
+        result = BatchDiceGroup(
+            iterations=self.iterations,
+            num_dice=numDice,
+            max_value=plan.dice_size,
+            annotation=plan.annotation,
+            operators=ops,
+        )
+
+        # define operators
+        def _op_rr(buf):
+            result.reroll(self, buf, greedy=True)
+
+        def _op_k(buf):
+            result.keep(buf[0])
+
+        def _op_ro(buf):
+            result.reroll(self, buf, once=True)
+
+        def _op_ra(buf):
+            result.reroll(self, buf, once=True, keep_rerolled=True, unique=True)
+
+        def _op_e(buf):
+            result.reroll(self, buf, greedy=True, keep_rerolled=True)
+
+        def _add(buf, selected):
+            if buf is None:
+                return selected
+            return buf[0] + selected[0], buf[1] + selected[1]
+
+        # run operators, in the same order as Roll.roll_dice()
+        buffer = None
+        operation = None
+        last_operator = None
+        for index, op in enumerate(ops):
+            self.check_rerolls()
+
+            if (
+                operation is not None
+                and op in VALID_OPERATORS_ARRAY
+                and not op == last_operator
+            ):
+                operation(buffer)
+                buffer = None
+                operation = None
+
+            selector = list_get(index + 1, 0, ops)
+            if op == "rr":
+                buffer = _add(buffer, result.parse_selector(selector, greedy=True))
+                operation = _op_rr
+            elif op == "k":
+                buffer = _add(buffer, result.parse_selector(selector))
+                operation = _op_k
+            elif op == "p":
+                buffer = _add(buffer, result.parse_selector(selector, inverse=True))
+                operation = _op_k
+            elif op == "ro":
+                buffer = _add(buffer, result.parse_selector(selector))
+                operation = _op_ro
+            elif op == "mi":
+                result.clamp(int(selector), minimum=True)
+            elif op == "ma":
+                result.clamp(int(selector), minimum=False)
+            elif op == "ra":
+                buffer = _add(buffer, result.parse_selector(selector))
+                operation = _op_ra
+            elif op == "e":
+                buffer = _add(buffer, result.parse_selector(selector, greedy=True))
+                operation = _op_e
+
+            if op in VALID_OPERATORS_ARRAY:
+                last_operator = op
+
+        self.check_rerolls()
+        if operation is not None:
+            operation(buffer)
+
+        return result
+
+
+class BatchDiceGroup(Part):
+    """The same dice group rolled once per iteration, as 2D arrays of
+    (iteration, die). Rerolled and exploded dice are appended as new columns, so
+    `exists` marks which cells hold a die for that iteration."""
+
+    def __init__(
+        self,
+        iterations: int,
+        num_dice: int = 0,
+        max_value: int = 0,
+        annotation: str = "",
+        operators=None,
+    ):
+        self.iterations = iterations
+        self.num_dice = num_dice
+        self.max_value = max_value
+        self.annotation = annotation
+        self.operators = operators if operators is not None else []
+        self.values = _dice_source.integers(max_value, (iterations, num_dice))
+        self.exists = numpy.ones((iterations, num_dice), dtype=bool)
+        self.kept = numpy.ones((iterations, num_dice), dtype=bool)
+        self.exploded = numpy.zeros((iterations, num_dice), dtype=bool)
+        self.initial = None  # values before the first mi/ma, if any
+        self.updates = []  # list of (mask, value) for each mi/ma applied
+        self._rows = numpy.arange(iterations)
+        self._num_values = None
+        self._spare = {}  # attribute -> the array it is a view of, see append()
+
+    @property
+    def num_values(self):
+        """The size of the per-iteration value tables used to select dice."""
+        if self._num_values is None:
+            literals = [int(o) for o in self.operators if o.isdigit()]
+            self._num_values = max([self.max_value] + literals) + 1
+            if self._num_values > MAX_BATCH_VALUES:
+                raise _BatchUnsupported()
+        return self._num_values
+
+    def append(self, values, exists):
+        start = self.values.shape[1]
+        end = start + values.shape[1]
+        columns = {
+            "values": values,
+            "exists": exists,
+            "kept": exists,
+            "exploded": False,
+            "initial": values,
+        }
+        for name, new in columns.items():
+            current = getattr(self, name)
+            if current is None:
+                continue
+            # the arrays are views of wider ones, doubled when full, so a long
+            # chain of rerolls doesn't copy every earlier column on each pass
+            full = self._spare.get(name)
+            if full is None or current.base is not full or full.shape[1] < end:
+                full = numpy.empty(
+                    (self.iterations, max(end, 2 * start)), dtype=current.dtype
+                )
+                full[:, :start] = current
+                self._spare[name] = full
+            full[:, start:end] = new
+            setattr(self, name, full[:, :end])
+
+    def count_values(self, mask, values=None):
+        """Returns: (iteration, value) table of how many dice in mask show each value."""
+        if values is None:
+            values = self.values
+        width = self.num_values
+        index = (self._rows[:, None] * width + values)[mask]
+        return (
+            numpy.bincount(index, minlength=self.iterations * width)
+            .reshape(self.iterations, width)
+            .astype(numpy.int32)
+        )
+
+    def parse_selector(self, selector, greedy=False, inverse=False):
+        """The batch equivalent of parse_selectors() for a single selector.
+        Returns: A two-tuple (value table, number of values selected per iteration)"""
+        width = self.num_values
+        kind = selector[0]
+        live = self.exists & self.kept
+        if kind in ("h", "l"):
+            num = int(selector.split(kind)[1])
+            if kind == "h":
+                ordered = numpy.sort(numpy.where(live, self.values, -1), axis=1)
+                ordered = ordered[:, ::-1][:, :num]
+                counts = self.count_values(ordered >= 0, ordered)
+            else:
+                ordered = numpy.sort(numpy.where(live, self.values, width), axis=1)
+                ordered = ordered[:, :num]
+                counts = self.count_values(ordered < width, ordered)
+        elif kind in (">", "<"):
+            num = int(selector.split(kind)[1])
+            if greedy:
+                counts = numpy.zeros((self.iterations, width), dtype=numpy.int32)
+                if kind == ">":
+                    counts[:, max(0, num + 1) : self.max_value + 1] = 1
+                else:
+                    counts[:, 1 : max(1, min(num, width))] = 1
+                lengths = numpy.full(
+                    self.iterations,
+                    max(0, self.max_value - num) if kind == ">" else max(0, num - 1),
+                )
+                return counts, lengths
+            if kind == ">":
+                counts = self.count_values(self.exists & (self.values > num))
+            else:
+                counts = self.count_values(self.exists & (self.values < num))
+        else:
+            num = int(selector)
+            if greedy:
+                counts = numpy.zeros((self.iterations, width), dtype=numpy.int32)
+                if 0 <= num < width:
+                    counts[:, num] = 1
+                return counts, numpy.ones(self.iterations, dtype=numpy.int64)
+            counts = self.count_values(live & (self.values == num))
+
+        if inverse:
+            kept = numpy.zeros_like(counts)
+            for j in range(self.values.shape[1]):
+                value = self.values[:, j]
+                dropped = live[:, j] & (counts[self._rows, value] > 0)
+                counts[self._rows[dropped], value[dropped]] -= 1
+                rest = live[:, j] & ~dropped
+                kept[self._rows[rest], value[rest]] += 1
+            counts = kept
+        return counts, counts.sum(axis=1, dtype=numpy.int64)
+
+    def keep(self, counts):
+        for j in range(self.values.shape[1]):
+            value = self.values[:, j]
+            kept = self.kept[:, j] & (counts[self._rows, value] > 0)
+            counts[self._rows[kept], value[kept]] -= 1
+            self.kept[:, j] = kept
+
+    def clamp(self, value, minimum=True):
+        """Applies mi (minimum=True) or ma to every die."""
+        if minimum:
+            mask = self.exists & (self.values < value)
+        else:
+            mask = self.exists & (self.values > value)
+        if not mask.any():
+            return
+        if self.initial is None:
+            self.initial = self.values.copy()
+        self.values[mask] = value
+        self.updates.append((mask, value))
+
+    def reroll(
+        self,
+        batch,
+        selected,
+        greedy=False,
+        keep_rerolled=False,
+        unique=False,
+        once=False,
+    ):
+        """The batch equivalent of SingleDiceGroup.reroll().
+        Returns: numpy array of int - the number of dice checked in each iteration."""
+        counts, lengths = selected
+        max_iterations = batch.budget.per_operation
+        if unique:
+            counts = numpy.minimum(counts, 1)
+            lengths = counts.sum(axis=1, dtype=numpy.int64)
+        too_many = lengths > 100
+        batch.fail(too_many, "Too many dice to reroll (max 100)")
+        active = (lengths > 0) & ~too_many
+        checked = numpy.zeros(self.iterations, dtype=numpy.int64)
+
+        # each pass checks the dice added by the previous one, in every iteration
+        start = 0
+        while active.any():
+            end = self.values.shape[1]
+            exists = self.exists[:, start:end] & active[:, None]
+            seen = checked[:, None] + numpy.cumsum(exists, axis=1)
+            over = (exists & (seen > max_iterations)).any(axis=1)
+            values = self.values[:, start:end]
+            candidate = (
+                exists
+                & (seen <= max_iterations)
+                & self.kept[:, start:end]
+                & ~self.exploded[:, start:end]
+            )
+            if greedy:
+                match = candidate & (counts[self._rows[:, None], values] > 0)
+            else:
+                match = numpy.zeros_like(candidate)
+                for j in range(end - start):
+                    value = values[:, j]
+                    hit = candidate[:, j] & (counts[self._rows, value] > 0)
+                    counts[self._rows[hit], value[hit]] -= 1
+                    match[:, j] = hit
+
+            if keep_rerolled:
+                self.exploded[:, start:end] |= match
+            else:
+                self.kept[:, start:end] &= ~match
+            checked += exists.sum(axis=1)
+            checked[over] = max_iterations + 1
+
+            found = match.sum(axis=1)
+            width = found.max() if len(found) else 0
+            if width:
+                self.append(
+                    _dice_source.integers(self.max_value, (self.iterations, width)),
+                    numpy.arange(width)[None, :] < found[:, None],
+                )
+            active &= ~over & (found > 0)
+            if once:
+                break
+            start = end
+        batch.budget.spend(checked)
+        return checked
+
+    def get_totals(self):
+        """Returns: numpy array of int - the total value of the dice in each iteration."""
+        return numpy.where(self.exists & self.kept, self.values, 0).sum(axis=1)
+
+    def materialize(self, index):
+        """Returns: The SingleDiceGroup rolled in one iteration."""
+        result = SingleDiceGroup(
+            num_dice=self.num_dice,
+            max_value=self.max_value,
+            annotation=self.annotation,
+            operators=self.operators,
+        )
+        exists = self.exists[index]
+        result.values = array("q", self.values[index][exists].tolist())
+        result.kept = bytearray(self.kept[index][exists].tobytes())
+        result.exploded = bytearray(self.exploded[index][exists].tobytes())
+        if self.updates:
+            initial = self.initial[index]
+            for i, j in enumerate(numpy.flatnonzero(exists)):
+                rolls = [int(initial[j])]
+                rolls += [
+                    v
+                    for mask, v in self.updates
+                    if j < mask.shape[1] and mask[index, j]
+                ]
+                if len(rolls) > 1:
+                    result.history[i] = rolls[:-1]
+        return result
+
+
+class MultiDiceResult:
+    """Class to hold the output of roll_many(). The DiceResult of each iteration is
+    only rendered when it is first accessed."""
+
+    def __init__(self, totals, render):
+        self.totals = totals  # numpy array of int
+        self.total = int(totals.sum())
+        self._render = render
+        self._results = {}
+
+    def __len__(self):
+        return len(self.totals)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("iteration out of range")
+        if index not in self._results:
+            self._results[index] = self._render(index)
+        return self._results[index]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __repr__(self):
+        return "<MultiDiceResult object: iterations={}, total={}>".format(
+            len(self), self.total
+        )
+
+
+class Distribution:
+    """The exact probability distribution of a roll total, held as numpy arrays of
+    the possible values (ascending) and their probabilities.
+    Supports + - * / with numbers and other (independent) Distributions, so it can
+    be evaluated by evaluate_tokens(). Arithmetic is charged to the WorkBudget of
+    either side (the Distributions of one odds() call share one), and fails with
+    InvalidArgument once that runs out."""
+
+    def __init__(self, values, probs, budget=None):
+        values = numpy.round(numpy.asarray(values, dtype=numpy.float64), 9)
+        probs = numpy.asarray(probs, dtype=numpy.float64)
+        self.values, inverse = numpy.unique(values, return_inverse=True)
+        self.probs = numpy.bincount(
+            inverse.ravel(), weights=probs.ravel(), minlength=len(self.values)
+        )
+        self.values.flags.writeable = False
+        self.probs.flags.writeable = False
+        self.budget = budget
+
+    @classmethod
+    def constant(cls, value, budget=None):
+        return cls([value], [1.0], budget)
+
+    @classmethod
+    def from_dict(cls, d, budget=None):
+        """Builds a Distribution from a dict of value -> probability."""
+        return cls(list(d.keys()), list(d.values()), budget)
+
+    def to_dict(self):
+        return {
+            (int(v) if v == int(v) else float(v)): float(p)
+            for v, p in zip(self.values, self.probs)
+        }
+
+    # ---------- arithmetic ----------
+    def _combine(self, other, op):
+        if not isinstance(other, Distribution):
+            other = Distribution.constant(other)
+        budget = self.budget or other.budget or WorkBudget(MAX_ODDS_WORK)
+        if op in ("+", "-") and self._is_integral() and other._is_integral():
+            # dense convolution is much faster than the outer product for sums
+            if op == "-":
+                other = -other
+            a, offset_a = self._dense()
+            b, offset_b = other._dense()
+            _spend_odds_work(budget, len(a) * len(b))
+            probs = numpy.convolve(a, b)
+            values = numpy.arange(len(probs)) + offset_a + offset_b
+            nonzero = probs > 0
+            return Distribution(values[nonzero], probs[nonzero], budget)
+        if op == "/" and (other.values == 0).any():
+            raise errors.InvalidArgument("That roll can divide by zero.")
+        _spend_odds_work(budget, len(self.values) * len(other.values) * ODDS_OUTER_COST)
+        values = {
+            "+": numpy.add,
+            "-": numpy.subtract,
+            "*": numpy.multiply,
+            "/": numpy.true_divide,
+        }[op].outer(self.values, other.values)
+        return Distribution(values, numpy.outer(self.probs, other.probs), budget)
+
+    def _is_integral(self):
+        return bool((self.values == numpy.floor(self.values)).all())
+
+    def _dense(self):
+        """Returns: A two-tuple (probabilities of every integer in range, lowest value)"""
+        offset = int(self.values[0])
+        width = int(self.values[-1]) - offset + 1
+        if width > MAX_ODDS_WIDTH:
+            raise errors.InvalidArgument("That roll is too complex to compute exactly.")
+        dense = numpy.zeros(width)
+        dense[self.values.astype(numpy.int64) - offset] = self.probs
+        return dense, offset
+
+    def __add__(self, other):
+        return self._combine(other, "+")
+
+    def __radd__(self, other):
+        return Distribution.constant(other)._combine(self, "+")
+
+    def __sub__(self, other):
+        return self._combine(other, "-")
+
+    def __rsub__(self, other):
+        return Distribution.constant(other)._combine(self, "-")
+
+    def __mul__(self, other):
+        return self._combine(other, "*")
+
+    def __rmul__(self, other):
+        return Distribution.constant(other)._combine(self, "*")
+
+    def __truediv__(self, other):
+        return self._combine(other, "/")
+
+    def __rtruediv__(self, other):
+        return Distribution.constant(other)._combine(self, "/")
+
+    def __neg__(self):
+        return Distribution(-self.values, self.probs, self.budget)
+
+    def __pos__(self):
+        return self
+
+    def sum_of(self, count: int):
+        """Returns: The distribution of the sum of count independent copies."""
+        total = Distribution.constant(0, self.budget)
+        power = self
+        while count:
+            if count & 1:
+                total = total + power
+            count >>= 1
+            if count:
+                power = power + power
+        return total
+
+    def floor(self):
+        return Distribution(numpy.floor(self.values), self.probs, self.budget)
+
+    # ---------- statistics ----------
+    def mean(self):
+        return float((self.values * self.probs).sum())
+
+    def variance(self):
+        return float((((self.values - self.mean()) ** 2) * self.probs).sum())
+
+    def std(self):
+        return self.variance() ** 0.5
+
+    def percentile(self, q):
+        """Returns: The smallest value with at least q percent of outcomes at or below it."""
+        cumulative = numpy.cumsum(self.probs)
+        index = numpy.searchsorted(cumulative, q / 100 - 1e-12)
+        return self.values[min(index, len(self.values) - 1)].item()
+
+    def at_least(self, value):
+        """Returns: The probability of a total of value or more."""
+        return float(self.probs[self.values >= value].sum())
+
+    def __repr__(self):
+        return "<Distribution object: mean={:.3f}, std={:.3f}>".format(
+            self.mean(), self.std()
+        )
+
+
+@lru_cache(maxsize=PLAN_CACHE_SIZE)
+def odds(rollStr, adv: int = 0, explode_depth: int = EXPLODE_DEPTH):
+    """Computes the exact distribution of a roll's (floored) total, without rolling.
+    Exploding dice are followed up to explode_depth times per die.
+    Raises InvalidArgument for rolls it can't compute exactly (e.g. the ra operator)
+    or that would take more than MAX_ODDS_WORK to.
+    Returns: Distribution"""
+    budget = WorkBudget(MAX_ODDS_WORK)
+    tokens = []
+    for step in compile_roll(rollStr):
+        if isinstance(step, DicePlan):
+            num_dice, ops = apply_adv(step, adv)
+            tokens.append(
+                _group_distribution(num_dice, step.dice_size, ops, explode_depth, budget)
+            )
+        elif isinstance(step, ConstantPlan):
+            tokens.append(step.value)
+        elif isinstance(step, OperatorPlan) and step.op.strip():
+            tokens.append(step.op.strip())
+    try:
+        total = evaluate_tokens(tokens)
+    except SyntaxError:
+        raise errors.InvalidArgument("No dice found to roll.")
+    except ZeroDivisionError:
+        raise errors.InvalidArgument("That roll divides by zero.")
+    if not isinstance(total, Distribution):
+        total = Distribution.constant(total)
+    return total.floor()
+
+
+def _selected_values(selector, candidates, size, greedy=False):
+    """The values a literal or >/< selector picks out of candidates, following
+    parse_selectors()."""
+    kind = selector[0]
+    if kind == ">":
+        num = int(selector.split(">")[1])
+        if greedy:
+            return set(range(num + 1, size + 1))
+        return {v for v in candidates if v > num}
+    if kind == "<":
+        num = int(selector.split("<")[1])
+        if greedy:
+            return set(range(1, num))
+        return {v for v in candidates if v < num}
+    return {int(selector)}
+
+
+def _group_distribution(num_dice, size, ops, explode_depth=EXPLODE_DEPTH, budget=None):
+    """The distribution of one dice group's total.
+    Operators that act on each die on its own (mi, ma, rr, ro, e and k/p with
+    literal or >/< selectors) are folded into a single-die distribution, which is
+    then summed num_dice times. A final kh/kl/ph/pl is handled by order statistics."""
+    unsupported = errors.InvalidArgument(
+        "I can't compute exact odds for {}d{}{}.".format(num_dice, size, "".join(ops))
+    )
+
+    # group the operators the way Roll.roll_dice() buffers them
+    steps = []
+    for index, op in enumerate(ops):
+        if op not in VALID_OPERATORS_ARRAY:
+            continue
+        selector = list_get(index + 1, 0, ops)
+        if steps and steps[-1][0] == op and op not in ("mi", "ma"):
+            steps[-1][1].append(selector)
+        else:
+            steps.append((op, [selector]))
+
+    fresh = {v: 1 / size for v in range(1, size + 1)}
+    die = dict(fresh)  # kept value -> probability
+    dropped = 0.0
+    explode = None
+    keep_order = None
+    for op, selectors in steps:
+        if explode is not None or keep_order is not None or op == "ra":
+            raise unsupported
+        if op in ("mi", "ma"):
+            bound = int(selectors[0])
+            clamped = {}
+            for v, p in die.items():
+                v = max(v, bound) if op == "mi" else min(v, bound)
+                clamped[v] = clamped.get(v, 0) + p
+            die = clamped
+            continue
+        if op in ("k", "p") and selectors[0] and selectors[0][0] in ("h", "l"):
+            if len(selectors) > 1:
+                raise unsupported
+            kind = selectors[0][0]
+            keep_order = (op, kind, int(selectors[0].split(kind)[1]))
+            continue
+        values = set()
+        for selector in selectors:
+            if selector[0] in ("h", "l"):
+                raise unsupported
+            values |= _selected_values(
+                selector, set(die) | set(fresh), size, greedy=op in ("rr", "e")
+            )
+        hit = sum(p for v, p in die.items() if v in values)
+        rest = {v: p for v, p in die.items() if v not in values}
+        if op == "k":
+            die, dropped = (
+                {v: p for v, p in die.items() if v in values},
+                dropped + sum(rest.values()),
+            )
+        elif op == "p":
+            die, dropped = rest, dropped + hit
+        elif op == "ro":
+            die = _mix(rest, fresh, hit)
+        elif op == "rr":
+            redrawn = {v: p for v, p in fresh.items() if v not in values}
+            if not redrawn:
+                raise unsupported
+            norm = sum(redrawn.values())
+            die = _mix(rest, {v: p / norm for v, p in redrawn.items()}, hit)
+        elif op == "e":
+            explode = values
+
+    if dropped:
+        die[0] = die.get(0, 0) + dropped
+    if explode is not None:
+        chain = Distribution.from_dict(fresh, budget)
+        for _ in range(explode_depth):
+            chain = _explode_once(fresh, explode, chain)
+        return _explode_once(die, explode, chain).sum_of(num_dice)
+    if keep_order is not None:
+        op, kind, num = keep_order
+        if op == "p":
+            if dropped:
+                raise unsupported
+            kind = "l" if kind == "h" else "h"
+            num = max(0, num_dice - num)
+        return _keep_distribution(die, dropped, num_dice, num, kind == "h", budget)
+    return Distribution.from_dict(die, budget).sum_of(num_dice)
+
+
+def _mix(base, replacement, weight):
+    """base (a partial distribution) plus replacement scaled by weight."""
+    out = dict(base)
+    for v, p in replacement.items():
+        out[v] = out.get(v, 0) + p * weight
+    return out
+
+
+def _explode_once(die, values, chain):
+    """A die that adds another die (distributed as chain) when it shows one of values."""
+    budget = chain.budget or WorkBudget(MAX_ODDS_WORK)
+    _spend_odds_work(budget, len(values) * len(chain.values) * ODDS_OUTER_COST)
+    stays = Distribution.from_dict(
+        {v: p for v, p in die.items() if v not in values} or {0: 0.0}
+    )
+    out = [stays.values], [stays.probs]
+    for v, p in die.items():
+        if v in values:
+            out[0].append(chain.values + v)
+            out[1].append(chain.probs * p)
+    return Distribution(numpy.concatenate(out[0]), numpy.concatenate(out[1]), budget)
+
+
+def _keep_distribution(die, dropped, num_dice, keep, highest=True, budget=None):
+    """The distribution of the sum of the highest (or lowest) keep dice out of
+    num_dice independent dice. Dice dropped by earlier operators show 0 and are
+    never kept ahead of a live die.
+    Works through the faces from the best down: once c of the r dice still unknown
+    show the current face, they are kept until keep dice have been kept."""
+    keep = min(keep, num_dice)
+    live = {v: p for v, p in die.items() if v != 0 or not dropped}
+    faces = sorted(live, reverse=highest)
+    if dropped:
+        faces.append(None)  # dropped dice rank behind every live face
+    # states x faces x counts, times the totals each state holds, which grow with the faces
+    _spend_odds_work(
+        budget or WorkBudget(MAX_ODDS_WORK),
+        len(faces) ** 2 * (num_dice + 1) * (keep + 1) ** 2 * ODDS_KEEP_COST,
+    )
+    probs = [live[f] if f is not None else dropped for f in faces]
+
+    done = {}  # total -> probability, once keep dice have been kept
+    # (dice still unknown, dice kept) -> {total: probability}
+    states = {(num_dice, 0): {0: 1.0}}
+    remaining_mass = 1.0
+    for face, p in zip(faces, probs):
+        q = min(1.0, p / remaining_mass) if remaining_mass > 0 else 1.0
+        remaining_mass -= p
+        value = face if face is not None else 0
+        next_states = {}
+        for (unknown, kept), totals in states.items():
+            need = keep - kept
+            for count in range(0, unknown + 1):
+                chance = comb(unknown, count) * q**count * (1 - q) ** (unknown - count)
+                if chance == 0:
+                    continue
+                taken = min(count, need)
+                target = (
+                    done
+                    if taken == need
+                    else next_states.setdefault((unknown - count, kept + taken), {})
+                )
+                for total, tp in totals.items():
+                    t = total + taken * value
+                    target[t] = target.get(t, 0) + tp * chance
+                if taken == need:
+                    # every larger count lands in the same place
+                    rest = 1 - sum(
+                        comb(unknown, c) * q**c * (1 - q) ** (unknown - c)
+                        for c in range(0, count + 1)
+                    )
+                    if rest > 0:
+                        for total, tp in totals.items():
+                            t = total + taken * value
+                            done[t] = done.get(t, 0) + tp * rest
+                    break
+        states = next_states
+    for totals in states.values():
+        for total, tp in totals.items():
+            done[total] = done.get(total, 0) + tp
+    return Distribution.from_dict(done, budget)
+
+
+def _spend_odds_work(budget, work):
+    """Charges work to an odds() WorkBudget before doing it.
+    Raises InvalidArgument if that leaves the budget exhausted."""
+    budget.spend(work)
+    if budget.exhausted():
+        raise errors.InvalidArgument("That roll is too complex to compute exactly.")
+
+
 if __name__ == "__main__":
     while True:
         print(roll(input().strip()))
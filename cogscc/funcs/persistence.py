@@ -0,0 +1,507 @@
+import asyncio
+import codecs
+import hashlib
+import json
+import logging
+import os
+import re
+import struct
+import time
+from urllib.parse import quote, unquote
+
+log = logging.getLogger(__name__)
+
+RECORD_SUFFIX = ".json"
+JOURNAL_FILE = "journal.jsonl"
+READ_CHUNK = 64 * 1024  # bytes read at a time when streaming a JSON save
+READ_BATCH = 16  # records read on the executor per round-trip from the event loop
+SNAPSHOT_MAGIC = b"CCSNAP"
+SNAPSHOT_VERSION = 1  # bump when the layout of the payload changes
+SNAPSHOT_SUFFIX = ".snap"
+ZSTD_LEVEL = 10
+CHUNK_GC_GRACE = 60 * 60  # seconds: chunks touched more recently than this are never garbage collected
+_SNAPSHOT_HEADER = struct.Struct(">6sB")  # magic, version
+
+
+class ToJson(json.JSONEncoder):
+    def default(self, obj):
+        if hasattr(obj, "__to_json__"):
+            return obj.__to_json__()
+        return json.JSONEncoder.default(self, obj)
+
+
+def dumps(obj, **kwargs):
+    return json.dumps(obj, cls=ToJson, ensure_ascii=False, **kwargs)
+
+
+# ==== records ====
+# A campaign is split into records, one per entity: each character, the calendar, the current location and each
+# location (with its weather). A record's key is a path into the {"characters": ..., "world": ...} dict that
+# !save has always written, e.g. ("characters", "slithy#1234") or ("world", "locations", "Greyhawk").
+def campaign_records(characters, world=None):
+    """Returns {key: JSON text} for every record of characters and, unless it is None, of the world."""
+    records = {("characters", player): dumps(c) for player, c in characters.items()}
+    if world is None:
+        return records
+    w = world.__to_json__()
+    for name, location in w.pop("locations", {}).items():
+        records[("world", "locations", name)] = dumps(location)
+    for attr, value in w.items():
+        records[("world", attr)] = dumps(value)
+    return records
+
+
+def campaign_dict(records):
+    """Inverse of campaign_records: returns the {"characters": ..., "world": ...} dict, with records parsed."""
+    out = {"characters": {}, "world": {"locations": {}}}
+    for key, text in records.items():
+        node = out
+        for part in key[:-1]:
+            node = node.setdefault(part, {})
+        node[key[-1]] = json.loads(text)
+    return out
+
+
+def snapshot_json(records):
+    """Assembles a whole campaign as compact JSON from its records, without re-serializing them."""
+    tree = {"characters": {}, "world": {"locations": {}}}
+    for key, text in records.items():
+        node = tree
+        for part in key[:-1]:
+            node = node.setdefault(part, {})
+        node[key[-1]] = text
+
+    def assemble(node):
+        if isinstance(node, str):
+            return node
+        return "{" + ",".join(f"{json.dumps(k, ensure_ascii=False)}:{assemble(v)}" for k, v in node.items()) + "}"
+
+    return assemble(tree)
+
+
+# ==== streaming JSON saves ====
+class _JsonStream:
+    """Reads JSON values one at a time from a binary file, only holding as much of it as the current value."""
+
+    _ws = re.compile(r"\s*")
+    _decoder = json.JSONDecoder()
+
+    def __init__(self, f, chunk_size=READ_CHUNK):
+        self.f = f
+        self.chunk_size = chunk_size
+        self._text = codecs.getincrementaldecoder("utf-8")()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, size):
+        """Reads up to size more bytes. Returns False at the end of the file."""
+        data = self.f.read(size)
+        self.buf = self.buf[self.pos :] + self._text.decode(data, final=not data)
+        self.pos = 0
+        self.eof = not data
+        return not self.eof
+
+    def peek(self):
+        while True:
+            self.pos = self._ws.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf) or not self._fill(self.chunk_size):
+                return self.buf[self.pos : self.pos + 1]
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"Expected {char!r} at byte {self.f.tell()}")
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self.buf, self.pos)
+                if end < len(self.buf) or self.eof:  # else a number might go on in the next chunk
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self._fill(size)
+            size *= 2  # a long value: read more at a time, so it isn't re-parsed once per chunk
+
+    def members(self):
+        """Iterates over the keys of the object about to be read; the caller reads each value."""
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(":")
+            yield key
+            end = self.peek()
+            self.pos += 1
+            if end == "}":
+                return
+            if end != ",":
+                raise ValueError(f"Expected ',' or '}}' at byte {self.f.tell()}")
+
+
+def iter_campaign_json(f, chunk_size=READ_CHUNK):
+    """Yields (key, value) of each character and the world of a JSON save as they are read from binary file f.
+    Keys are ("characters", player) or ("world",)."""
+    stream = _JsonStream(f, chunk_size)
+    for key in stream.members():
+        if key == "characters":
+            for player in stream.members():
+                yield ("characters", player), stream.value()
+        elif key == "world":
+            yield ("world",), stream.value()
+        else:  # saved before there was a world: the whole file is characters
+            yield ("characters", key), stream.value()
+
+
+def _take(iterator, n):
+    return [item for _, item in zip(range(n), iterator)]
+
+
+async def read_campaign_json(path, progress=None):
+    """Asynchronously yields what iter_campaign_json does, reading on the default executor.
+    progress, if given, is awaited with (bytes read, file size) after every batch of records."""
+    loop = asyncio.get_event_loop()
+    f = await loop.run_in_executor(None, open, path, "rb")
+    try:
+        size = os.fstat(f.fileno()).st_size
+        items = iter_campaign_json(f)
+        while True:
+            batch = await loop.run_in_executor(None, _take, items, READ_BATCH)
+            for item in batch:
+                yield item
+            if progress is not None:
+                await progress(f.tell(), size)
+            if len(batch) < READ_BATCH:
+                return
+    finally:
+        f.close()
+
+
+# ==== binary snapshots ====
+# A snapshot is the {"characters": ..., "world": ...} dict as msgpack, compressed with zstd, after a header of
+# SNAPSHOT_MAGIC and a one-byte format version. Both libraries are only needed to read or write snapshots.
+def snapshot_bytes(records):
+    """Returns a whole campaign as a compressed binary snapshot. Blocking, and CPU-bound for big campaigns."""
+    return _pack_snapshot(campaign_dict(records))
+
+
+def _pack_snapshot(campaign):
+    import msgpack
+    import zstandard
+
+    payload = msgpack.packb(campaign, use_bin_type=True)
+    header = _SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION)
+    return header + zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(payload)
+
+
+def is_snapshot(path):
+    with open(path, "rb") as f:
+        return f.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC
+
+
+def read_snapshot(path):
+    """Returns the campaign dict in a snapshot file. Blocking."""
+    import msgpack
+    import zstandard
+
+    with open(path, "rb") as f:
+        magic, version = _SNAPSHOT_HEADER.unpack(f.read(_SNAPSHOT_HEADER.size))
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not a campaign snapshot")
+        if version > SNAPSHOT_VERSION:
+            raise ValueError(f"{path} is a version {version} snapshot, this version reads up to {SNAPSHOT_VERSION}")
+        payload = zstandard.ZstdDecompressor().stream_reader(f).read()
+    return msgpack.unpackb(payload, raw=False)
+
+
+def convert_to_snapshot(path, out=None):
+    """Converts a JSON save to a snapshot at out (path + SNAPSHOT_SUFFIX by default). Returns out."""
+    out = out or path + SNAPSHOT_SUFFIX
+    campaign = {"characters": {}}
+    with open(path, "rb") as f:
+        for key, value in iter_campaign_json(f):
+            if key[0] == "world":
+                campaign["world"] = value
+            else:
+                campaign["characters"][key[1]] = value
+    write_atomic(out, _pack_snapshot(campaign))
+    return out
+
+
+def convert_to_json(path, out=None):
+    """Converts a snapshot to a JSON save at out (path without SNAPSHOT_SUFFIX by default). Returns out."""
+    out = out or (path[: -len(SNAPSHOT_SUFFIX)] if path.endswith(SNAPSHOT_SUFFIX) else path + ".json")
+    write_atomic(out, json.dumps(read_snapshot(path), ensure_ascii=False))
+    return out
+
+
+def record_filename(key):
+    # each part is quoted, so "+" can only be the separator
+    return "+".join(quote(part, safe="") for part in key) + RECORD_SUFFIX
+
+
+def record_key(filename):
+    return tuple(unquote(part) for part in filename[: -len(RECORD_SUFFIX)].split("+"))
+
+
+def digest(text):
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def write_atomic(path, data):
+    """Writes data (str or bytes) to path via a temporary file and a rename, so readers never see half a file."""
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        if isinstance(data, str):
+            data = data.encode()
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class CampaignStore:
+    """
+    A campaign saved as one file per record in a directory, plus a write-ahead journal.
+    The store remembers a digest of every record it has written or read, so a save only writes the records
+    that changed since (and deletes the ones that are gone): save time follows the size of the edit, not of
+    the campaign. Writes are atomic, and file I/O is done on the default executor.
+    Between saves, journal() appends the records that changed to journal.jsonl, one line per call. load()
+    replays the journal on top of the record files, and save() folds it into them and truncates it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._digests = None  # key -> digest of the record file, once the store has been read
+        self._live = None  # key -> digest of the record as of the end of the journal
+        self._lock = asyncio.Lock()  # one save or journal write at a time
+        self.journal_entries = 0
+
+    @property
+    def journal_path(self):
+        return os.path.join(self.path, JOURNAL_FILE)
+
+    def exists(self):
+        return os.path.isdir(self.path)
+
+    @staticmethod
+    def _diff(records, digests):
+        changed = {k: t for k, t in records.items() if digests.get(k) != digest(t)}
+        removed = [k for k in digests if k not in records]
+        return changed, removed
+
+    def diff(self, records):
+        """Returns ({key: text} of new or changed records, [keys of removed records]) since the last save."""
+        return self._diff(records, self._digests)
+
+    async def _scan(self):
+        # learn what is on disk before the first save or journal entry, so records removed since are deleted
+        if self._digests is None:
+            if self.exists():
+                await asyncio.get_event_loop().run_in_executor(None, self.load)
+            else:
+                self._digests, self._live = {}, {}
+
+    def write(self, changed, removed):
+        """Blocking: writes changed records, deletes removed ones and empties the journal."""
+        os.makedirs(self.path, exist_ok=True)
+        for key, text in changed.items():
+            write_atomic(os.path.join(self.path, record_filename(key)), text)
+            self._digests[key] = digest(text)
+        for key in removed:
+            try:
+                os.remove(os.path.join(self.path, record_filename(key)))
+            except FileNotFoundError:
+                pass
+            self._digests.pop(key, None)
+        try:
+            os.remove(self.journal_path)
+        except FileNotFoundError:
+            pass
+
+    async def save(self, records):
+        """Writes whatever changed in records and truncates the journal. Returns the number of records written or
+        deleted."""
+        async with self._lock:
+            await self._scan()
+            changed, removed = self.diff(records)
+            if changed or removed or self.journal_entries:
+                await asyncio.get_event_loop().run_in_executor(None, self.write, changed, removed)
+            self._live = dict(self._digests)
+            self.journal_entries = 0
+        log.debug(f"Saved {len(changed)} changed and {len(removed)} removed records to {self.path}")
+        return len(changed) + len(removed)
+
+    def _append(self, line):
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.journal_path, "ab") as f:
+            f.write(line.encode())
+            f.flush()
+            os.fsync(f.fileno())
+
+    async def journal(self, records, op, scopes=None):
+        """Appends the records that changed since the last journal entry (or save) to the journal.
+        scopes are the key prefixes that records covers, e.g. {("characters", player), ("world",)}: records under
+        them that are missing from records were removed, and the rest of the campaign is left alone. By default
+        records is the whole campaign.
+        Returns whether anything changed."""
+        async with self._lock:
+            await self._scan()
+            live = self._live
+            if scopes is not None:
+                live = {k: d for k, d in live.items() if any(k[: len(s)] == s for s in scopes)}
+            changed, removed = self._diff(records, live)
+            if not (changed or removed):
+                return False
+            entry = {"ts": time.time(), "op": op, "del": removed}
+            sets = ",".join(f"[{json.dumps(k, ensure_ascii=False)},{t}]" for k, t in changed.items())
+            line = json.dumps(entry, ensure_ascii=False)[:-1] + f', "set": [{sets}]}}\n'
+            await asyncio.get_event_loop().run_in_executor(None, self._append, line)
+            for key, text in changed.items():
+                self._live[key] = digest(text)
+            for key in removed:
+                self._live.pop(key, None)
+            self.journal_entries += 1
+            return True
+
+    def load(self):
+        """Blocking: returns {key: text} of every record in the store, with the journal replayed."""
+        records = {}
+        for filename in os.listdir(self.path):
+            if not filename.endswith(RECORD_SUFFIX):
+                continue  # e.g. a .tmp left by a crash mid-write
+            with open(os.path.join(self.path, filename), encoding="utf-8") as f:
+                records[record_key(filename)] = f.read()
+        self._digests = {k: digest(t) for k, t in records.items()}
+
+        self.journal_entries = 0
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, "rb+") as f:
+                good = 0  # end of the last complete entry
+                for line in f:
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError()
+                        entry = json.loads(line)
+                    except ValueError:  # torn by a crash mid-append: drop it so new entries aren't appended to it
+                        log.warning(f"Dropping incomplete journal entry in {self.journal_path}")
+                        f.truncate(good)
+                        break
+                    good += len(line)
+                    for key, record in entry["set"]:
+                        records[tuple(key)] = json.dumps(record, ensure_ascii=False)
+                    for key in entry["del"]:
+                        records.pop(tuple(key), None)
+                    self.journal_entries += 1
+        self._live = {k: digest(t) for k, t in records.items()}
+        return records
+
+
+# ==== deduplicated backups ====
+class BackupStore:
+    """
+    Content-addressed backups: every record is stored once as a chunk, named by the SHA-256 of its text, under
+    chunks/. A backup is a small manifest under backups/, listing its records' keys and chunk ids, so a backup
+    only adds the records that changed since the last one.
+    Backup ids are "<save>.<YYYYmmddHHMMSS>", the names full-copy backups have always had, so clean_saves can
+    prune manifests like it prunes backup files; gc() then deletes the chunks no manifest uses any more.
+    All methods are blocking.
+    """
+
+    def __init__(self, path):
+        self.chunk_dir = os.path.join(path, "chunks")
+        self.manifest_dir = os.path.join(path, "backups")
+
+    @staticmethod
+    def chunk_id(text):
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def _chunk_path(self, cid):
+        return os.path.join(self.chunk_dir, cid[:2], cid)
+
+    def write(self, backup_id, records):
+        """Writes a backup of records. Returns the number of new chunks it needed."""
+        manifest = []
+        new = 0
+        for key, text in records.items():
+            cid = self.chunk_id(text)
+            path = self._chunk_path(cid)
+            try:
+                os.utime(path)  # keeps gc() off chunks that a backup is being written with
+            except FileNotFoundError:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                write_atomic(path, text)
+                new += 1
+            manifest.append([key, cid])
+        os.makedirs(self.manifest_dir, exist_ok=True)
+        write_atomic(os.path.join(self.manifest_dir, backup_id), json.dumps({"records": manifest}))
+        return new
+
+    def exists(self, backup_id):
+        return os.path.isfile(os.path.join(self.manifest_dir, backup_id))
+
+    def read(self, backup_id):
+        """Returns {key: text} of the records in a backup."""
+        with open(os.path.join(self.manifest_dir, backup_id)) as f:
+            manifest = json.load(f)
+        records = {}
+        for key, cid in manifest["records"]:
+            with open(self._chunk_path(cid), encoding="utf-8") as f:
+                records[tuple(key)] = f.read()
+        return records
+
+    def backups(self):
+        """Returns the ids of all backups, oldest first within each save."""
+        if not os.path.isdir(self.manifest_dir):
+            return []
+        return sorted(f for f in os.listdir(self.manifest_dir) if not f.endswith(".tmp"))
+
+    def find(self, timestamp):
+        """Returns the ids of the backups whose YYYYmmddHHMMSS timestamp starts with timestamp, newest first."""
+        matches = [b for b in self.backups() if b.rsplit(".", 1)[-1].startswith(timestamp)]
+        return sorted(matches, key=lambda b: b.rsplit(".", 1)[-1], reverse=True)
+
+    def gc(self):
+        """Deletes the chunks that no backup uses. Returns the number deleted."""
+        used = set()
+        for backup_id in self.backups():
+            with open(os.path.join(self.manifest_dir, backup_id)) as f:
+                used.update(cid for _, cid in json.load(f)["records"])
+        deleted = 0
+        cutoff = time.time() - CHUNK_GC_GRACE
+        for root, _, files in os.walk(self.chunk_dir):
+            for cid in files:
+                path = os.path.join(root, cid)
+                if cid not in used and os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    deleted += 1
+        return deleted
+
+
+if __name__ == "__main__":
+    # python -m cogscc.funcs.persistence {snapshot,json} FILE...
+    # python -m cogscc.funcs.persistence gc SAVE_DIR
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Converts campaign saves between JSON and binary snapshots, or deletes unused backup chunks."
+    )
+    parser.add_argument("to", choices=["snapshot", "json", "gc"], help="the format to convert to, or gc")
+    parser.add_argument("files", nargs="+")
+    args = parser.parse_args()
+    if args.to == "gc":
+        for save_dir in args.files:
+            print(f"Deleted {BackupStore(save_dir).gc()} unused chunks from {save_dir}")
+        raise SystemExit()
+    convert = convert_to_snapshot if args.to == "snapshot" else convert_to_json
+    for file in args.files:
+        before = os.path.getsize(file)
+        out = convert(file)
+        print(f"{file} ({before} bytes) -> {out} ({os.path.getsize(out)} bytes)")
@@ -0,0 +1,68 @@
+import asyncio
+import logging
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from cogscc.models.errors import TooBusy
+
+log = logging.getLogger(__name__)
+
+POOL_WORKERS = 2
+MAX_PENDING = 8  # rolls running or waiting on the pool before new ones are refused
+MAX_PER_USER = 2  # rolls one user may have on the pool at once
+ROLL_TIMEOUT = 10.0  # seconds
+
+
+class RollPool:
+    """Runs expensive rolls on a small thread pool, so a big roll doesn't block the
+    event loop (and with it every shard's heartbeat on this process).
+    There is no unbounded queue: once max_pending rolls are running or waiting,
+    or a user already has per_user rolls going, new rolls are refused with TooBusy.
+    A roll that doesn't finish within timeout seconds is reported as failed; it
+    keeps its slot until its thread actually finishes."""
+
+    def __init__(
+        self,
+        workers: int = POOL_WORKERS,
+        max_pending: int = MAX_PENDING,
+        per_user: int = MAX_PER_USER,
+        timeout: float = ROLL_TIMEOUT,
+    ):
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="roll"
+        )
+        self.max_pending = max_pending
+        self.per_user = per_user
+        self.timeout = timeout
+        self.pending = 0
+        self.users = Counter()
+
+    async def run(self, user_id, func, *args):
+        """Runs func(*args) on the pool for user_id.
+        Returns: Whatever func returns."""
+        if self.pending >= self.max_pending:
+            raise TooBusy(
+                "I'm rolling a lot of dice right now. Please try again in a moment."
+            )
+        if self.users[user_id] >= self.per_user:
+            raise TooBusy("You already have dice rolling. Please wait for them to land.")
+
+        self.pending += 1
+        self.users[user_id] += 1
+        future = asyncio.get_event_loop().run_in_executor(self.executor, func, *args)
+        future.add_done_callback(lambda _: self._release(user_id))
+        try:
+            # shield: a timed-out roll can't be stopped, so keep its slot until it ends
+            return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            log.warning(f"Roll for user {user_id} timed out after {self.timeout}s")
+            raise TooBusy("That roll took too long, so I gave up on it.")
+
+    def _release(self, user_id):
+        self.pending -= 1
+        self.users[user_id] -= 1
+        if not self.users[user_id]:
+            del self.users[user_id]
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -1,10 +1,26 @@
+import asyncio
+import os
+import re
 import time
-import json
 import random
-from os.path import basename
+from os.path import basename, join
 from discord.ext import commands
 from cogscc.funcs.dice import roll
 from cogscc.funcs import utils
+from cogscc.funcs.persistence import (
+    SNAPSHOT_SUFFIX,
+    BackupStore,
+    CampaignStore,
+    ToJson,  # imported from here by the world tests and the sandbox
+    campaign_dict,
+    campaign_records,
+    is_snapshot,
+    read_campaign_json,
+    read_snapshot,
+    snapshot_bytes,
+    snapshot_json,
+    write_atomic,
+)
 from cogscc.character import Character
 from cogscc.monster import Monster
 import cogscc.npc
@@ -19,6 +35,11 @@ from cogscc.models.errors import (
 from cogscc.world.world import GHWorld
 from cogscc.world.location import GHLocation
 
+JOURNAL_COMPACT_ENTRIES = 200  # journal entries before they are folded into the record files
+PROGRESS_MIN_BYTES = 1024 * 1024  # report progress when loading saves bigger than this
+PROGRESS_INTERVAL = 2  # seconds between progress reports
+BACKUP_SUFFIX = re.compile(r"\.(\d{14})(\.snap)?$")  # what !save adds to the name of a save for its backups
+
 
 def getArgDict(*args):
     synonymDict = {"cap": "capacity", "dmg": "damage", "rng": "range", "val": "value"}
@@ -53,55 +74,181 @@ def getArgDict(*args):
     return argDict
 
 
-class ToJson(json.JSONEncoder):
-    def default(self, obj):
-        if hasattr(obj, "__to_json__"):
-            return obj.__to_json__()
-        return json.JSONEncoder.default(self, obj)
-
-
 class Game(commands.Cog):
     gm_roles = ["Castle Keeper", "Game Master", "Dungeon Master"]
+    save_dir = "/save"
 
     def __init__(self, bot):
         self.bot = bot
         self.characters = {}
         self.monsters = []
         self.world = GHWorld()
+        self.stores = {}  # campaign name -> CampaignStore
+        self.campaign = None  # the campaign last saved or loaded: changes are journaled to its store
+        self.dirty = set()  # prefixes of the record keys changed by commands since the last journal entry
+        self.backup_format = getattr(bot, "backup_format", "chunks")  # or "json" or "snapshot"
+        self._compacting = None
+
+    @property
+    def backups(self):
+        return BackupStore(self.save_dir)
+
+    def getStore(self, filename):
+        """The per-record store of a campaign: /save/campaigns/<filename>/."""
+        name = basename(filename)
+        if name not in self.stores:
+            self.stores[name] = CampaignStore(join(self.save_dir, "campaigns", name))
+        return self.stores[name]
 
     @commands.command(name="save")
     async def saveJson(self, ctx, filename: str = "characters.json"):
         """Save characters to a file in JSON format."""
-        with open(f"/save/{basename(filename)}", "w") as f:
-            json.dump({"characters": self.characters, "world": self.world}, f, cls=ToJson, indent=2,
-                      ensure_ascii=False)
+        records = campaign_records(self.characters, self.world)
+        written = await self.getStore(filename).save(records)
+        self.campaign = basename(filename)
         ts = time.gmtime()
         timestamp = time.strftime("%Y%m%d%H%M%S", ts)
         filename_backup = f"{basename(filename)}.{timestamp}"
-        with open(f"/save/{filename_backup}", "w") as f:
-            json.dump({"characters": self.characters, "world": self.world}, f, cls=ToJson)
-        await ctx.send(f"Characters and calendar saved as {filename_backup}")
+        if self.backup_format == "chunks":
+            await asyncio.get_event_loop().run_in_executor(None, self.backups.write, filename_backup, records)
+        else:
+            if self.backup_format == "snapshot":
+                filename_backup += SNAPSHOT_SUFFIX
+                encode = snapshot_bytes
+            else:
+                encode = snapshot_json
+            await asyncio.get_event_loop().run_in_executor(
+                None, lambda: write_atomic(join(self.save_dir, filename_backup), encode(records))
+            )
+        await ctx.send(
+            f"Characters and calendar saved as {filename_backup} ({written} of {len(records)} records changed)"
+        )
 
     @commands.command(name="load")
     async def loadJson(self, ctx, filename: str = "characters.json"):
-        """Load characters from a JSON-formatted file."""
+        """Load characters from a JSON-formatted file.
+        Usage: !load [<file>|<backup ID>|<timestamp>]
+               where a timestamp (YYYYmmddHHMMSS, or the start of one, like YYYYmmdd) loads the latest backup
+               taken then; see !backups"""
         self.gmOnly(ctx)
-        with open(f"/save/{basename(filename)}", "r") as f:
-            raw = json.load(f)
-            if "world" not in raw:
-                chars = raw
+        filename = await self.findSave(filename)
+        characters = {}
+        world = None
+        async for key, value in self.readCampaign(ctx, filename):
+            if key[0] == "world":
+                world = GHWorld.__from_dict__(value)
+            elif value.get("type", ""):
+                characters[key[1]] = Monster.__from_dict__(value)
             else:
-                chars = raw["characters"]
-                self.world = GHWorld.__from_dict__(raw["world"])
+                characters[key[1]] = Character.__from_dict__(value)
+        self.characters.update(characters)
+        if world is not None:
+            self.world = world
+        self.campaign = BACKUP_SUFFIX.sub("", basename(filename))  # restoring a backup continues its campaign
+        self.markChanged(*self.characters, world=True)  # what was loaded may not be what the campaign's store holds
+        await ctx.send(f"Characters, calendar and NPCs loaded from {filename}.")
 
-            for player, character in chars.items():
-                if character.get("type", ""):
-                    self.characters[player] = Monster.__from_dict__(character)
-                else:
-                    self.characters[player] = Character.__from_dict__(character)
+    @commands.command(name="backups")
+    async def listBackups(self, ctx, filename: str = "characters.json", number: int = 10):
+        """List the most recent backups of a save.
+        Usage: !backups [<file>] [<number>]"""
+        self.gmOnly(ctx)
+        name = basename(filename)
+        backups = await asyncio.get_event_loop().run_in_executor(None, self.allBackups)
+        backups = [b for b in backups if BACKUP_SUFFIX.sub("", b) == name][-number:]
+        if not backups:
+            await ctx.send(f"There are no backups of {name}.")
+        else:
+            await ctx.send(f"Backups of {name}:\n" + "\n".join(reversed(backups)))
+
+    def allBackups(self):
+        """Blocking: returns the ids of the backups of every save, in any format, oldest first."""
+        backups = set(self.backups.backups())
+        if os.path.isdir(self.save_dir):
+            backups.update(os.listdir(self.save_dir))  # full-copy backups, as JSON or snapshots
+        backups = [b for b in backups if BACKUP_SUFFIX.search(b)]
+        return sorted(backups, key=lambda b: BACKUP_SUFFIX.search(b).group(1))
+
+    async def findSave(self, filename):
+        """Returns the name of the save to load: filename, or for a timestamp, the id of the latest backup then."""
+        filename = basename(filename)
+        if not filename.isdigit():
+            return filename
+        backups = await asyncio.get_event_loop().run_in_executor(None, self.allBackups)
+        matches = [b for b in reversed(backups) if BACKUP_SUFFIX.search(b).group(1).startswith(filename)]
+        if not matches:
+            raise InvalidArgument(f"There is no backup from {filename}.")
+        saves = {BACKUP_SUFFIX.sub("", b) for b in matches}
+        if len(saves) > 1:
+            raise AmbiguousMatch(
+                f"There are backups of {', '.join(sorted(saves))} from {filename}, use the backup ID."
+            )
+        return matches[0]
+
+    async def readCampaign(self, ctx, filename):
+        """Yields (key, value) of each character and the world of a saved campaign, reading off the event loop."""
+        loop = asyncio.get_event_loop()
+        filename = basename(filename)
+        store = self.getStore(filename)
+        path = join(self.save_dir, filename)
+        if store.exists():
+            raw = await loop.run_in_executor(None, lambda: campaign_dict(store.load()))
+        elif await loop.run_in_executor(None, self.backups.exists, filename):
+            raw = await loop.run_in_executor(None, lambda: campaign_dict(self.backups.read(filename)))
+        elif await loop.run_in_executor(None, is_snapshot, path):
+            raw = await loop.run_in_executor(None, read_snapshot, path)
+        else:
+            raw = None
+        if raw is not None:
+            for player, character in raw["characters"].items():
+                yield ("characters", player), character
+            if "world" in raw:
+                yield ("world",), raw["world"]
+            return
 
-        await ctx.send(f"Characters, calendar and NPCs loaded from {filename}.")
+        # a backup, or a campaign saved before per-record saves: stream it, with progress for big files
+        message = None
+        last_report = time.monotonic()
 
+        async def progress(done, size):
+            nonlocal message, last_report
+            if size < PROGRESS_MIN_BYTES or time.monotonic() - last_report < PROGRESS_INTERVAL:
+                return
+            last_report = time.monotonic()
+            text = f"Loading {basename(filename)}... {done * 100 // size}%"
+            if message is None:
+                message = await ctx.send(text)
+            else:
+                await message.edit(content=text)
+
+        async for item in read_campaign_json(path, progress):
+            yield item
+
+    def markChanged(self, *players, world=False):
+        """Marks the characters of players (and the world) as changed by the running command, for the journal."""
+        self.dirty.update(("characters", player) for player in players)
+        if world:
+            self.dirty.add(("world",))
+
+    async def cog_after_invoke(self, ctx):
+        # journal what the command changed, so a crash doesn't lose everything since the last !save
+        dirty, self.dirty = self.dirty, set()
+        if self.campaign is None or not dirty:
+            return
+        store = self.getStore(self.campaign)
+        players = [key[1] for key in dirty if key[0] == "characters"]
+        characters = {player: self.characters[player] for player in players if player in self.characters}
+        world = self.world if ("world",) in dirty else None
+        await store.journal(campaign_records(characters, world), ctx.command.qualified_name, dirty)
+        if store.journal_entries >= JOURNAL_COMPACT_ENTRIES and self._compacting is None:
+            self._compacting = asyncio.ensure_future(self.compact(store))
+
+    async def compact(self, store):
+        """Folds the journal into the record files."""
+        try:
+            await store.save(campaign_records(self.characters, self.world))
+        finally:
+            self._compacting = None
 
     def isGm(self, ctx):
         # return ctx.author.name == 'slithy'
@@ -163,6 +310,7 @@ class Game(commands.Cog):
             )
             return
         self.characters[player] = Character(name, race, xclass, level)
+        self.markChanged(player)
         await ctx.send(self.characters.get(player).showSummary(f"{player} is playing "))
         return
 
@@ -190,6 +338,7 @@ class Game(commands.Cog):
                 f"{name} {random_death}. :skull:\n"
                 + self.characters.get(player).showInventory("", ["all"])
             )
+            self.markChanged(player)
             del self.characters[player]
         else:
             await ctx.send(f"{player} does not have a character.")
@@ -210,6 +359,7 @@ class Game(commands.Cog):
         Usage: !assign <str> <dex> <con> <int> <wis> <cha> [<hp>]"""
         player = str(ctx.author)
         if player in self.characters:
+            self.markChanged(player)
             self.characters.get(player).assignStats(
                 strength, dexterity, constitution, intelligence, wisdom, charisma, hp
             )
@@ -232,6 +382,7 @@ class Game(commands.Cog):
         Usage: !assign <first prime> [<second prime>]"""
         player = str(ctx.author)
         if player in self.characters:
+            self.markChanged(player)
             self.characters.get(player).setPrimes(
                 first_prime, second_prime, third_prime
             )
@@ -247,6 +398,7 @@ class Game(commands.Cog):
                where alignment is one of: LG, LN, LE, NG, N, NE, CG, CN, CE"""
         player = str(ctx.author)
         if player in self.characters:
+            self.markChanged(player)
             self.characters.get(player).setAlignment(alignment)
             await ctx.send(
                 f"{self.characters.get(player).getName()} is {self.characters.get(player).getAlignment()}"
@@ -382,6 +534,7 @@ class Game(commands.Cog):
         Usage: !damage <character> <damage_dice>"""
         self.gmOnly(ctx)
         player = self.getPlayer(character)
+        self.markChanged(player)
         await ctx.send(self.characters[player].damage(dmg))
 
     @commands.command(name="energy_drain")
@@ -390,6 +543,7 @@ class Game(commands.Cog):
         Usage: !energy_drain <character> <no_levels>"""
         self.gmOnly(ctx)
         player = self.getPlayer(character)
+        self.markChanged(player)
         await ctx.send(self.characters[player].energyDrain(levels))
 
     @commands.command(name="heal")
@@ -397,6 +551,7 @@ class Game(commands.Cog):
         """Heals the specified character.
         Usage: !heal <character> <healing_dice>"""
         player = self.getPlayer(character)
+        self.markChanged(player)
         await ctx.send(self.characters[player].heal(hp))
 
     @commands.command(name="heal_all")
@@ -409,6 +564,7 @@ class Game(commands.Cog):
             if character.disabled:
                 continue
             elif character.isActive():
+                self.markChanged(player)
                 await ctx.send(self.characters[player].heal(val))
 
     @commands.command(name="first_aid", aliases=["firstaid", "aid"])
@@ -417,6 +573,7 @@ class Game(commands.Cog):
         First aid does not restore any hit points, but can stop bleeding and restore unconscious characters to consciousness.
         Usage: !first_aid <character>"""
         player = self.getPlayer(character)
+        self.markChanged(player)
         await ctx.send(self.characters[player].first_aid())
 
     @commands.command(name="rest")
@@ -426,6 +583,7 @@ class Game(commands.Cog):
         result = ""
         if duration < 2:
             duration = 1
+        self.markChanged(*self.characters, world=True)
         for player, character in self.characters.items():
             result += character.rest(duration)
 
@@ -502,6 +660,7 @@ class Game(commands.Cog):
                   `!equip "Mail Shirt" wearable ev:3 ac:4`"""
         player = str(ctx.author)
         if player in self.characters:
+            self.markChanged(player)
             argDict = getArgDict(*args)
             # If type not specified, try to infer it from the attributes
             if argDict.get("name", "") == "":
@@ -553,6 +712,7 @@ class Game(commands.Cog):
         Usage: `!edit "Item description" [key:value]...`"""
         player = str(ctx.author)
         if player in self.characters:
+            self.markChanged(player)
             argDict = getArgDict(*args)
             await ctx.send(self.characters.get(player).edit(description, argDict))
         else:
@@ -566,6 +726,7 @@ class Game(commands.Cog):
         Usage: !equip "Old Description" "New Description" ["Plural"]"""
         player = str(ctx.author)
         if player in self.characters:
+            self.markChanged(player)
             await ctx.send(
                 self.characters.get(player).rename(description, new_description, plural)
             )
@@ -597,9 +758,11 @@ class Game(commands.Cog):
                 raise InvalidArgument(
                     "Wrong number of arguments. Try: `!give <item> to <character>`"
                 )
+            recipient = self.getPlayer(recipient)
+            self.markChanged(player, recipient)
             await ctx.send(
                 self.characters.get(player).give(
-                    count, description, self.characters.get(self.getPlayer(recipient))
+                    count, description, self.characters.get(recipient)
                 )
             )
         else:
@@ -611,6 +774,7 @@ class Game(commands.Cog):
         Usage: !wield "Weapon Name" """
         player = str(ctx.author)
         if player in self.characters:
+            self.markChanged(player)
             await ctx.send(self.characters.get(player).wield(description))
         else:
             await ctx.send(f"{player} does not have a character.")
@@ -623,6 +787,7 @@ class Game(commands.Cog):
         Example: `wear ring "on left hand"`"""
         player = str(ctx.author)
         if player in self.characters:
+            self.markChanged(player)
             await ctx.send(self.characters.get(player).wear(description, location))
         else:
             await ctx.send(f"{player} does not have a character.")
@@ -646,6 +811,7 @@ class Game(commands.Cog):
         Usage: !remove "Item Description" """
         player = str(ctx.author)
         if player in self.characters:
+            self.markChanged(player)
             await ctx.send(self.characters.get(player).takeOff(description))
         else:
             await ctx.send(f"{player} does not have a character.")
@@ -658,6 +824,7 @@ class Game(commands.Cog):
             container = instr
         player = str(ctx.author)
         if player in self.characters:
+            self.markChanged(player)
             await ctx.send(self.characters.get(player).put(description, container))
         else:
             await ctx.send(f"{player} does not have a character.")
@@ -669,6 +836,7 @@ class Game(commands.Cog):
                where count is the number of this item you want to drop (default: 1)"""
         player = str(ctx.author)
         if player in self.characters:
+            self.markChanged(player)
             await ctx.send(
                 self.characters.get(player).dropEquipment(description, count)
             )
@@ -687,6 +855,7 @@ class Game(commands.Cog):
                !cp (copper pieces)"""
         player = str(ctx.author)
         if player in self.characters:
+            self.markChanged(player)
             await ctx.send(
                 self.characters.get(player).managePurse(ctx.invoked_with, amount)
             )
@@ -702,6 +871,7 @@ class Game(commands.Cog):
         npcs = cogscc.npc.load()
         for player, npc in npcs.items():
             self.characters[player] = npc
+        self.markChanged(*npcs)
         await ctx.send(f"NPCs loaded.")
 
     def getPlayer(self, character_name: str):
@@ -727,6 +897,7 @@ class Game(commands.Cog):
         """Disables the specified character."""
         self.gmOnly(ctx)
         player = self.getPlayer(character)
+        self.markChanged(player)
         self.characters[player].disabled = True
         await ctx.send(f"{player}'s character has been disabled for this session.")
 
@@ -735,6 +906,7 @@ class Game(commands.Cog):
         """Enables the specified character."""
         self.gmOnly(ctx)
         player = self.getPlayer(character)
+        self.markChanged(player)
         self.characters[player].disabled = False
         await ctx.send(f"{player}'s character has been re-enabled.")
 
@@ -744,6 +916,7 @@ class Game(commands.Cog):
         Usage: !gm_note <character> <item> [<description>]"""
         self.gmOnly(ctx)
         player = self.getPlayer(character)
+        self.markChanged(player)
         await ctx.send(self.characters[player].gmNote(item, description))
 
     @commands.command(name="level_up", aliases=["levelup"])
@@ -751,12 +924,14 @@ class Game(commands.Cog):
         """Levels up the specified character."""
         self.gmOnly(ctx)
         player = self.getPlayer(character)
+        self.markChanged(player)
         await ctx.send(self.characters[player].levelUp())
 
     @commands.command(name="euthanise", aliases=["kill"])
     async def deleteCharacter(self, ctx, player: str):
         """Ends the suffering of the character belonging to the specified player."""
         self.gmOnly(ctx)
+        self.markChanged(player)
         del self.characters[player]
         await ctx.send(f"The suffering of {player}'s character has been ended.")
 
@@ -784,6 +959,7 @@ class Game(commands.Cog):
         """Sets character god."""
         player = str(ctx.author)
         if player in self.characters:
+            self.markChanged(player)
             self.characters.get(player).setGod(god)
             await ctx.send(
                 f"{self.characters.get(player).getName()} worships"
@@ -805,6 +981,7 @@ class Game(commands.Cog):
     async def swapWeapons(self, ctx):
         """Character swaps weapons."""
         player = str(ctx.author)
+        self.markChanged(player)
         await ctx.send(self.characters.get(player).swapWeapons())
 
     @commands.command(name="attack", aliases=["attacks", "atk", "atks"])
@@ -818,6 +995,7 @@ class Game(commands.Cog):
     async def throw(self, ctx, weapon_or_ammo_description: str):
         """Character performs a standard throw attack."""
         player = str(ctx.author)
+        self.markChanged(player)
         atks = self.characters.get(player).getThrowAtk(
             ammo_or_weapon_name=weapon_or_ammo_description
         )
@@ -827,6 +1005,7 @@ class Game(commands.Cog):
     async def shoot(self, ctx, ammo_description: str):
         """Character performs standard melee attacks."""
         player = str(ctx.author)
+        self.markChanged(player)
         atks = self.characters.get(player).getShootAtk(ammo_name=ammo_description)
         await ctx.send(atks)
 
@@ -834,18 +1013,21 @@ class Game(commands.Cog):
     async def pickUp(self, ctx, weapon_description: str):
         """Pick up a dropped item."""
         player = str(ctx.author)
+        self.markChanged(player)
         await ctx.send(self.characters.get(player).equipment.pickUp(weapon_description))
 
     @commands.command(name="add_tag", aliases=["tag"])
     async def addTag(self, ctx, description: str, tag: str):
         """Pick up a dropped item."""
         player = str(ctx.author)
+        self.markChanged(player)
         await ctx.send(self.characters.get(player).equipment.addTag(description, tag))
 
     @commands.command(name="remove_tag", aliases=["untag"])
     async def removeTag(self, ctx, description: str, tag: str):
         """Pick up a dropped item."""
         player = str(ctx.author)
+        self.markChanged(player)
         await ctx.send(
             self.characters.get(player).equipment.removeTag(description, tag)
         )
@@ -864,6 +1046,7 @@ class Game(commands.Cog):
         if not isinstance(day, int):
             raise InvalidArgument(f"To set the calendar you need to provide the number of days since day-0.")
 
+        self.markChanged(world=True)
         self.world.set_date(day)
         await ctx.send(f"The calendar is set to: \n{self.world.calendar.getDate()}")
 
@@ -887,17 +1070,20 @@ class Game(commands.Cog):
     @commands.command(name="reset_weather")
     async def resetWeather(self, ctx):
         """Reset weather"""
+        self.markChanged(world=True)
         await ctx.send(self.world.reset_weather())
 
     @commands.command(name="add_location")
     async def addLocation(self, ctx, name: str, terrain: str, latitude: float, altitude: float):
         """Add location"""
         l = GHLocation(name, terrain, latitude, altitude)
+        self.markChanged(world=True)
         await ctx.send(self.world.add_location(l))
 
     @commands.command(name="set_current_location", aliases=["set_location"])
     async def setCurrentLocation(self, ctx, name: str):
         """Set current location"""
+        self.markChanged(world=True)
         await ctx.send(self.world.set_current_location(name))
 
     @commands.command(name="get_current_location", aliases=["location"])
@@ -913,6 +1099,7 @@ class Game(commands.Cog):
     @commands.command(name="remove_location")
     async def removeLocation(self, ctx, name):
         """Get all locations"""
+        self.markChanged(world=True)
         await ctx.send(self.world.remove_location())
 
     @commands.command(name='draw', aliases=['deck'])
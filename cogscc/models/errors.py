@@ -24,6 +24,12 @@ class NotAllowed(BambleweenyException):
     pass
 
 
+class TooBusy(BambleweenyException):
+    """Raised when work is refused because too much is already in progress."""
+
+    pass
+
+
 class MissingArgument(BambleweenyException):
     """Raised when a command is missing a required argument."""
 
@@ -1,4 +1,4 @@
-from cogscc.funcs.dice import roll
+from cogscc.funcs.dice import odds, roll
 from utils.constants import STAT_ABBREVIATIONS
 from cogscc.models.errors import InvalidArgument
 
@@ -156,6 +156,14 @@ class BaseStats:
         else:
             return 0
 
+    def siegeOdds(self, level: int, stat: str, bonus: int, cl: int):
+        """Returns: The chance (0-1) that siegeCheck() succeeds against challenge level cl.
+        With no known CL, the check succeeds on anything above the challenge base."""
+        cb = 18
+        all_mods = level + self.getMod(stat) + self.getPrime(stat) + bonus
+        target = cb + 1 if cl == 0 else cb + cl
+        return odds(f"1d20{all_mods:+}").at_least(target)
+
     def siegeCheck(self, name: str, level: int, stat: str, bonus: int, cl: int):
         cb = 18
         mod = self.getMod(stat)
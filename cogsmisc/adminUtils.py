@@ -5,6 +5,8 @@ Created on Sep 23, 2016
 """
 import asyncio
 import logging
+import time
+from collections import Counter, defaultdict
 from math import floor
 
 import discord
@@ -18,6 +20,37 @@ from utils import checks, config
 log = logging.getLogger(__name__)
 
 COMMAND_PUBSUB_CHANNEL = f"admin-commands:{config.ENVIRONMENT}"  # >:c
+PS_CODEC = redis.get_ps_codec(config.PUBSUB_CODEC)
+
+
+async def publish_command(bot, command, args=None, kwargs=None):
+    """Sends a command to every cluster without waiting for replies (see AdminUtils.pscall)."""
+    request = redis.PubSubCommand.new(bot, command, args, kwargs)
+    await bot.rdb.publish(COMMAND_PUBSUB_CHANNEL, PS_CODEC.encode([request.to_dict()]))
+
+
+class PendingCall:
+    """
+    The replies to one pscall, as they arrive. `done` resolves with the replies as soon as
+    expected_replies clusters have answered; `updates` gets each (cluster_id, reply_data).
+    """
+
+    def __init__(self, request, expected_replies, timeout):
+        self.request = request
+        self.expected_replies = expected_replies
+        self.timeout = timeout
+        self.replies = {}
+        self.updates = asyncio.Queue()
+        self.done = asyncio.get_event_loop().create_future()
+        self.started = time.monotonic()
+        if expected_replies <= 0:
+            self.done.set_result(self.replies)
+
+    def add_reply(self, sender, data):
+        self.replies[sender] = data
+        self.updates.put_nowait((sender, data))
+        if len(self.replies) >= self.expected_replies and not self.done.done():
+            self.done.set_result(self.replies)
 
 
 class AdminUtils(commands.Cog):
@@ -33,17 +66,23 @@ class AdminUtils(commands.Cog):
         self.whitelisted_serv_ids = set()
 
         # pubsub stuff
+        self._ps_publisher = redis.PubSubPublisher(bot.rdb, COMMAND_PUBSUB_CHANNEL, PS_CODEC)
         self._ps_cmd_map = {}  # set up in admin_pubsub()
-        self._ps_requests_pending = {}
+        self._ps_requests_pending = {}  # request id -> PendingCall
+        self.ps_metrics = defaultdict(Counter)  # command -> calls, timeouts, cancelled, replies, ms
 
     # ==== setup tasks ====
     async def load_admin(self):
-        self.bot.muted = set(await self.bot.rdb.jget('muted', []))
-        self.blacklisted_serv_ids = set(await self.bot.rdb.jget('blacklist', []))
-        self.whitelisted_serv_ids = set(await self.bot.rdb.jget('server-whitelist', []))
-
-        loglevels = await self.bot.rdb.jget('loglevels', {})
-        for logger, level in loglevels.items():
+        async with self.bot.rdb.pipeline() as p:
+            muted = p.jget('muted', [])
+            blacklist = p.jget('blacklist', [])
+            whitelist = p.jget('server-whitelist', [])
+            loglevels = p.jget('loglevels', {})
+        self.bot.muted = set(muted.result())
+        self.blacklisted_serv_ids = set(blacklist.result())
+        self.whitelisted_serv_ids = set(whitelist.result())
+
+        for logger, level in loglevels.result().items():
             try:
                 logging.getLogger(logger).setLevel(level)
             except:
@@ -58,10 +97,13 @@ class AdminUtils(commands.Cog):
             "reload_lists": self._reload_lists,
             "serv_info": self._serv_info,
             "whois": self._whois,
-            "ping": self._ping
+            "ping": self._ping,
+            "invalidate_prefix": self._invalidate_prefix,
+            "invalidate_aliases": self._invalidate_aliases,
+            "invalidate_rdb": self._invalidate_rdb
         }
         channel = (await self.bot.rdb.subscribe(COMMAND_PUBSUB_CHANNEL))[0]
-        async for msg in channel.iter(encoding="utf-8"):
+        async for msg in channel.iter(encoding=PS_CODEC.encoding):
             try:
                 await self._ps_recv(msg)
             except Exception as e:
@@ -162,6 +204,28 @@ class AdminUtils(commands.Cog):
         resp = await self.pscall("reload_static")
         await self._send_replies(ctx, resp)
 
+    @commands.command(hidden=True)
+    @checks.is_owner()
+    async def psstats(self, ctx):
+        """Shows this cluster's pubsub call metrics."""
+        lines = []
+        for command, m in sorted(self.ps_metrics.items()):
+            avg = m['ms'] / m['calls'] if m['calls'] else 0
+            lines.append(f"{command}: {m['calls']} calls, {m['timeouts']} timed out, {m['cancelled']} cancelled, "
+                         f"{m['replies']} replies, {avg:.0f}ms avg")
+        await ctx.send("```\n{}\n```".format('\n'.join(lines) or "No calls yet."))
+
+    @commands.command(hidden=True)
+    @checks.is_owner()
+    async def rdbcache(self, ctx, *keys):
+        """Shows this cluster's redis cache hits and misses. With keys, drops them from every cluster's cache."""
+        if keys:
+            await publish_command(self.bot, "invalidate_rdb", args=list(keys))
+            return await ctx.send(f"Invalidated {', '.join(keys)}.")
+        lines = [f"{key}: {hits} hits, {misses} misses"
+                 for key, (hits, misses) in sorted(self.bot.rdb.cache_stats().items())]
+        await ctx.send("```\n{}\n```".format('\n'.join(lines) or "Nothing cached yet."))
+
     # ==== listener ====
     @commands.Cog.listener()
     async def on_guild_join(self, server):
@@ -216,9 +280,13 @@ class AdminUtils(commands.Cog):
         return "OK"
 
     async def _reload_lists(self):
-        self.blacklisted_serv_ids = set(await self.bot.rdb.jget('blacklist', []))
-        self.whitelisted_serv_ids = set(await self.bot.rdb.jget('server-whitelist', []))
-        self.bot.muted = set(await self.bot.rdb.jget('muted', []))
+        async with self.bot.rdb.pipeline() as p:
+            blacklist = p.jget('blacklist', [])
+            whitelist = p.jget('server-whitelist', [])
+            muted = p.jget('muted', [])
+        self.blacklisted_serv_ids = set(blacklist.result())
+        self.whitelisted_serv_ids = set(whitelist.result())
+        self.bot.muted = set(muted.result())
         return "OK"
 
     async def _serv_info(self, guild_id):
@@ -249,33 +317,84 @@ class AdminUtils(commands.Cog):
     async def _ping(self):
         return dict(self.bot.latencies)
 
+    async def _invalidate_prefix(self, guild_id):
+        self.bot.prefixes.invalidate(guild_id)
+        return False  # nobody is waiting for a reply
+
+    async def _invalidate_aliases(self, owner=None, server=None):
+        self.bot.alias_cache.invalidate(owner=owner, server=server)
+        return False
+
+    async def _invalidate_rdb(self, *keys):
+        self.bot.rdb.invalidate(*keys)
+        return False
+
     # ==== pubsub ====
     async def pscall(self, command, args=None, kwargs=None, *, expected_replies=config.NUM_CLUSTERS or 1, timeout=30):
-        """Makes an IPC call to all clusters. Returns a dict of {cluster_id: reply_data}."""
+        """Makes an IPC call to all clusters. Returns a dict of {cluster_id: reply_data}.
+        Returns as soon as expected_replies clusters have replied, or with whatever replies there are after
+        timeout seconds."""
+        pending = await self._ps_send(command, args, kwargs, expected_replies, timeout)
+        try:
+            await asyncio.wait_for(asyncio.shield(pending.done), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self._ps_finish(pending)
+        return pending.replies
+
+    async def pscall_iter(self, command, args=None, kwargs=None, *, expected_replies=config.NUM_CLUSTERS or 1,
+                          timeout=30):
+        """Like pscall(), but yields (cluster_id, reply_data) as each reply arrives."""
+        pending = await self._ps_send(command, args, kwargs, expected_replies, timeout)
+        deadline = time.monotonic() + timeout
+        try:
+            while not pending.done.done() or not pending.updates.empty():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    yield await asyncio.wait_for(pending.updates.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+        finally:
+            self._ps_finish(pending)
+
+    async def _ps_send(self, command, args, kwargs, expected_replies, timeout):
         request = redis.PubSubCommand.new(self.bot, command, args, kwargs)
-        self._ps_requests_pending[request.id] = {}
-        await self.bot.rdb.publish(COMMAND_PUBSUB_CHANNEL, request.to_json())
-
-        for _ in range(timeout * 10):  # timeout after 30 sec
-            if len(self._ps_requests_pending[request.id]) >= expected_replies:
-                break
-            else:
-                await asyncio.sleep(0.1)
-
-        return self._ps_requests_pending.pop(request.id)
+        pending = PendingCall(request, expected_replies, timeout)
+        self._ps_requests_pending[request.id] = pending
+        try:
+            await self._ps_publisher.publish(request)
+        except BaseException:
+            del self._ps_requests_pending[request.id]
+            raise
+        return pending
+
+    def _ps_finish(self, pending):
+        """Stops collecting replies for a call (finished, timed out or cancelled) and records its metrics."""
+        self._ps_requests_pending.pop(pending.request.id, None)
+        metrics = self.ps_metrics[pending.request.command]
+        metrics['calls'] += 1
+        metrics['replies'] += len(pending.replies)
+        elapsed = time.monotonic() - pending.started
+        metrics['ms'] += int(elapsed * 1000)
+        if not pending.done.done():
+            metrics['timeouts' if elapsed >= pending.timeout else 'cancelled'] += 1
+            pending.done.cancel()
 
     async def _ps_recv(self, message):
         redis.pslogger.debug(message)
-        msg = redis.deserialize_ps_msg(message)
-        if msg.type == 'reply':
-            await self._ps_reply(msg)
-        elif msg.type == 'cmd':
-            await self._ps_cmd(msg)
+        for msg in redis.deserialize_ps_frame(message, PS_CODEC):
+            if msg.type == 'reply':
+                await self._ps_reply(msg)
+            elif msg.type == 'cmd':
+                await self._ps_cmd(msg)
 
     async def _ps_reply(self, message: redis.PubSubReply):
         if message.reply_to not in self._ps_requests_pending:
             return
-        self._ps_requests_pending[message.reply_to][message.sender] = message.data
+        self._ps_requests_pending[message.reply_to].add_reply(message.sender, message.data)
 
     async def _ps_cmd(self, message: redis.PubSubCommand):
         if message.command not in self._ps_cmd_map:
@@ -285,7 +404,7 @@ class AdminUtils(commands.Cog):
 
         if result is not False:
             response = redis.PubSubReply.new(self.bot, reply_to=message.id, data=result)
-            await self.bot.rdb.publish(COMMAND_PUBSUB_CHANNEL, response.to_json())
+            await self._ps_publisher.publish(response, batch=True)
 
 
 # ==== setup ====
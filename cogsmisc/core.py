@@ -14,6 +14,8 @@ from discord.ext import commands
 
 from cogsmisc.stats import Stats
 
+BUILD_NUM_TTL = 10 * 60  # seconds to cache the build number for
+
 
 class Core(commands.Cog):
     """
@@ -81,7 +83,7 @@ class Core(commands.Cog):
                               "Will give higher rolls for tea", "The answer is 42",
                               "Does anyone even read these?"])
         embed.set_footer(
-            text=f'{motd} | Build {await self.bot.rdb.get("build_num")} | Cluster {self.bot.cluster_id}')
+            text=f'{motd} | Build {await self.bot.rdb.cached_get("build_num", BUILD_NUM_TTL)} | Cluster {self.bot.cluster_id}')
 
         #commands_run = "{commands_used_life} total\n{dice_rolled_life} dice rolled\n" \
         #               "{spells_looked_up_life} spells looked up\n{monsters_looked_up_life} monsters looked up\n" \
@@ -15,6 +15,7 @@ from discord.ext.commands import BucketType, UserInputError
 #from cogs5e.models.character import Character
 #from cogs5e.models.embeds import EmbedWithAuthor
 #from cogs5e.models.errors import AvraeException, EvaluationError, NoCharacter
+from cogsmisc.adminUtils import publish_command
 from utils import checks
 from utils.argparser import argquote, argsplit
 from utils.functions import auth_and_chan, clean_content, confirm
@@ -55,7 +56,7 @@ class Customization(commands.Cog):
             current_prefix = await self.bot.get_server_prefix(ctx.message)
             return await ctx.send(f"My current prefix is: `{current_prefix}`")
         # insert into cache
-        self.bot.prefixes[guild_id] = prefix
+        self.bot.prefixes.set(guild_id, prefix)
 
         # update db
         await self.bot.mdb.prefixes.update_one(
@@ -63,6 +64,8 @@ class Customization(commands.Cog):
             {"$set": {"prefix": prefix}},
             upsert=True
         )
+        # and drop every cluster's cached copy
+        await publish_command(self.bot, "invalidate_prefix", kwargs={"guild_id": guild_id})
 
         await ctx.send("Prefix set to `{}` for this server.".format(prefix))
 
@@ -88,16 +91,10 @@ class Customization(commands.Cog):
         prefix = await self.bot.get_server_prefix(message)
         if message.content.startswith(prefix):
             alias = message.content[len(prefix):].split(' ')[0]
-            if message.guild:
-                command = (await self.bot.mdb.aliases.find_one({"owner": str(message.author.id), "name": alias},
-                                                               ['commands'])) or \
-                          (await self.bot.mdb.servaliases.find_one({"server": str(message.guild.id), "name": alias},
-                                                                   ['commands']))
-            else:
-                command = await self.bot.mdb.aliases.find_one({"owner": str(message.author.id), "name": alias},
-                                                              ['commands'])
+            guild_id = str(message.guild.id) if message.guild else None
+            # built-in commands can't be aliases: the cache answers those without a lookup
+            command = await self.bot.alias_cache.get(alias, str(message.author.id), guild_id)
             if command:
-                command = command['commands']
                 try:
                     message.content = await self.handle_alias_arguments(command, message)
                 except UserInputError as e:
@@ -191,6 +188,7 @@ class Customization(commands.Cog):
             return await ctx.send(out)
 
         await helpers.create_alias(ctx, alias_name, cmds.lstrip("!"))
+        await self.invalidate_aliases(owner=str(ctx.author.id))
 
         out = f'Alias `{ctx.prefix}{alias_name}` added.' \
               f'```py\n{ctx.prefix}alias {alias_name} {cmds.lstrip("!")}\n```'
@@ -215,6 +213,7 @@ class Customization(commands.Cog):
         result = await self.bot.mdb.aliases.delete_one({"owner": str(ctx.author.id), "name": alias_name})
         if not result.deleted_count:
             return await ctx.send('Alias not found.')
+        await self.invalidate_aliases(owner=str(ctx.author.id))
         await ctx.send('Alias {} removed.'.format(alias_name))
 
     @alias.command(name='deleteall', aliases=['removeall'])
@@ -228,6 +227,7 @@ class Customization(commands.Cog):
             return await ctx.send("Unconfirmed. Aborting.")
 
         await self.bot.mdb.aliases.delete_many({"owner": str(ctx.author.id)})
+        await self.invalidate_aliases(owner=str(ctx.author.id))
         return await ctx.send("OK. I have deleted all your aliases.")
 
     @commands.group(invoke_without_command=True, aliases=['serveralias'])
@@ -260,6 +260,7 @@ class Customization(commands.Cog):
                                   "is required.")
 
         await helpers.create_servalias(ctx, alias_name, cmds.lstrip("!"))
+        await self.invalidate_aliases(server=str(ctx.guild.id))
 
         out = f'Server alias `{ctx.prefix}{alias_name}` added.' \
               f'```py\n{ctx.prefix}alias {alias_name} {cmds.lstrip("!")}\n```'
@@ -287,8 +288,14 @@ class Customization(commands.Cog):
         result = await self.bot.mdb.servaliases.delete_one({"server": str(ctx.guild.id), "name": alias_name})
         if not result.deleted_count:
             return await ctx.send('Server alias not found.')
+        await self.invalidate_aliases(server=str(ctx.guild.id))
         await ctx.send('Server alias {} removed.'.format(alias_name))
 
+    async def invalidate_aliases(self, owner=None, server=None):
+        """Drops a changed alias index from this cluster's cache, then from every other cluster's."""
+        self.bot.alias_cache.invalidate(owner=owner, server=server)
+        await publish_command(self.bot, "invalidate_aliases", kwargs={"owner": owner, "server": server})
+
     @staticmethod
     def can_edit_servaliases(ctx):
         """
@@ -5,14 +5,181 @@ Created on Jul 17, 2017
 """
 import asyncio
 import datetime
+import logging
 import time
-from collections import Counter
+from collections import Counter, defaultdict
 
 from discord.ext import commands
+from pymongo import UpdateOne
+from pymongo.errors import ConnectionFailure, PyMongoError
 
 from utils import config
 
 GUILD_RDB_KEY = "stats.cluster_guilds"
+GUILD_COUNT_TTL = 60  # seconds to cache the other clusters' guild counts for
+FLUSH_INTERVAL = 5  # seconds between StatsBuffer flushes
+FLUSH_EVENTS = 100  # increments that trigger an early flush
+MAX_PENDING = 10000  # documents StatsBuffer holds updates for, e.g. while Mongo is down
+ANALYTICS_QUEUE_SIZE = 10000  # events waiting for the analytics consumer
+
+log = logging.getLogger(__name__)
+
+
+class StatsBuffer:
+    """Accumulates counter increments in memory and writes them to Mongo as one
+    unordered bulk_write of $inc upserts per collection, every few seconds or
+    every max_events increments, and once more on close().
+    Increments to the same document are merged, so a busy command costs one
+    update per flush rather than one round-trip per call. Fields set with
+    $currentDate get the time of the flush.
+    Updates to documents beyond the first max_pending are dropped and counted."""
+
+    def __init__(self, mdb, interval=FLUSH_INTERVAL, max_events=FLUSH_EVENTS, max_pending=MAX_PENDING):
+        self.mdb = mdb
+        self.interval = interval
+        self.max_events = max_events
+        self.max_pending = max_pending
+        # (collection, filter items) -> (Counter of $inc deltas, set of $currentDate fields)
+        self.pending = {}
+        self.events = 0
+        self.dropped = 0
+        self._lock = asyncio.Lock()
+        self._task = None
+        self._early_flush = None
+
+    def inc(self, collection, query, field, amount=1, date_field=None):
+        """Adds amount to field of the document in collection matching query
+        (upserting it), the next time the buffer is flushed."""
+        key = (collection, tuple(sorted(query.items())))
+        if key not in self.pending and len(self.pending) >= self.max_pending:
+            self.dropped += 1
+            return
+        deltas, dates = self.pending.setdefault(key, (Counter(), set()))
+        deltas[field] += amount
+        if date_field is not None:
+            dates.add(date_field)
+        self.events += 1
+        if self.events >= self.max_events:
+            self.events = 0
+            if self._early_flush is None or self._early_flush.done():
+                self._early_flush = asyncio.ensure_future(self._scheduled_flush())
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._flush_loop())
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self._scheduled_flush()
+
+    async def _scheduled_flush(self):
+        # nothing awaits these flushes, so a failure is logged here or never seen
+        try:
+            await self.flush()
+        except Exception:
+            log.exception("Failed to flush stat updates")
+
+    async def flush(self):
+        async with self._lock:
+            pending, self.pending, self.events = self.pending, {}, 0
+            by_collection = defaultdict(list)
+            for (collection, query), (deltas, dates) in pending.items():
+                by_collection[collection].append((query, deltas, dates))
+
+            for collection, updates in by_collection.items():
+                ops = []
+                for query, deltas, dates in updates:
+                    update = {"$inc": dict(deltas)}
+                    if dates:
+                        update["$currentDate"] = {field: True for field in dates}
+                    ops.append(UpdateOne(dict(query), update, upsert=True))
+                try:
+                    await self.mdb[collection].bulk_write(ops, ordered=False)
+                except ConnectionFailure as e:
+                    # most likely nothing was written; keep the deltas for the next flush
+                    log.warning(f"Could not flush {len(ops)} stat updates to {collection}: {e}")
+                    dropped = self.dropped
+                    for query, deltas, dates in updates:
+                        key = (collection, query)
+                        if key not in self.pending and len(self.pending) >= self.max_pending:
+                            self.dropped += 1
+                            continue
+                        old_deltas, old_dates = self.pending.setdefault(key, (Counter(), set()))
+                        old_deltas.update(deltas)
+                        old_dates.update(dates)
+                    if self.dropped > dropped:
+                        log.warning(f"Dropped {self.dropped - dropped} stat updates to {collection}: "
+                                    f"more than {self.max_pending} documents pending")
+                except PyMongoError as e:
+                    log.warning(f"Dropped {len(ops)} stat updates to {collection}: {e}")
+
+    async def close(self):
+        """Stops the periodic flush and writes out whatever is still buffered."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._early_flush is not None:
+            await self._early_flush
+            self._early_flush = None
+        await self.flush()
+
+
+class AnalyticsPipeline:
+    """Write-behind analytics. Commands submit events without waiting on Mongo;
+    a background consumer drains the bounded queue into a StatsBuffer, which
+    coalesces them by document and writes them in bulk.
+    When the queue is full, new events are dropped and counted instead of
+    holding up the command."""
+
+    def __init__(self, buffer, maxsize=ANALYTICS_QUEUE_SIZE):
+        self.buffer = buffer
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.dropped = 0
+        self.processed = 0
+        self.lag = 0.0  # seconds the last processed event spent queued
+        self.max_lag = 0.0
+        self._task = None
+
+    def submit(self, *increments):
+        """Queues one event, made of StatsBuffer.inc() argument tuples."""
+        try:
+            self.queue.put_nowait((time.monotonic(), increments))
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._consume())
+
+    async def _consume(self):
+        while True:
+            self._process(*await self.queue.get())
+
+    def _process(self, queued_at, increments):
+        self.lag = time.monotonic() - queued_at
+        self.max_lag = max(self.max_lag, self.lag)
+        for increment in increments:
+            self.buffer.inc(*increment)
+        self.processed += 1
+
+    def metrics(self):
+        return {
+            "depth": self.queue.qsize(),
+            "capacity": self.queue.maxsize,
+            "processed": self.processed,
+            "dropped": self.dropped,
+            "lag": self.lag,
+            "max_lag": self.max_lag
+        }
+
+    async def close(self):
+        """Stops the consumer and hands everything still queued to the buffer."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        while not self.queue.empty():
+            self._process(*self.queue.get_nowait())
 
 
 class Stats(commands.Cog):
@@ -32,9 +199,11 @@ class Stats(commands.Cog):
     async def on_command(self, ctx):
         command = ctx.command.qualified_name
         self.command_stats[command] += 1
-        await self.user_activity(ctx)
-        await self.guild_activity(ctx)
-        await self.command_activity(ctx)
+        self.bot.analytics.submit(
+            self.user_activity(ctx),
+            self.guild_activity(ctx),
+            *self.command_activity(ctx)
+        )
 
     # ===== tasks =====
     async def scheduled_update(self):
@@ -59,40 +228,26 @@ class Stats(commands.Cog):
         await self.bot.rdb.hset(GUILD_RDB_KEY, str(self.bot.cluster_id), cluster_servers)
 
     # ===== analytic loggers =====
-    async def user_activity(self, ctx):
-        await self.bot.mdb.analytics_user_activity.update_one(
-            {"user_id": ctx.author.id},
-            {
-                "$inc": {"commands_called": 1},
-                "$currentDate": {"last_command_time": True}
-            },
-            upsert=True
-        )
+    # these return StatsBuffer.inc() arguments for AnalyticsPipeline.submit()
+    @staticmethod
+    def user_activity(ctx):
+        return "analytics_user_activity", {"user_id": ctx.author.id}, "commands_called", 1, "last_command_time"
 
-    async def guild_activity(self, ctx):
+    @staticmethod
+    def guild_activity(ctx):
         if ctx.guild is None:
             guild_id = 0
         else:
             guild_id = ctx.guild.id
 
-        await self.bot.mdb.analytics_guild_activity.update_one(
-            {"guild_id": guild_id},
-            {
-                "$inc": {"commands_called": 1},
-                "$currentDate": {"last_command_time": True}
-            },
-            upsert=True
-        )
+        return "analytics_guild_activity", {"guild_id": guild_id}, "commands_called", 1, "last_command_time"
 
-    async def command_activity(self, ctx):
-        await self.increase_stat(ctx, "commands_used_life")
-        await self.bot.mdb.analytics_command_activity.update_one(
-            {"name": ctx.command.qualified_name},
-            {
-                "$inc": {"num_invocations": 1},  # yay, atomic operations
-                "$currentDate": {"last_invoked_time": True}
-            },
-            upsert=True
+    @staticmethod
+    def command_activity(ctx):
+        return (
+            ("random_stats", {"key": "commands_used_life"}, "value"),
+            ("analytics_command_activity", {"name": ctx.command.qualified_name}, "num_invocations", 1,
+             "last_invoked_time")
         )
 
     async def update_hourly(self):
@@ -141,6 +296,14 @@ class Stats(commands.Cog):
         output = '\n'.join('{0:<{1}}: {2}'.format(k, width, c) for k, c in common)
         await ctx.send(f'```\n{output}\n{total} total\n```')
 
+    @commands.command(hidden=True)
+    async def analyticsstats(self, ctx):
+        """Shows the state of the analytics write-behind queue."""
+        m = self.bot.analytics.metrics()
+        await ctx.send(f"```\nqueue depth: {m['depth']}/{m['capacity']}\n"
+                       f"processed: {m['processed']}\ndropped: {m['dropped']}\n"
+                       f"lag: {m['lag'] * 1000:.1f}ms (max {m['max_lag'] * 1000:.1f}ms)\n```")
+
     # ===== event listeners =====
     # we can update our server count as we join/leave servers
     @commands.Cog.listener()
@@ -154,11 +317,7 @@ class Stats(commands.Cog):
     # ===== utils =====
     @staticmethod
     async def increase_stat(ctx, stat):
-        await ctx.bot.mdb.random_stats.update_one(
-            {"key": stat},
-            {"$inc": {"value": 1}},
-            upsert=True
-        )
+        ctx.bot.analytics.submit(("random_stats", {"key": stat}, "value"))
 
     @staticmethod
     async def get_statistic(ctx, stat):
@@ -174,7 +333,7 @@ class Stats(commands.Cog):
     @staticmethod
     async def get_guild_count(bot):
         """Returns the total number of guilds the entire bot can see, across all shards."""
-        cluster_servers = await bot.rdb.get_whole_dict(GUILD_RDB_KEY)
+        cluster_servers = await bot.rdb.cached_get_whole_dict(GUILD_RDB_KEY, GUILD_COUNT_TTL)
         return sum(int(v) for v in cluster_servers.values())
 
 
@@ -20,8 +20,12 @@ from discord.errors import Forbidden, HTTPException, InvalidArgument, NotFound
 from discord.ext import commands
 from discord.ext.commands.errors import CommandInvokeError
 
+from cogscc.funcs.dice import SeededDiceSource, SystemDiceSource, set_dice_source
 from cogscc.models.errors import BambleweenyException, EvaluationError
+from cogsmisc.stats import AnalyticsPipeline, StatsBuffer
+from utils.aliases import AliasCache
 from utils.help import help_command
+from utils.prefixes import PrefixCache
 from utils.redisIO import RedisIO
 
 COGS = (
@@ -32,16 +36,7 @@ COGS = (
 async def get_prefix(the_bot, message):
     if not message.guild:
         return commands.when_mentioned_or(config.DEFAULT_PREFIX)(the_bot, message)
-    guild_id = str(message.guild.id)
-    if guild_id in the_bot.prefixes:
-        gp = the_bot.prefixes.get(guild_id, config.DEFAULT_PREFIX)
-    else:  # load from db and cache
-        gp_obj = await the_bot.mdb.prefixes.find_one({"guild_id": guild_id})
-        if gp_obj is None:
-            gp = config.DEFAULT_PREFIX
-        else:
-            gp = gp_obj.get("prefix", config.DEFAULT_PREFIX)
-        the_bot.prefixes[guild_id] = gp
+    gp = await the_bot.prefixes.get(str(message.guild.id))
     return commands.when_mentioned_or(gp)(the_bot, message)
 
 
@@ -57,9 +52,21 @@ class Avrae(commands.AutoShardedBot):
             self.mclient = motor.motor_asyncio.AsyncIOMotorClient(config.MONGO_URL)
         self.mdb = self.mclient[config.MONGODB_DB_NAME]
         self.rdb = self.loop.run_until_complete(self.setup_rdb())
-        self.prefixes = dict()
+        self.prefixes = PrefixCache(self.mdb)
+        self.alias_cache = AliasCache(self.mdb, reserved=self.all_commands)
         self.muted = set()
         self.cluster_id = 0
+        self.stats_buffer = StatsBuffer(self.mdb)
+        self.analytics = AnalyticsPipeline(self.stats_buffer)
+        self.loop.call_soon(self.stats_buffer.start)
+        self.loop.call_soon(self.analytics.start)
+
+        if config.DICE_SEED is not None:
+            self.dice_source = SeededDiceSource(int(config.DICE_SEED))
+        else:
+            self.dice_source = SystemDiceSource()
+        set_dice_source(self.dice_source)
+        self.backup_format = config.BACKUP_FORMAT
 
         if config.SENTRY_DSN is not None:
             release = None
@@ -74,6 +81,11 @@ class Avrae(commands.AutoShardedBot):
             redis_url = config.REDIS_URL
         return RedisIO(await aioredis.create_redis_pool(redis_url, db=config.REDIS_DB_NUM))
 
+    async def close(self):
+        await self.analytics.close()
+        await self.stats_buffer.close()
+        await super(Avrae, self).close()
+
     async def get_server_prefix(self, msg):
         return (await get_prefix(self, msg))[-1]
 
@@ -156,6 +168,7 @@ async def on_ready():
     log.info(bot.user.name)
     log.info(bot.user.id)
     log.info('------')
+    await bot.prefixes.warm(str(guild.id) for guild in bot.guilds)
 
 
 @bot.event
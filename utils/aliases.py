@@ -0,0 +1,52 @@
+from utils.cache import LRUCache
+
+ALIAS_CACHE_SIZE = 5000  # alias indexes (users plus guilds)
+ALIAS_CACHE_TTL = 60 * 60  # seconds
+
+
+class AliasCache:
+    """
+    Per-user and per-guild alias indexes (alias name -> commands), each loaded with one find the
+    first time it's needed and kept in an LRU cache with TTL eviction.
+    An index holds all of its owner's aliases, so a name missing from a cached index is known not
+    to be an alias; users and guilds with no aliases at all are cached as empty indexes. Reserved
+    names (the bot's own commands) are never aliases, and are answered without loading an index.
+    Alias writes publish "invalidate_aliases" on the admin pubsub channel so every cluster drops
+    the stale index (see AdminUtils).
+    """
+
+    def __init__(self, mdb, reserved=(), maxsize=ALIAS_CACHE_SIZE, ttl=ALIAS_CACHE_TTL):
+        self.mdb = mdb
+        self.reserved = reserved
+        self._cache = LRUCache(maxsize, ttl)
+
+    async def _index(self, collection, field, owner_id):
+        key = (collection, owner_id)
+        index = self._cache.get(key)
+        if index is None:
+            index = {}
+            async for alias in self.mdb[collection].find({field: owner_id}, ['name', 'commands']):
+                index[alias['name']] = alias['commands']
+            self._cache.set(key, index)
+        return index
+
+    async def user_aliases(self, user_id: str):
+        return await self._index("aliases", "owner", user_id)
+
+    async def guild_aliases(self, guild_id: str):
+        return await self._index("servaliases", "server", guild_id)
+
+    async def get(self, name, user_id: str, guild_id: str = None):
+        """Returns: The commands of the user's alias called name, else the guild's, else None."""
+        if name in self.reserved:
+            return None
+        command = (await self.user_aliases(user_id)).get(name)
+        if command is None and guild_id is not None:
+            command = (await self.guild_aliases(guild_id)).get(name)
+        return command
+
+    def invalidate(self, owner: str = None, server: str = None):
+        if owner is not None:
+            self._cache.pop(("aliases", owner))
+        if server is not None:
+            self._cache.pop(("servaliases", server))
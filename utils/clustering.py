@@ -53,13 +53,21 @@ async def _coordinate_shards(bot):
     }
     """
     cluster_coordination_key = f"clusters.{config.GIT_COMMIT_SHA}:{config.NUM_CLUSTERS}"
-    coordinator_exists = await bot.rdb.exists(cluster_coordination_key)
     my_task_arn, my_family, my_ecs_cluster_name = await _get_ecs_metadata()
 
+    # read the coordinator in one round-trip (we hold the lock, so it can't change under us)
+    async with bot.rdb.pipeline() as p:
+        num_shards = p.hget(cluster_coordination_key, "num_shards")
+        num_keys = p.hlen(cluster_coordination_key)
+        my_id_exists = p.hexists(cluster_coordination_key, my_task_arn)
+    coordinator_exists = num_shards.result() is not None
+
     # get the total number of shards running on this acct
     if coordinator_exists:
         # get the canonical number of shards
-        bot.shard_count = int(await bot.rdb.hget(cluster_coordination_key, "num_shards"))
+        bot.shard_count = int(num_shards.result())
+        num_existing_clusters = num_keys.result() - 1
+        my_id_exists = my_id_exists.result()
     else:
         if config.NUM_SHARDS is None:
             # how many shards does Discord want?
@@ -70,11 +78,11 @@ async def _coordinate_shards(bot):
         await bot.rdb.hset(cluster_coordination_key, "num_shards", recommended_shards)
         bot.shard_count = recommended_shards
         log.info(f"Created task coordinator {cluster_coordination_key} with num_shards={bot.shard_count}!")
+        num_existing_clusters = 0
+        my_id_exists = False
     log.debug(f"SHARD_COUNT={bot.shard_count}")
 
     # claim unclaimed shards, or take over a dead task
-    num_existing_clusters = await bot.rdb.hlen(cluster_coordination_key) - 1
-    my_id_exists = await bot.rdb.hexists(cluster_coordination_key, my_task_arn)
     if my_id_exists:
         await _claim_existing_cluster(bot, my_task_arn, cluster_coordination_key)
     elif num_existing_clusters < config.NUM_CLUSTERS:
@@ -18,6 +18,9 @@ SENTRY_DSN = os.getenv('SENTRY_DSN') or None
 NUM_CLUSTERS = int(os.getenv('NUM_CLUSTERS')) if 'NUM_CLUSTERS' in os.environ else None
 NUM_SHARDS = int(os.getenv('NUM_SHARDS')) if 'NUM_SHARDS' in os.environ else None
 NO_DICECLOUD = os.environ.get("NO_DICECLOUD", False)
+BACKUP_FORMAT = os.getenv('BACKUP_FORMAT', 'chunks')  # chunks, json or snapshot - format of !save's backups
+PUBSUB_CODEC = os.getenv('PUBSUB_CODEC', 'json')  # json or msgpack - must match across clusters
+DICE_SEED = os.getenv('DICE_SEED')  # optional - if set, dice are rolled from a deterministic generator
 DICECLOUD_USER = os.getenv('DICECLOUD_USER', 'avrae') if not TESTING else credentials.test_dicecloud_user
 DICECLOUD_PASS = credentials.dicecloud_pass.encode() if not TESTING else credentials.test_dicecloud_pass.encode()
 DICECLOUD_API_KEY = credentials.dicecloud_token if not TESTING else credentials.test_dicecloud_token
@@ -11,6 +11,7 @@ application = newrelic.agent.application()
 
 _motor_classes = {
     'AsyncIOMotorCollection': [
+        'bulk_write',
         'count_documents',
         'delete_many',
         'delete_one',
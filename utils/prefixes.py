@@ -0,0 +1,53 @@
+import logging
+
+from utils import config
+from utils.cache import LRUCache
+
+PREFIX_CACHE_SIZE = 10000
+PREFIX_CACHE_TTL = 60 * 60  # seconds
+
+log = logging.getLogger(__name__)
+
+
+class PrefixCache:
+    """
+    Guild prefixes from the prefixes collection, cached with LRU and TTL eviction so
+    memory stays flat however many guilds the bot is in.
+    Guilds without a custom prefix are cached too, as config.DEFAULT_PREFIX.
+    When a prefix changes, the cluster that changed it publishes "invalidate_prefix" on
+    the admin pubsub channel and every cluster drops its copy (see AdminUtils).
+    """
+
+    def __init__(self, mdb, maxsize=PREFIX_CACHE_SIZE, ttl=PREFIX_CACHE_TTL):
+        self.mdb = mdb
+        self._cache = LRUCache(maxsize, ttl)
+
+    async def get(self, guild_id: str):
+        prefix = self._cache.get(guild_id)
+        if prefix is None:  # load from db and cache
+            gp_obj = await self.mdb.prefixes.find_one({"guild_id": guild_id})
+            if gp_obj is None:
+                prefix = config.DEFAULT_PREFIX
+            else:
+                prefix = gp_obj.get("prefix", config.DEFAULT_PREFIX)
+            self._cache.set(guild_id, prefix)
+        return prefix
+
+    def set(self, guild_id: str, prefix):
+        self._cache.set(guild_id, prefix)
+
+    def invalidate(self, guild_id: str):
+        self._cache.pop(guild_id)
+
+    async def warm(self, guild_ids):
+        """Loads the prefixes of up to maxsize guilds with one find."""
+        guild_ids = list(guild_ids)[:self._cache.maxsize]
+        custom = {}
+        async for gp_obj in self.mdb.prefixes.find({"guild_id": {"$in": guild_ids}}, ['guild_id', 'prefix']):
+            custom[gp_obj['guild_id']] = gp_obj.get('prefix', config.DEFAULT_PREFIX)
+        for guild_id in guild_ids:
+            self._cache.set(guild_id, custom.get(guild_id, config.DEFAULT_PREFIX))
+        log.info(f"Warmed prefix cache with {len(guild_ids)} guilds ({len(custom)} custom).")
+
+    def __len__(self):
+        return len(self._cache)
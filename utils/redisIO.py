@@ -4,9 +4,16 @@ Created on Dec 28, 2016
 @author: andrew
 """
 import abc
+import asyncio
+import itertools
 import json
 import logging
-import uuid
+import random
+from collections import Counter
+
+from utils.cache import LRUCache
+
+RDB_CACHE_SIZE = 256  # cached keys (see RedisIO.cached_get)
 
 
 class RedisIO:
@@ -14,36 +21,78 @@ class RedisIO:
     A simple class to interface with the redis database.
     """
 
-    def __init__(self, _db):
+    def __init__(self, _db, cache_size=RDB_CACHE_SIZE):
         """
         :type _db: :class:`aioredis.Redis`
         """
         self._db = _db
+        self._cache = LRUCache(cache_size)  # (kind, key) -> value
+        self.cache_hits = Counter()  # key -> hits
+        self.cache_misses = Counter()  # key -> misses
 
     async def get(self, key, default=None):
         encoded_data = await self._db.get(key)
         return encoded_data.decode() if encoded_data is not None else default
 
     async def set(self, key, value, **kwargs):
+        self.invalidate(key)
         return await self._db.set(key, value, **kwargs)
 
     async def incr(self, key):
+        self.invalidate(key)
         return await self._db.incr(key)
 
     async def exists(self, *keys):
         return await self._db.exists(*keys)
 
     async def delete(self, *keys):
+        self.invalidate(*keys)
         return await self._db.delete(*keys)
 
     async def setex(self, key, value, expiration):
+        self.invalidate(key)
         return await self._db.setex(key, expiration, value)
 
     async def setnx(self, key, value):
+        self.invalidate(key)
         return await self._db.setnx(key, value)
 
+    # ==== read-through cache ====
+    # for hot, read-mostly keys: values are kept locally for ttl seconds. Writes through this RedisIO drop the
+    # local copy; other clusters' copies expire, or are dropped by the "invalidate_rdb" pubsub command.
+    async def _cached(self, kind, key, ttl, fetch):
+        value = self._cache.get((kind, key), _MISSING)
+        if value is not _MISSING:
+            self.cache_hits[key] += 1
+            return value
+        self.cache_misses[key] += 1
+        value = await fetch()
+        self._cache.set((kind, key), value, ttl=ttl)
+        return value
+
+    async def cached_get(self, key, ttl, default=None):
+        return await self._cached('get', key, ttl, lambda: self.get(key, default))
+
+    async def cached_jget(self, key, ttl, default=None):
+        return await self._cached('jget', key, ttl, lambda: self.jget(key, default))
+
+    async def cached_get_whole_dict(self, key, ttl):
+        return await self._cached('hash', key, ttl, lambda: self.get_whole_dict(key))
+
+    def invalidate(self, *keys):
+        """Drops any locally cached values of keys."""
+        for key in keys:
+            for kind in ('get', 'jget', 'hash'):
+                self._cache.pop((kind, key))
+
+    def cache_stats(self):
+        """Returns a dict of {key: (hits, misses)}."""
+        return {key: (self.cache_hits[key], self.cache_misses[key])
+                for key in self.cache_hits.keys() | self.cache_misses.keys()}
+
     # ==== hashmaps ====
     async def set_dict(self, key, dictionary):
+        self.invalidate(key)
         return await self._db.hmset_dict(key, **dictionary)
 
     async def get_dict(self, key, dict_key):
@@ -62,9 +111,11 @@ class RedisIO:
         return out if out is not None else default
 
     async def hset(self, key, field, value):
+        self.invalidate(key)
         return await self._db.hset(key, field, value)
 
     async def hdel(self, key, *fields):
+        self.invalidate(key)
         return await self._db.hdel(key, *fields)
 
     async def hlen(self, key):
@@ -74,6 +125,7 @@ class RedisIO:
         return await self._db.hexists(hashkey, key)
 
     async def hincrby(self, key, field, increment):
+        self.invalidate(key)
         return await self._db.hincrby(key, field, increment)
 
     async def jhget(self, key, field, default=None):
@@ -121,6 +173,136 @@ class RedisIO:
     async def publish(self, channel, data):
         return await self._db.publish(channel, data)
 
+    # ==== pipelines ====
+    def pipeline(self, transaction=False):
+        """
+        Queues commands and sends them in one round-trip when the block exits::
+
+            async with rdb.pipeline() as p:
+                muted = p.jget('muted', [])
+                blacklist = p.jget('blacklist', [])
+            muted.result(), blacklist.result()
+
+        If transaction is True, the commands are wrapped in MULTI/EXEC.
+        """
+        return RedisPipeline(self._db.multi_exec() if transaction else self._db.pipeline(), self)
+
+
+class RedisPipeline:
+    """
+    Queued commands, mirroring RedisIO. Each returns a future that resolves to what the RedisIO method
+    would have returned once the pipeline is executed. Keys written through the pipeline are dropped from
+    rdb's read-through cache when it is executed.
+    """
+
+    def __init__(self, _pipe, rdb):
+        self._pipe = _pipe
+        self._rdb = rdb
+        self._queued = []  # (aioredis future, transform, our future)
+        self._written = set()  # keys to invalidate in rdb's cache
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            await self.execute()
+
+    async def execute(self):
+        """Sends the queued commands. Returns their results in order, with exceptions in place of failures."""
+        queued, self._queued = self._queued, []
+        written, self._written = self._written, set()
+        if not queued:
+            return []
+        try:
+            await self._pipe.execute(return_exceptions=True)
+        finally:
+            self._rdb.invalidate(*written)
+        results = []
+        for raw, transform, future in queued:
+            try:
+                future.set_result(transform(raw.result()))
+            except Exception as e:  # a failed command only fails its own future
+                future.set_exception(e)
+            results.append(future.exception() or future.result())
+        return results
+
+    def _queue(self, raw, transform=None):
+        future = asyncio.get_event_loop().create_future()
+        self._queued.append((raw, transform or (lambda v: v), future))
+        return future
+
+    def _write(self, raw, *keys):
+        self._written.update(keys)
+        return self._queue(raw)
+
+    def get(self, key, default=None):
+        return self._queue(self._pipe.get(key), lambda v: v.decode() if v is not None else default)
+
+    def set(self, key, value, **kwargs):
+        return self._write(self._pipe.set(key, value, **kwargs), key)
+
+    def incr(self, key):
+        return self._write(self._pipe.incr(key), key)
+
+    def exists(self, *keys):
+        return self._queue(self._pipe.exists(*keys))
+
+    def delete(self, *keys):
+        return self._write(self._pipe.delete(*keys), *keys)
+
+    def setex(self, key, value, expiration):
+        return self._write(self._pipe.setex(key, expiration, value), key)
+
+    def setnx(self, key, value):
+        return self._write(self._pipe.setnx(key, value), key)
+
+    # ==== hashmaps ====
+    def get_whole_dict(self, key, default=None):
+        if default is None:
+            default = {}
+        return self._queue(self._pipe.hgetall(key, encoding='utf-8'), lambda v: v if v is not None else default)
+
+    def hget(self, key, field, default=None):
+        return self._queue(self._pipe.hget(key, field, encoding='utf-8'),
+                           lambda v: v if v is not None else default)
+
+    def hset(self, key, field, value):
+        return self._write(self._pipe.hset(key, field, value), key)
+
+    def hdel(self, key, *fields):
+        return self._write(self._pipe.hdel(key, *fields), key)
+
+    def hlen(self, key):
+        return self._queue(self._pipe.hlen(key))
+
+    def hexists(self, hashkey, key):
+        return self._queue(self._pipe.hexists(hashkey, key))
+
+    def hincrby(self, key, field, increment):
+        return self._write(self._pipe.hincrby(key, field, increment), key)
+
+    def jhget(self, key, field, default=None):
+        return self._queue(self._pipe.hget(key, field, encoding='utf-8'),
+                           lambda v: json.loads(v) if v is not None else default)
+
+    def jhset(self, key, field, value, **kwargs):
+        return self.hset(key, field, json.dumps(value, **kwargs))
+
+    # ==== json ====
+    def jset(self, key, data, **kwargs):
+        return self.set(key, json.dumps(data, **kwargs))
+
+    def jsetex(self, key, data, exp, **kwargs):
+        return self.setex(key, json.dumps(data, **kwargs), exp)
+
+    def jget(self, key, default=None):
+        return self._queue(self._pipe.get(key), lambda v: json.loads(v) if v is not None else default)
+
+    # ==== pubsub ====
+    def publish(self, channel, data):
+        return self._queue(self._pipe.publish(channel, data))
+
 
 class _PubSubMessageBase(abc.ABC):
     def __init__(self, type, id, sender):
@@ -139,6 +321,18 @@ class _PubSubMessageBase(abc.ABC):
         return json.dumps(self.to_dict())
 
 
+_MISSING = object()
+
+
+# request/reply ids: the sending cluster in the high bits, a per-process counter (from a random start, so a
+# restarted cluster doesn't reuse recent ids) in the low 40
+_ps_id_counter = itertools.count(random.getrandbits(32))
+
+
+def new_ps_id(bot):
+    return ((bot.cluster_id or 0) << 40) | (next(_ps_id_counter) & ((1 << 40) - 1))
+
+
 class PubSubCommand(_PubSubMessageBase):
     def __init__(self, id, sender, command, args, kwargs):
         super().__init__('cmd', id, sender)
@@ -152,8 +346,7 @@ class PubSubCommand(_PubSubMessageBase):
             args = []
         if kwargs is None:
             kwargs = {}
-        _id = str(uuid.uuid4())
-        return cls(_id, bot.cluster_id, command, args, kwargs)
+        return cls(new_ps_id(bot), bot.cluster_id, command, args, kwargs)
 
     def to_dict(self):
         inst = super(PubSubCommand, self).to_dict()
@@ -169,8 +362,7 @@ class PubSubReply(_PubSubMessageBase):
 
     @classmethod
     def new(cls, bot, reply_to, data):
-        _id = str(uuid.uuid4())
-        return cls(_id, bot.cluster_id, reply_to, data)
+        return cls(new_ps_id(bot), bot.cluster_id, reply_to, data)
 
     def to_dict(self):
         inst = super().to_dict()
@@ -185,10 +377,114 @@ PS_DESER_MAP = {
 
 
 def deserialize_ps_msg(message: str):
-    data = json.loads(message)
+    return _deserialize_ps_dict(json.loads(message))
+
+
+def _deserialize_ps_dict(data):
     t = data.pop('type')
     if t not in PS_DESER_MAP:
         raise TypeError(f"{t} is not a valid pubsub message type.")
     return PS_DESER_MAP[t].from_dict(data)
 
+
+def deserialize_ps_frame(frame, codec):
+    """Decodes a frame of one or more pubsub messages. Returns a list of messages."""
+    return [_deserialize_ps_dict(data) for data in codec.decode(frame)]
+
+
+# ==== pubsub codecs ====
+class PubSubCodec(abc.ABC):
+    """Turns a list of message dicts into one pubsub frame and back."""
+    encoding = None  # what to decode received frames with before decode(), if anything
+
+    @abc.abstractmethod
+    def encode(self, messages):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def decode(self, frame):
+        raise NotImplementedError
+
+
+class JSONPubSubCodec(PubSubCodec):
+    """JSON frames. A single message is sent as a bare object, as before batching existed."""
+    encoding = 'utf-8'
+
+    def encode(self, messages):
+        return json.dumps(messages[0] if len(messages) == 1 else messages)
+
+    def decode(self, frame):
+        data = json.loads(frame)
+        return data if isinstance(data, list) else [data]
+
+
+class MsgpackPubSubCodec(PubSubCodec):
+    """msgpack frames: smaller than JSON and cheaper to parse."""
+
+    def __init__(self):
+        import msgpack  # only needed when this codec is configured
+        self._msgpack = msgpack
+
+    def encode(self, messages):
+        return self._msgpack.packb(messages, use_bin_type=True)
+
+    def decode(self, frame):
+        return self._msgpack.unpackb(frame, raw=False, strict_map_key=False)
+
+
+PS_CODECS = {
+    "json": JSONPubSubCodec,
+    "msgpack": MsgpackPubSubCodec
+}
+
+
+def get_ps_codec(name):
+    if name not in PS_CODECS:
+        raise ValueError(f"{name} is not a valid pubsub codec.")
+    return PS_CODECS[name]()
+
+
+class PubSubPublisher:
+    """
+    Publishes pubsub messages on one channel. Messages sent with batch=True are held for up to `delay`
+    seconds (or until max_batch are waiting) and published together as one frame.
+    """
+
+    def __init__(self, rdb, channel, codec, delay=0.005, max_batch=32):
+        self.rdb = rdb
+        self.channel = channel
+        self.codec = codec
+        self.delay = delay
+        self.max_batch = max_batch
+        self._batch = []
+        self._flush_handle = None
+
+    async def publish(self, message, batch=False):
+        if not batch:
+            return await self.rdb.publish(self.channel, self.codec.encode([message.to_dict()]))
+        self._batch.append(message.to_dict())
+        if len(self._batch) >= self.max_batch:
+            await self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_event_loop().call_later(
+                self.delay, lambda: asyncio.ensure_future(self._scheduled_flush()))
+
+    async def _scheduled_flush(self):
+        # nothing awaits a flush scheduled by publish(), so a failure is logged here or never seen
+        count = len(self._batch)
+        try:
+            await self.flush()
+        except Exception:
+            pslogger.exception(f"Failed to publish {count} batched messages on {self.channel}")
+
+    async def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._batch:
+            return
+        batch, self._batch = self._batch, []
+        await self.rdb.publish(self.channel, self.codec.encode(batch))
+
+
 pslogger = logging.getLogger("rdb.pubsub")